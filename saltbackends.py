@@ -0,0 +1,666 @@
+""" Storage backends used by saltstorage.
+A backend persists the player dictionaries, match history, player stats and bet history. saltstorage keeps
+the in-memory copies and calls the backend chosen by saltstorage.STORAGE_BACKEND to load and save them.
+"""
+
+import os
+import pickle
+import json
+import gzip
+import shutil
+import struct
+import sqlite3
+import threading
+import contextlib
+from time import time
+import numpy as np
+
+MATCH_FIELDS = 6    # [p1_id, p2_id, winner, p1total, p2total, timestamp]
+MATCH_DTYPE = np.dtype('<i8')
+
+MATCH_LOG_MAGIC = b'SALTMTCH'
+MATCH_LOG_VERSION = 1
+MATCH_LOG_HEADER = np.dtype([('magic', 'S8'), ('version', '<u4'), ('num_fields', '<u4')])
+
+# Player stats are one record per player ID; 'known' is False for IDs without stats
+PLAYER_STATS_DTYPE = np.dtype([('rank', '<f8'), ('wins', '<i8'), ('losses', '<i8'), ('times_seen', '<i8'),
+                               ('acc', '<f8'), ('tpr', '<f8'), ('tnr', '<f8'), ('known', '?')])
+STAT_NAMES = ['rank', 'wins', 'losses', 'times_seen', 'acc', 'tpr', 'tnr']
+STATS_FILE_MAGIC = b'SALTSTAT'
+STATS_FILE_VERSION = 1
+# model_version increases by one every time the stats are saved; timestamp is when they were saved
+STATS_FILE_HEADER = np.dtype([('magic', 'S8'), ('version', '<u4'), ('record_size', '<u4'),
+                              ('model_version', '<u8'), ('timestamp', '<f8')])
+
+
+def as_match_records(matches):
+    return np.asarray(matches, dtype=MATCH_DTYPE).reshape(-1, MATCH_FIELDS)
+
+
+def select_matches(records, pid=None, since=None, until=None):
+    # Filter an (N, 6) match array by player and by timestamp range [since, until)
+    mask = np.ones(len(records), dtype=bool)
+    if pid is not None:
+        mask &= (records[:,0]==pid) | (records[:,1]==pid)
+    if since is not None:
+        mask &= records[:,5] >= since
+    if until is not None:
+        mask &= records[:,5] < until
+    return np.asarray(records[mask])
+
+
+def to_python(value):
+    # sqlite3 cannot bind numpy scalar types
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def names_from_dict(player_name_dict):
+    # ID-indexed name list from an {id: name} dict, with None for unused IDs
+    names = [None]*(max(player_name_dict.keys())+1 if player_name_dict else 0)
+    for pid, name in player_name_dict.items():
+        names[pid] = name
+    return names
+
+
+def encode_json_lines(items):
+    return b''.join(json.dumps(item).encode('utf-8') + b'\n' for item in items)
+
+
+def read_json_lines(filename):
+    with open(filename, 'rb') as infile:
+        data = infile.read()
+    # Drop a partial last line left by an interrupted append, so later appends stay on the right line
+    complete = data.rfind(b'\n') + 1
+    if complete < len(data):
+        with open(filename, 'r+b') as outfile:
+            outfile.truncate(complete)
+    return [json.loads(line) for line in data[:complete].decode('utf-8').splitlines()]
+
+
+def count_json_lines(filename, start=0):
+    # Counts complete lines from byte offset start on, without decoding them
+    count = 0
+    with open(filename, 'rb') as infile:
+        infile.seek(start)
+        for block in iter(lambda: infile.read(1 << 20), b''):
+            count += block.count(b'\n')
+    return count
+
+
+def replace_file(filename, data):
+    # Write to a temporary file first so a crash never leaves a half-written file behind
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as outfile:
+        outfile.write(data)
+    os.rename(temp_filename, filename)
+
+
+def empty_player_stats(size=0):
+    return np.zeros(size, dtype=PLAYER_STATS_DTYPE)
+
+
+def player_stats_from_dicts(stats):
+    # Structured stats array from the seven {pid: value} dicts (ranks, wins, losses, times_seen, acc, tpr, tnr)
+    ranks = stats[0]
+    player_stats = empty_player_stats(max(ranks.keys())+1 if ranks else 0)
+    for name, stat in zip(STAT_NAMES, stats):
+        for pid, value in stat.items():
+            if pid in ranks:
+                player_stats[name][pid] = value
+    player_stats['known'][list(ranks.keys())] = True
+    return player_stats
+
+
+def read_stats_header(filename):
+    header = np.fromfile(filename, dtype=STATS_FILE_HEADER, count=1)
+    if len(header) == 0 or header[0]['magic'] != STATS_FILE_MAGIC or header[0]['record_size'] != PLAYER_STATS_DTYPE.itemsize:
+        raise IOError('{} is not a player stats file'.format(filename))
+    return header[0]
+
+
+def read_stats_file(filename):
+    # Copy-on-write mapping: online updates change the in-memory stats without touching the file
+    header = read_stats_header(filename)
+    num_players = (os.path.getsize(filename) - STATS_FILE_HEADER.itemsize) // PLAYER_STATS_DTYPE.itemsize
+    if num_players == 0:
+        return empty_player_stats(), int(header['model_version'])
+    player_stats = np.memmap(filename, dtype=PLAYER_STATS_DTYPE, mode='c', offset=STATS_FILE_HEADER.itemsize, shape=(num_players,))
+    return player_stats, int(header['model_version'])
+
+
+def write_stats_file(filename, player_stats, model_version):
+    header = np.array([(STATS_FILE_MAGIC, STATS_FILE_VERSION, PLAYER_STATS_DTYPE.itemsize, model_version, time())], dtype=STATS_FILE_HEADER)
+    replace_file(filename, header.tobytes() + np.asarray(player_stats, dtype=PLAYER_STATS_DTYPE).tobytes())
+
+
+def read_match_log(filename):
+    header = np.fromfile(filename, dtype=MATCH_LOG_HEADER, count=1)
+    if len(header) == 0 or header[0]['magic'] != MATCH_LOG_MAGIC or header[0]['num_fields'] != MATCH_FIELDS:
+        raise IOError('{} is not a match log'.format(filename))
+    # Ignore a trailing partial record left by an interrupted append
+    num_records = (os.path.getsize(filename) - MATCH_LOG_HEADER.itemsize) // (MATCH_FIELDS*MATCH_DTYPE.itemsize)
+    if num_records == 0:
+        return np.zeros((0, MATCH_FIELDS), dtype=MATCH_DTYPE)
+    return np.memmap(filename, dtype=MATCH_DTYPE, mode='r', offset=MATCH_LOG_HEADER.itemsize, shape=(num_records, MATCH_FIELDS))
+
+
+def write_match_log(filename, records):
+    header = np.array([(MATCH_LOG_MAGIC, MATCH_LOG_VERSION, MATCH_FIELDS)], dtype=MATCH_LOG_HEADER)
+    replace_file(filename, header.tobytes() + as_match_records(records).tobytes())
+
+
+def count_match_log(filename):
+    if filename.endswith('.gz'):
+        # A gzip member ends with the uncompressed size mod 2**32, far above any monthly shard
+        with open(filename, 'rb') as infile:
+            infile.seek(-4, os.SEEK_END)
+            size = struct.unpack('<I', infile.read(4))[0]
+    else:
+        size = os.path.getsize(filename)
+    return (size - MATCH_LOG_HEADER.itemsize) // (MATCH_FIELDS*MATCH_DTYPE.itemsize)
+
+
+def read_compressed_match_log(filename):
+    with gzip.open(filename, 'rb') as infile:
+        data = infile.read()
+    header = np.frombuffer(data, dtype=MATCH_LOG_HEADER, count=1)
+    if header[0]['magic'] != MATCH_LOG_MAGIC or header[0]['num_fields'] != MATCH_FIELDS:
+        raise IOError('{} is not a match log'.format(filename))
+    return np.frombuffer(data, dtype=MATCH_DTYPE, offset=MATCH_LOG_HEADER.itemsize).reshape(-1, MATCH_FIELDS)
+
+
+def compress_match_log(filename):
+    with open(filename, 'rb') as infile:
+        data = infile.read()
+    temp_filename = filename + '.gz.tmp'
+    with gzip.open(temp_filename, 'wb') as outfile:
+        outfile.write(data)
+    os.rename(temp_filename, filename + '.gz')
+    os.remove(filename)
+
+
+def match_months(records):
+    # Calendar month (UTC, 'YYYY-MM') of each match's timestamp
+    return records[:,5].astype('datetime64[s]').astype('datetime64[M]').astype(str)
+
+
+def month_of(timestamp):
+    return str(np.datetime64(int(timestamp), 's').astype('datetime64[M]'))
+
+
+def append_match_log(filename, records):
+    # Truncate any partial record first so the new records stay aligned
+    record_size = MATCH_FIELDS*MATCH_DTYPE.itemsize
+    with open(filename, 'r+b') as outfile:
+        num_records = (os.path.getsize(filename) - MATCH_LOG_HEADER.itemsize) // record_size
+        outfile.truncate(MATCH_LOG_HEADER.itemsize + num_records*record_size)
+        outfile.seek(0, os.SEEK_END)
+        outfile.write(as_match_records(records).tobytes())
+
+
+class ShardedMatchRecords(object):
+    # Read-only (N, 6) view over the shards of a match history, without copying them into one array.
+    # Uncompressed shards stay memory-mapped; gzipped ones are decompressed the first time their rows are
+    # read. Indexing and slicing only touch the shards involved, np.asarray() concatenates (copies) them all.
+
+    def __init__(self, filenames):
+        self.filenames = list(filenames)
+        self.parts = [None]*len(self.filenames)
+        self.offsets = np.cumsum([0] + [count_match_log(filename) for filename in self.filenames])
+        self.shape = (int(self.offsets[-1]), MATCH_FIELDS)
+        self.dtype = MATCH_DTYPE
+
+    def __len__(self):
+        return self.shape[0]
+
+    def part(self, i):
+        if self.parts[i] is None:
+            filename = self.filenames[i]
+            self.parts[i] = read_compressed_match_log(filename) if filename.endswith('.gz') else read_match_log(filename)
+        return self.parts[i]
+
+    def rows(self, start, stop):
+        # Rows [start, stop) from the shards that hold them
+        first = max(np.searchsorted(self.offsets, start, side='right') - 1, 0)
+        last = np.searchsorted(self.offsets, stop, side='left')
+        pieces = [self.part(i)[max(start-self.offsets[i], 0):stop-self.offsets[i]] for i in range(first, min(last, len(self.parts)))]
+        if len(pieces) == 1:
+            return pieces[0]
+        if not pieces:
+            return np.zeros((0, MATCH_FIELDS), dtype=MATCH_DTYPE)
+        return np.concatenate(pieces)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice) and key.step in (None, 1):
+            start, stop, step = key.indices(len(self))
+            return self.rows(start, max(stop, start))
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += len(self)
+            if not 0 <= key < len(self):
+                raise IndexError(key)
+            return self.rows(key, key+1)[0]
+        return np.asarray(self)[key]
+
+    def __iter__(self):
+        for i in range(len(self.parts)):
+            for match in self.part(i):
+                yield match
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.rows(0, len(self))
+        if dtype is not None:
+            array = array.astype(dtype)
+        return array
+
+
+class FileBackend(object):
+    # Append-only JSON-lines player table and bet history, memory-mapped stats file, and the match history
+    # as append-only binary match logs, one shard per calendar month of match timestamps. Shards of past
+    # months never change, so with compress_old_shards they are gzipped once a newer month has started.
+
+    name = 'file'
+
+    def __init__(self, directory='.', compress_old_shards=False):
+        self.players_filename = os.path.join(directory, 'players.p')    # Legacy pickled dictionaries
+        self.player_table_filename = os.path.join(directory, 'players.txt')
+        self.matches_filename = os.path.join(directory, 'matches.p')    # Legacy full-pickle match history
+        self.match_log_filename = os.path.join(directory, 'matches.bin')    # Unsharded match log
+        self.match_shard_directory = os.path.join(directory, 'matches')
+        self.compress_old_shards = compress_old_shards
+        self.ranks_filename = os.path.join(directory, 'ranks.p')      # Legacy pickled stat dicts
+        self.stats_filename = os.path.join(directory, 'stats.bin')
+        self.bets_filename = os.path.join(directory, 'bets.p')    # Legacy pickled bet list
+        self.bet_log_filename = os.path.join(directory, 'bets.txt')
+        self.bet_count_filename = os.path.join(directory, 'bets.count')    # Bet count at a known size of bets.txt
+
+    def describe(self, kind):
+        return {'players': self.player_table_filename, 'matches': self.match_shard_directory,
+                'stats': self.stats_filename, 'bets': self.bet_log_filename}[kind]
+
+    def load_players(self):
+        # players.txt is an append-only string table: line N holds the JSON-encoded name of player ID N
+        if not os.path.isfile(self.player_table_filename) and os.path.isfile(self.players_filename):
+            # One-time migration from the pickled dictionaries
+            player_id_dict, player_name_dict = pickle.load(open(self.players_filename, 'rb'))
+            names = names_from_dict(player_name_dict)
+            self.write_players(names)
+            print('{:d} characters migrated from {} to {}'.format(len(player_id_dict), self.players_filename, self.player_table_filename))
+        if not os.path.isfile(self.player_table_filename):
+            return None
+        return read_json_lines(self.player_table_filename)
+
+    def append_players(self, names, start_id):
+        with open(self.player_table_filename, 'ab') as outfile:
+            outfile.write(encode_json_lines(names))
+
+    def write_players(self, names):
+        replace_file(self.player_table_filename, encode_json_lines(names))
+
+    def recover_match_shards(self):
+        # write_matches builds the new shards in matches.tmp and swaps them in through matches.old. If the swap
+        # was interrupted, matches.tmp is already complete; otherwise the old shards are still the current ones.
+        temp_directory, old_directory = self.match_shard_directory + '.tmp', self.match_shard_directory + '.old'
+        if not os.path.isdir(old_directory):
+            return
+        if not os.path.isdir(self.match_shard_directory):
+            os.rename(temp_directory if os.path.isdir(temp_directory) else old_directory, self.match_shard_directory)
+        if os.path.isdir(old_directory):
+            shutil.rmtree(old_directory)
+
+    def build_match_shards(self, records):
+        # Shards are built next to the final directory, so an interrupted build simply starts over
+        temp_directory = self.match_shard_directory + '.tmp'
+        if os.path.isdir(temp_directory):
+            shutil.rmtree(temp_directory)
+        os.makedirs(temp_directory)
+        records = as_match_records(records)
+        months = match_months(records)
+        for month in np.unique(months):
+            write_match_log(os.path.join(temp_directory, month + '.bin'), records[months==month])
+        return temp_directory
+
+    def migrate_matches(self):
+        self.recover_match_shards()
+        if os.path.isdir(self.match_shard_directory):
+            return
+        if os.path.isfile(self.match_log_filename):
+            old_matches, old_filename = read_match_log(self.match_log_filename), self.match_log_filename
+        elif os.path.isfile(self.matches_filename):
+            # One-time migration from the full-pickle history
+            old_matches, old_filename = pickle.load(open(self.matches_filename, 'rb')), self.matches_filename
+        else:
+            return
+        os.rename(self.build_match_shards(old_matches), self.match_shard_directory)
+        print('{:d} match results migrated from {} to {}'.format(len(old_matches), old_filename, self.match_shard_directory))
+
+    def match_shards(self):
+        # [(month, filename)] in month order
+        self.migrate_matches()
+        if not os.path.isdir(self.match_shard_directory):
+            return []
+        shards = {}
+        for filename in sorted(os.listdir(self.match_shard_directory)):
+            month, extension = filename.split('.', 1)
+            # An uncompressed shard wins over a compressed copy left by an interrupted compression
+            if extension == 'bin' or (extension == 'bin.gz' and month not in shards):
+                shards[month] = os.path.join(self.match_shard_directory, filename)
+        return sorted(shards.items())
+
+    def read_shards(self, shards):
+        records = [read_compressed_match_log(filename) if filename.endswith('.gz') else read_match_log(filename) for month, filename in shards]
+        if len(records) == 1:
+            return records[0]
+        if not records:
+            return np.zeros((0, MATCH_FIELDS), dtype=MATCH_DTYPE)
+        return np.concatenate(records)
+
+    def load_matches(self):
+        # A lazy view over the shards; nothing is read until rows are accessed
+        shards = self.match_shards()
+        if not shards:
+            return None
+        return ShardedMatchRecords(filename for month, filename in shards)
+
+    def count_matches(self):
+        return sum(count_match_log(filename) for month, filename in self.match_shards())
+
+    def append_matches(self, records):
+        records = as_match_records(records)
+        shards = dict(self.match_shards())
+        if not os.path.isdir(self.match_shard_directory):
+            os.makedirs(self.match_shard_directory)
+        months = match_months(records)
+        for month in np.unique(months):
+            filename = os.path.join(self.match_shard_directory, month + '.bin')
+            if shards.get(month, filename).endswith('.gz'):
+                # A late match for a compressed month: reopen the shard for appending
+                write_match_log(filename, read_compressed_match_log(shards[month]))
+                os.remove(shards[month])
+            if os.path.isfile(filename):
+                append_match_log(filename, records[months==month])
+            else:
+                write_match_log(filename, records[months==month])
+        if self.compress_old_shards:
+            self.compress_shards()
+
+    def write_matches(self, records):
+        # The complete new set of shards replaces the old one; the old shards are removed only after the swap
+        self.migrate_matches()
+        temp_directory = self.build_match_shards(records)
+        old_directory = self.match_shard_directory + '.old'
+        if os.path.isdir(self.match_shard_directory):
+            os.rename(self.match_shard_directory, old_directory)
+        os.rename(temp_directory, self.match_shard_directory)
+        if os.path.isdir(old_directory):
+            shutil.rmtree(old_directory)
+        if self.compress_old_shards:
+            self.compress_shards()
+
+    def compress_shards(self, keep_recent=1):
+        # Gzip all but the most recent keep_recent shards
+        shards = self.match_shards()
+        for month, filename in shards[:max(len(shards)-keep_recent, 0)]:
+            if not filename.endswith('.gz'):
+                compress_match_log(filename)
+
+    def query_matches(self, pid=None, since=None, until=None):
+        # Only the shards for months overlapping [since, until) are read
+        first_month = month_of(since) if since is not None else None
+        last_month = month_of(until-1) if until is not None else None
+        shards = [(month, filename) for month, filename in self.match_shards()
+                  if (first_month is None or month >= first_month) and (last_month is None or month <= last_month)]
+        # Filtered shard by shard, so only the selected rows are ever copied
+        selected = [select_matches(self.read_shards([shard]), pid=pid, since=since, until=until) for shard in shards]
+        if not selected:
+            return np.zeros((0, MATCH_FIELDS), dtype=MATCH_DTYPE)
+        return np.concatenate(selected)
+
+    def recent_matches(self, num_matches):
+        # The last num_matches saved matches, reading shards from the newest back until there are enough
+        shards = self.match_shards()
+        needed, count = [], 0
+        while shards and count < num_matches:
+            needed.insert(0, shards.pop())
+            count += count_match_log(needed[0][1])
+        records = self.read_shards(needed)
+        return np.asarray(records[max(len(records)-num_matches, 0):])
+
+    def migrate_player_stats(self):
+        if not os.path.isfile(self.stats_filename) and os.path.isfile(self.ranks_filename):
+            # One-time migration from the pickled stat dicts
+            player_stats = player_stats_from_dicts(pickle.load(open(self.ranks_filename, 'rb')))
+            write_stats_file(self.stats_filename, player_stats, 1)
+            print('{:d} players\' stats migrated from {} to {}'.format(np.count_nonzero(player_stats['known']), self.ranks_filename, self.stats_filename))
+
+    def player_stats_version(self):
+        # Only reads the header, so polling for a new model is cheap
+        self.migrate_player_stats()
+        if not os.path.isfile(self.stats_filename):
+            return None
+        return int(read_stats_header(self.stats_filename)['model_version'])
+
+    def load_player_stats(self):
+        # Returns (stats array, model version), or None
+        self.migrate_player_stats()
+        if not os.path.isfile(self.stats_filename):
+            return None
+        return read_stats_file(self.stats_filename)
+
+    def save_player_stats(self, player_stats):
+        # Returns the new model version
+        model_version = (self.player_stats_version() or 0) + 1
+        write_stats_file(self.stats_filename, player_stats, model_version)
+        return model_version
+
+    def migrate_bets(self):
+        if not os.path.isfile(self.bet_log_filename) and os.path.isfile(self.bets_filename):
+            # One-time migration from the pickled bet list
+            old_bets = pickle.load(open(self.bets_filename, 'rb'))
+            self.write_bets(old_bets)
+            print('{:d} past bets migrated from {} to {}'.format(len(old_bets), self.bets_filename, self.bet_log_filename))
+
+    def load_bets(self):
+        # bets.txt holds one JSON-encoded bet per line
+        self.migrate_bets()
+        if not os.path.isfile(self.bet_log_filename):
+            return None
+        return read_json_lines(self.bet_log_filename)
+
+    def count_bets(self):
+        # Read from bets.count, so startup does not scan the bet history. Only lines appended after the count
+        # was last recorded (e.g. by a crash in between) are counted, and a count that does not fit is redone.
+        self.migrate_bets()
+        if not os.path.isfile(self.bet_log_filename):
+            return 0
+        size = os.path.getsize(self.bet_log_filename)
+        try:
+            with open(self.bet_count_filename, 'r') as infile:
+                recorded = json.load(infile)
+            count, counted_size = recorded['count'], recorded['size']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            count, counted_size = None, None
+        if count is None or counted_size > size:
+            count, counted_size = 0, 0
+        if counted_size < size:
+            count += count_json_lines(self.bet_log_filename, counted_size)
+            self.record_bet_count(count, size)
+        return count
+
+    def record_bet_count(self, count, size):
+        replace_file(self.bet_count_filename, json.dumps({'count': count, 'size': size}).encode('utf-8'))
+
+    def append_bets(self, bets):
+        count = self.count_bets()
+        data = encode_json_lines([to_python(item) for item in bet] for bet in bets)
+        with open(self.bet_log_filename, 'ab') as outfile:
+            outfile.write(data)
+        self.record_bet_count(count + len(bets), os.path.getsize(self.bet_log_filename))
+
+    def write_bets(self, bets):
+        replace_file(self.bet_log_filename, encode_json_lines([to_python(item) for item in bet] for bet in bets))
+        self.record_bet_count(len(bets), os.path.getsize(self.bet_log_filename))
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend(object):
+    # Everything in one SQLite database, with matches indexed by player and by timestamp. New matches,
+    # bets and players are inserted in batched transactions.
+
+    name = 'sqlite'
+
+    def __init__(self, filename='saltwatch.db'):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.lock = threading.RLock()
+        with self.transaction():
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS players (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+                CREATE TABLE IF NOT EXISTS matches (id INTEGER PRIMARY KEY, p1_id INTEGER, p2_id INTEGER, winner INTEGER,
+                                                    p1total INTEGER, p2total INTEGER, timestamp INTEGER);
+                CREATE INDEX IF NOT EXISTS matches_p1_id ON matches (p1_id, timestamp);
+                CREATE INDEX IF NOT EXISTS matches_p2_id ON matches (p2_id, timestamp);
+                CREATE INDEX IF NOT EXISTS matches_timestamp ON matches (timestamp);
+                CREATE TABLE IF NOT EXISTS player_stats (id INTEGER PRIMARY KEY, rank REAL, wins INTEGER, losses INTEGER,
+                                                         times_seen INTEGER, acc REAL, tpr REAL, tnr REAL);
+                CREATE TABLE IF NOT EXISTS bets (id INTEGER PRIMARY KEY, mode TEXT, player INTEGER, odds REAL, wager INTEGER,
+                                                 balance INTEGER, timestamp INTEGER);
+                CREATE INDEX IF NOT EXISTS bets_timestamp ON bets (timestamp);
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+            ''')
+
+    def describe(self, kind):
+        return '{} ({} table)'.format(self.filename, kind)
+
+    # The connection is shared by the main thread and saltstorage's persistence thread, so every use of it
+    # holds the lock: reads through fetchall/fetchone, writes inside transaction()
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            with self.connection:
+                yield
+
+    def fetchall(self, query, values=()):
+        with self.lock:
+            return self.connection.execute(query, values).fetchall()
+
+    def fetchone(self, query, values=()):
+        with self.lock:
+            return self.connection.execute(query, values).fetchone()
+
+    def load_players(self):
+        rows = self.fetchall('SELECT id, name FROM players')
+        if not rows:
+            return None
+        return names_from_dict(dict(rows))
+
+    def append_players(self, names, start_id):
+        with self.transaction():
+            self.connection.executemany('INSERT INTO players (id, name) VALUES (?, ?)',
+                                        [(pid, name) for pid, name in enumerate(names, start_id) if name is not None])
+
+    def write_players(self, names):
+        with self.transaction():
+            self.connection.execute('DELETE FROM players')
+            self.connection.executemany('INSERT INTO players (id, name) VALUES (?, ?)',
+                                        [(pid, name) for pid, name in enumerate(names) if name is not None])
+
+    def load_matches(self):
+        rows = self.fetchall('SELECT p1_id, p2_id, winner, p1total, p2total, timestamp FROM matches ORDER BY id')
+        if not rows:
+            return None
+        return as_match_records(rows)
+
+    def count_matches(self):
+        return self.fetchone('SELECT COUNT(*) FROM matches')[0]
+
+    def append_matches(self, records):
+        with self.transaction():
+            self.connection.executemany('INSERT INTO matches (p1_id, p2_id, winner, p1total, p2total, timestamp) VALUES (?, ?, ?, ?, ?, ?)',
+                                        as_match_records(records).tolist())
+
+    def write_matches(self, records):
+        with self.transaction():
+            self.connection.execute('DELETE FROM matches')
+            self.connection.executemany('INSERT INTO matches (p1_id, p2_id, winner, p1total, p2total, timestamp) VALUES (?, ?, ?, ?, ?, ?)',
+                                        as_match_records(records).tolist())
+
+    def query_matches(self, pid=None, since=None, until=None):
+        conditions, values = [], []
+        if pid is not None:
+            conditions.append('(p1_id = ? OR p2_id = ?)')
+            values += [int(pid), int(pid)]
+        if since is not None:
+            conditions.append('timestamp >= ?')
+            values.append(int(since))
+        if until is not None:
+            conditions.append('timestamp < ?')
+            values.append(int(until))
+        query = 'SELECT p1_id, p2_id, winner, p1total, p2total, timestamp FROM matches'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        return as_match_records(self.fetchall(query + ' ORDER BY id', values))
+
+    def recent_matches(self, num_matches):
+        rows = self.fetchall('SELECT p1_id, p2_id, winner, p1total, p2total, timestamp FROM matches ORDER BY id DESC LIMIT ?',
+                             (int(num_matches),))
+        return as_match_records(rows[::-1])
+
+    def player_stats_version(self):
+        row = self.fetchone("SELECT value FROM meta WHERE key = 'player_stats_version'")
+        return row[0] if row else None
+
+    def load_player_stats(self):
+        # Returns (stats array, model version), or None
+        with self.transaction():
+            rows = self.fetchall('SELECT id, {} FROM player_stats'.format(', '.join(STAT_NAMES)))
+            version = self.player_stats_version()
+        if not rows:
+            return None
+        rows = np.array(rows, dtype=float)
+        pids = rows[:,0].astype(int)
+        player_stats = empty_player_stats(pids.max()+1)
+        for i, name in enumerate(STAT_NAMES):
+            player_stats[name][pids] = rows[:,i+1]
+        player_stats['known'][pids] = True
+        return player_stats, version
+
+    def save_player_stats(self, player_stats):
+        # Returns the new model version
+        pids = np.flatnonzero(player_stats['known'])
+        rows = [[int(pid)] + [to_python(player_stats[name][pid]) for name in STAT_NAMES] for pid in pids]
+        with self.transaction():
+            self.connection.execute('DELETE FROM player_stats')
+            self.connection.executemany('INSERT INTO player_stats (id, {}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)'.format(', '.join(STAT_NAMES)), rows)
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('player_stats_version', "
+                                    "COALESCE((SELECT value FROM meta WHERE key = 'player_stats_version'), 0) + 1)")
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('player_stats_timestamp', ?)", (time(),))
+            return self.player_stats_version()
+
+    def load_bets(self):
+        rows = self.fetchall('SELECT mode, player, odds, wager, balance, timestamp FROM bets ORDER BY id')
+        if not rows:
+            return None
+        return [list(row) for row in rows]
+
+    def count_bets(self):
+        return self.fetchone('SELECT COUNT(*) FROM bets')[0]
+
+    def append_bets(self, bets):
+        with self.transaction():
+            self.connection.executemany('INSERT INTO bets (mode, player, odds, wager, balance, timestamp) VALUES (?, ?, ?, ?, ?, ?)',
+                                        ([to_python(item) for item in bet] for bet in bets))
+
+    def write_bets(self, bets):
+        with self.transaction():
+            self.connection.execute('DELETE FROM bets')
+            self.connection.executemany('INSERT INTO bets (mode, player, odds, wager, balance, timestamp) VALUES (?, ?, ?, ?, ?, ?)',
+                                        ([to_python(item) for item in bet] for bet in bets))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
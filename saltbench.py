@@ -0,0 +1,258 @@
+""" Benchmarks for the persistence path in saltstorage.
+Generates synthetic players, matches and bets, then times saving, loading, appending and range queries for the
+legacy pickle files and each saltstorage backend. Every (backend, size) case runs in its own subprocess so its
+peak RSS can be measured; on Linux the peak is reset after the data is generated, so it covers the backend's
+work only. Results are written as JSON.
+
+Usage: python saltbench.py [output.json] [size1,size2,...] [backend1,backend2,...]
+"""
+
+import sys
+import os
+import json
+import pickle
+import shutil
+import tempfile
+import subprocess
+import resource
+from time import time
+import numpy as np
+import saltstorage as ss
+import saltprocessing as sp
+
+SIZES = [10**4, 10**5, 10**6, 10**7]
+BACKENDS = ['pickle', 'file', 'sqlite']
+NUM_APPEND = 1000   # Matches (and bets) added for the append benchmark
+NUM_RECENT = 10000   # Matches read by the recent-matches benchmark
+QUERY_DAYS = 30   # Length of the range query, ending at the newest match
+MATCH_INTERVAL = 180   # Seconds between synthetic matches
+START_TIME = 1420070400   # 2015-01-01 UTC
+
+
+def generate_names(num_players):
+    return ['Player {:d}'.format(pid) for pid in range(num_players)]
+
+
+def generate_matches(num_matches, num_players, start_time=START_TIME, random_state=None):
+    # [p1_id, p2_id, winner, p1total, p2total, timestamp] rows, one match every MATCH_INTERVAL seconds
+    rng = np.random.RandomState(random_state)
+    matches = np.zeros((num_matches, 6), dtype=np.int64)
+    matches[:,0] = rng.randint(0, num_players, num_matches)
+    matches[:,1] = (matches[:,0] + rng.randint(1, num_players, num_matches)) % num_players
+    matches[:,2] = rng.randint(0, 2, num_matches)
+    matches[:,3] = rng.randint(0, 5000000, num_matches)
+    matches[:,4] = rng.randint(0, 5000000, num_matches)
+    matches[:,5] = start_time + MATCH_INTERVAL*np.arange(num_matches)
+    return matches
+
+
+def generate_bets(matches, random_state=None):
+    # [mode, player, odds, wager, balance, timestamp], one bet per match
+    rng = np.random.RandomState(random_state)
+    players = rng.randint(0, 2, len(matches))
+    odds = 1 + rng.exponential(1., len(matches))
+    wagers = rng.randint(1, 100000, len(matches))
+    balances = wagers + rng.randint(0, 1000000, len(matches))
+    return [[sp.MATCHMAKING, int(player), float(odd), int(wager), int(balance), int(timestamp)]
+            for player, odd, wager, balance, timestamp in zip(players, odds, wagers, balances, matches[:,5])]
+
+
+def num_players_for(num_matches):
+    return max(100, num_matches//100)
+
+
+def proc_status_mb(field):
+    # A kB field (VmRSS, VmHWM) of /proc/self/status, or None off Linux
+    try:
+        with open('/proc/self/status') as infile:
+            for line in infile:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])/1024.
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def reset_peak_rss():
+    # Linux resets the peak RSS (VmHWM) to the current RSS when 5 is written to clear_refs
+    try:
+        with open('/proc/self/clear_refs', 'w') as outfile:
+            outfile.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def peak_rss_mb():
+    peak = proc_status_mb('VmHWM')
+    if peak is not None:
+        return peak
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS, and cannot be reset
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/1024./1024. if sys.platform == 'darwin' else peak/1024.
+
+
+def timed(results, name, count, function):
+    start = time()
+    value = function()
+    elapsed = time() - start
+    results[name] = {'seconds': elapsed, 'count': count, 'per_second': count/elapsed if elapsed > 0 else None}
+    print('  {:8} {:10.3f}s  {:12.0f}/s'.format(name, elapsed, results[name]['per_second'] or 0))
+    return value
+
+
+def bench_pickle(directory, names, matches, bets, new_matches, new_bets):
+    # The original storage: pickled dicts and lists, rewritten in full on every save
+    results = {}
+    players_filename = os.path.join(directory, 'players.p')
+    matches_filename = os.path.join(directory, 'matches.p')
+    bets_filename = os.path.join(directory, 'bets.p')
+    match_list = matches.tolist()
+    pid_dict = {name:pid for pid, name in enumerate(names)}
+    pname_dict = {pid:name for pid, name in enumerate(names)}
+
+    def save():
+        pickle.dump([pid_dict, pname_dict], open(players_filename, 'wb'))
+        pickle.dump(match_list, open(matches_filename, 'wb'))
+        pickle.dump(bets, open(bets_filename, 'wb'))
+    timed(results, 'save', len(matches), save)
+    del match_list
+
+    def load():
+        loaded = pickle.load(open(players_filename, 'rb')), pickle.load(open(matches_filename, 'rb')), pickle.load(open(bets_filename, 'rb'))
+        return loaded[1], loaded[2]
+    loaded_matches, loaded_bets = timed(results, 'load', len(matches), load)
+
+    def append():
+        loaded_matches.extend(new_matches.tolist())
+        loaded_bets.extend(new_bets)
+        pickle.dump(loaded_matches, open(matches_filename, 'wb'))
+        pickle.dump(loaded_bets, open(bets_filename, 'wb'))
+    timed(results, 'append', len(new_matches), append)
+
+    since = int(matches[-1,5]) - QUERY_DAYS*24*60*60
+    def query():
+        return [match for match in pickle.load(open(matches_filename, 'rb')) if match[5] >= since]
+    queried = timed(results, 'query', 1, query)
+    results['query']['returned'] = len(queried)
+    pid = int(matches[-1,0])
+    def player():
+        return [match for match in pickle.load(open(matches_filename, 'rb')) if match[0] == pid or match[1] == pid]
+    queried = timed(results, 'player', 1, player)
+    results['player']['returned'] = len(queried)
+    del queried
+
+    def recent():
+        return pickle.load(open(matches_filename, 'rb'))[-NUM_RECENT:]
+    timed(results, 'recent', 1, recent)
+    return results
+
+
+def reset_storage(backend_name, directory):
+    ss.STORAGE_BACKEND = backend_name
+    ss.DATA_DIRECTORY = directory
+    ss.SQLITE_FILENAME = os.path.join(directory, 'saltwatch.db')
+    ss.use_backend(backend_name)
+    ss.matches, ss.bets = [], []
+    ss.set_player_registry(ss.PlayerRegistry())
+
+
+def bench_backend(backend_name, directory, names, matches, bets, new_matches, new_bets):
+    results = {}
+    reset_storage(backend_name, directory)
+
+    def save():
+        ss.set_player_registry(ss.PlayerRegistry(names))
+        ss.matches = matches.tolist()
+        ss.bets = bets
+        ss.save_persistent_data()
+    timed(results, 'save', len(matches), save)
+
+    # Opening is lazy, so time opening and reading everything separately
+    reset_storage(backend_name, directory)
+    timed(results, 'open', len(matches), ss.load_persistent_data)
+    reset_storage(backend_name, directory)
+    def load():
+        ss.load_persistent_data()
+        return np.asarray(ss.matches), list(ss.bets)
+    timed(results, 'load', len(matches), load)
+
+    def append():
+        for match, bet in zip(new_matches.tolist(), new_bets):
+            ss.add_match(match)
+            ss.add_bet(bet)
+        ss.save_persistent_data()
+    timed(results, 'append', len(new_matches), append)
+
+    since = int(matches[-1,5]) - QUERY_DAYS*24*60*60
+    queried = timed(results, 'query', 1, lambda: ss.query_matches(since=since))
+    results['query']['returned'] = len(queried)
+    pid = int(matches[-1,0])
+    queried = timed(results, 'player', 1, lambda: ss.query_matches(pid=pid))
+    results['player']['returned'] = len(queried)
+    timed(results, 'recent', 1, lambda: ss.recent_matches(NUM_RECENT))
+    ss.get_backend().close()
+    return results
+
+
+def run_case(backend_name, num_matches):
+    # One benchmark case, run inside a worker process
+    num_players = num_players_for(num_matches)
+    names = generate_names(num_players)
+    matches = generate_matches(num_matches, num_players, random_state=num_matches)
+    bets = generate_bets(matches, random_state=num_matches)
+    new_matches = generate_matches(NUM_APPEND, num_players, start_time=int(matches[-1,5])+MATCH_INTERVAL, random_state=num_matches+1)
+    new_bets = generate_bets(new_matches, random_state=num_matches+1)
+    # Measure from here on, so generating the synthetic data does not count towards the backend's peak.
+    # The generated data stays resident, so it is reported separately as the baseline.
+    peak_reset = reset_peak_rss()
+    baseline_rss = proc_status_mb('VmRSS') if peak_reset else None
+    directory = tempfile.mkdtemp(prefix='saltbench-')
+    try:
+        print('{} backend, {:d} matches, {:d} players'.format(backend_name, num_matches, num_players))
+        if backend_name == 'pickle':
+            results = bench_pickle(directory, names, matches, bets, new_matches, new_bets)
+        else:
+            results = bench_backend(backend_name, directory, names, matches, bets, new_matches, new_bets)
+        disk_bytes = sum(os.path.getsize(os.path.join(root, filename)) for root, dirs, filenames in os.walk(directory) for filename in filenames)
+    finally:
+        shutil.rmtree(directory)
+    peak_rss = peak_rss_mb()
+    return {'backend': backend_name, 'num_matches': num_matches, 'num_players': num_players, 'num_bets': len(bets),
+            'operations': results, 'disk_bytes': disk_bytes, 'peak_rss_mb': peak_rss, 'baseline_rss_mb': baseline_rss,
+            'backend_rss_mb': peak_rss - baseline_rss if peak_reset else None, 'peak_includes_generation': not peak_reset}
+
+
+def run_benchmarks(sizes=SIZES, backends=BACKENDS, output_filename='saltbench_results.json'):
+    cases = []
+    for num_matches in sizes:
+        for backend_name in backends:
+            # A fresh interpreter per case, so peak RSS belongs to that case alone
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--case', backend_name, str(num_matches)])
+            case = json.loads(output.decode('utf-8').splitlines()[-1])
+            if case['backend_rss_mb'] is not None:
+                memory = 'peak RSS {:.1f} MB above {:.1f} MB of generated data'.format(case['backend_rss_mb'], case['baseline_rss_mb'])
+            else:
+                memory = 'peak RSS {:.1f} MB including data generation'.format(case['peak_rss_mb'])
+            print('{} backend, {:d} matches: {}, {:.1f} MB on disk'.format(backend_name, num_matches, memory, case['disk_bytes']/1024./1024.))
+            cases.append(case)
+    report = {'timestamp': int(time()), 'python': sys.version.split()[0], 'numpy': np.__version__,
+              'num_append': NUM_APPEND, 'num_recent': NUM_RECENT, 'query_days': QUERY_DAYS, 'cases': cases}
+    with open(output_filename, 'w') as outfile:
+        json.dump(report, outfile, indent=1)
+    print('Results written to {}'.format(output_filename))
+    return report
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == '--case':
+        # Worker: progress goes to stderr, the result is the last line on stdout
+        stdout = sys.stdout
+        sys.stdout = sys.stderr
+        case = run_case(sys.argv[2], int(sys.argv[3]))
+        stdout.write(json.dumps(case) + '\n')
+    else:
+        output_filename = sys.argv[1] if len(sys.argv) > 1 else 'saltbench_results.json'
+        sizes = [int(float(size)) for size in sys.argv[2].split(',')] if len(sys.argv) > 2 else SIZES
+        backends = sys.argv[3].split(',') if len(sys.argv) > 3 else BACKENDS
+        run_benchmarks(sizes, backends, output_filename)
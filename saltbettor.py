@@ -4,10 +4,16 @@ Relies on saltmind for outcome prediction and bet recommendations.
 
 import requests
 import random
+import math
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 import saltprocessing as sp
 import saltstorage as ss
 import saltmind as sm
-from time import time
+from time import time, sleep
 import numpy as np
 
 LOGIN_URL = 'http://www.saltybet.com/authenticate?signin=1'
@@ -33,6 +39,18 @@ HEADERS = {'Host': 'www.saltybet.com',
 
 s = requests.Session()
 
+# Balance cache: balances are prefetched in the background while bets are locked and after results, and
+# updated locally from our own wagers and payouts, so placing a bet in the OPEN window is a single POST.
+# A cached balance older than BALANCE_MAX_AGE seconds is never bet with; it is fetched synchronously instead.
+BALANCE_MAX_AGE = 120.
+BALANCE_SETTLE_DELAY = 5.   # Seconds after a result before the server's balance reflects the payout
+balances = {}   # mode -> (balance, time fetched)
+balance_stats = {'hits': 0, 'misses': 0, 'stale': 0, 'refreshes': 0, 'refresh_failures': 0, 'local_updates': 0}
+balance_lock = threading.RLock()
+balance_queue = None
+balance_thread = None
+open_bet = None   # (mode, player, wager, p1_id, p2_id, first new ID) of the bet awaiting its result
+
 
 def login(): 
     global s
@@ -49,6 +67,95 @@ def get_tournament_balance():
     return balance
 
 
+def fetch_balance(mode):
+    if mode == sp.TOURNAMENT:
+        return get_tournament_balance()
+    return get_balance()
+
+
+def refresh_balance(mode):
+    balance = fetch_balance(mode)
+    with balance_lock:
+        balances[mode] = (balance, time())
+        balance_stats['refreshes'] += 1
+    return balance
+
+
+def get_cached_balance(mode):
+    # The cached balance if it is fresh enough, otherwise a synchronous fetch
+    with balance_lock:
+        cached = balances.get(mode)
+        if cached is not None and time() - cached[1] <= BALANCE_MAX_AGE:
+            balance_stats['hits'] += 1
+            return cached[0]
+        balance_stats['stale' if cached is not None else 'misses'] += 1
+    return refresh_balance(mode)
+
+
+def adjust_cached_balance(mode, change):
+    # Apply a known change (a wager or a payout) without asking the server
+    with balance_lock:
+        cached = balances.get(mode)
+        if cached is not None:
+            balances[mode] = (cached[0] + change, time())
+            balance_stats['local_updates'] += 1
+
+
+def get_balance_cache_stats():
+    with balance_lock:
+        stats = dict(balance_stats)
+        stats['age'] = {mode: time() - fetched for mode, (balance, fetched) in balances.items()}
+    return stats
+
+
+def prefetch_balance(mode, delay=0):
+    # Refresh the cached balance on the background thread
+    global balance_queue, balance_thread
+    if mode != sp.MATCHMAKING and mode != sp.TOURNAMENT:
+        return
+    if balance_thread is None:
+        balance_queue = queue.Queue()
+        balance_thread = threading.Thread(target=run_balance_thread, name='saltbettor-balance')
+        balance_thread.daemon = True
+        balance_thread.start()
+    balance_queue.put((mode, time() + delay))
+
+
+def run_balance_thread():
+    while True:
+        mode, due = balance_queue.get()
+        if due > time():
+            sleep(due - time())
+        try:
+            refresh_balance(mode)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            with balance_lock:
+                balance_stats['refresh_failures'] += 1
+            print('Balance prefetch failed: {}'.format(e))
+
+
+def settle_open_bet(mode, match):
+    # Credit a winning bet's payout locally: the wager back plus its share of the losing side's pot,
+    # rounded up. The wager itself was deducted when the bet was placed.
+    global open_bet
+    if open_bet is None:
+        return False
+    bet_mode, player, wager, p1_id, p2_id, first_new_id = open_bet
+    open_bet = None
+    if bet_mode != mode or not same_player(p1_id, match[0], first_new_id) or not same_player(p2_id, match[1], first_new_id) or match[2] not in (0, 1):
+        return False
+    if match[2] == player:
+        winner_total, loser_total = match[3+player], match[4-player]
+        payout = wager + (int(math.ceil(wager*loser_total/float(winner_total))) if winner_total > 0 else 0)
+        adjust_cached_balance(mode, payout)
+    return True
+
+
+def same_player(bet_id, result_id, first_new_id):
+    # A new character is still -1 when the bet is placed and only gets an ID (first_new_id or later) at the result
+    return bet_id == result_id or (bet_id == -1 and result_id >= first_new_id)
+
+
 def place_bet(player, wager):
     # Example bet payload: {'selectedplayer': 'player2', 'wager': 100}
     r = s.post(BET_URL, data={'selectedplayer': 'player'+str(player+1), 'wager': wager})
@@ -61,8 +168,10 @@ def place_bet(player, wager):
 
 
 def place_saltmind_bet(mode, match):
+    global open_bet
     # Get prediction value, predicted winner, and current balance
-    pred = sm.predict_one_outcome(ss.ranks, match[0], match[1])
+    player_stats = ss.player_stats   # Hold one version of the stats for the whole decision
+    pred = float(sm.predict_outcomes_from_array(player_stats['rank'], player_stats['known'], match[0], match[1]))
     if pred == 0.5:
         player = random.randint(0,1)
     else:
@@ -71,9 +180,9 @@ def place_saltmind_bet(mode, match):
     conf = abs(pred-0.5)+0.5  
     odds = conf/(1-conf)
     # Decrease odds by past prediction accuracies
-    try:
-        reduced_odds = 1 + (odds-1) * ss.acc[match[player]] * ss.acc[match[1-player]]
-    except:
+    if pred != 0.5:
+        reduced_odds = 1 + (odds-1) * player_stats['acc'][match[player]] * player_stats['acc'][match[1-player]]
+    else:
         reduced_odds = 1
     logodds = np.log(reduced_odds)
     print('Final log odds: {:.2f} of possible {:.2f}'.format(logodds, np.log(odds)))
@@ -81,7 +190,7 @@ def place_saltmind_bet(mode, match):
     # Determine wager based on mode, prediction and balance
     wager = 0
     if mode == sp.MATCHMAKING:
-        balance = get_balance()
+        balance = get_cached_balance(mode)
         if balance <= 2000:
             wager = balance
         elif logodds > 4:
@@ -91,7 +200,7 @@ def place_saltmind_bet(mode, match):
         else:
             wager = 10000
     elif mode == sp.TOURNAMENT:
-        balance = get_tournament_balance()
+        balance = get_cached_balance(mode)
         if balance <= 2000:
             wager = balance
         else:
@@ -107,6 +216,8 @@ def place_saltmind_bet(mode, match):
     else:
         success = False
     if success:
+        adjust_cached_balance(mode, -wager)
+        open_bet = (mode, player, wager, match[0], match[1], len(ss.get_player_registry().names))
         ss.add_bet([mode, player, reduced_odds, wager, balance, int(time())])
         return True
     else:
@@ -114,15 +225,16 @@ def place_saltmind_bet(mode, match):
 
 
 def display_player_statistics(pid):
-    try:
-        print('{:4}:  Record: {:2}/{:2}/{:2} {:3d}%   Rank: {:7.2f}   Acc/TPR/TNR: {:3d}%/{:3d}%/{:3d}%'.format(pid, ss.wins[pid], ss.losses[pid], ss.times_seen[pid], (int(ss.wins[pid]/float(ss.times_seen[pid])*100) if ss.times_seen[pid]>0 else 0), ss.ranks[pid], int(ss.acc[pid]*100), int(ss.tpr[pid]*100), int(ss.tnr[pid]*100)))
-    except KeyError:
+    stats = ss.get_player_stats(pid)
+    if stats is not None:
+        print('{:4}:  Record: {:2}/{:2}/{:2} {:3d}%   Rank: {:7.2f}   Acc/TPR/TNR: {:3d}%/{:3d}%/{:3d}%'.format(pid, stats['wins'], stats['losses'], stats['times_seen'], (int(stats['wins']/float(stats['times_seen'])*100) if stats['times_seen']>0 else 0), stats['rank'], int(stats['acc']*100), int(stats['tpr']*100), int(stats['tnr']*100)))
+    else:
         print('    :  Record:  0/ 0/ 0    %   Rank:             Acc/TPR/TNR:    %/   %/   %')
 
 
 def display_outcome_prediction(pid1, pid2):
     try:
-        outcome = sm.predict_one_outcome(ss.ranks, pid1, pid2)
+        outcome = float(sm.predict_outcomes_from_array(ss.player_stats['rank'], ss.player_stats['known'], pid1, pid2))
         if outcome<0.5:
             print('{} wins with {:.2f}% probability'.format(ss.player_name_dict[pid1], (1-outcome)*100))
         elif outcome>0.5:
@@ -139,3 +251,10 @@ def act_on_processed_state(mode, status, match):
         display_player_statistics(match[1])
         display_outcome_prediction(match[0], match[1])
         place_saltmind_bet(mode, match)
+    elif status == sp.LOCKED:
+        # Nothing changes the balance until the result, so this is the time to refresh it
+        prefetch_balance(mode)
+    elif status == sp.RESULTS:
+        # Known outcome first, then the server's figure once the payout has gone through
+        settle_open_bet(mode, match)
+        prefetch_balance(mode, BALANCE_SETTLE_DELAY)
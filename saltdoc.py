@@ -4,6 +4,7 @@ Primarily to remove old/invalid/unwanted characters and clean up the indexing.
 """
 
 import numpy as np
+import saltstorage as ss
 
 
 def check_dictionary_reversibility(dict1, dict2):
@@ -35,12 +36,17 @@ def check_dictionary_value_uniqueness(pdict):
 
 
 def build_new_dicts(names):
-    pid_dict = {name:i for i,name in enumerate(names)}
-    pname_dict = {i:name for i,name in enumerate(names)}
+    # Dictionaries backed by a fresh PlayerRegistry, so they are bijections by construction
+    registry = ss.PlayerRegistry(names)
 
     print('New dictionaries built for {:d} names'.format(len(names)))
 
-    return pid_dict, pname_dict
+    return registry.ids, registry.name_dict
+
+
+def is_registry_backed(pid_dict, pname_dict):
+    registry = getattr(pname_dict, 'registry', None)
+    return registry is not None and registry.ids is pid_dict
 
 
 def translate_matches_to_new_dict(matches, old_pname_dict, new_pid_dict, verbose=True):
@@ -123,19 +129,22 @@ def check_dictionary_conciseness(matches, pname_dict, return_concise_names=False
 def do_checkup(matches, pid_dict, pname_dict):
     healthy = True
 
-    # Check that dictionaries are 1-1 mappings (bijections)
-    if not check_dictionary_value_uniqueness(pid_dict):
-        print('WARNING: Player ID dictionary has duplicate values')
-        healthy = False
-    if not check_dictionary_value_uniqueness(pname_dict):
-        print('WARNING: Player name dictionary has duplicate values')
-        healthy = False        
-    if not check_dictionary_reversibility(pid_dict, pname_dict):
-        print('WARNING: Player ID dictionary is not reversible by player name dictionary')
-        healthy = False
-    if not check_dictionary_reversibility(pname_dict, pid_dict):
-        print('WARNING: Player name dictionary is not reversible by player name dictionary')
-        healthy = False
+    # Check that dictionaries are 1-1 mappings (bijections). A PlayerRegistry guarantees this already.
+    if is_registry_backed(pid_dict, pname_dict):
+        print('Dictionaries are backed by a player registry, bijection holds by construction')
+    else:
+        if not check_dictionary_value_uniqueness(pid_dict):
+            print('WARNING: Player ID dictionary has duplicate values')
+            healthy = False
+        if not check_dictionary_value_uniqueness(pname_dict):
+            print('WARNING: Player name dictionary has duplicate values')
+            healthy = False        
+        if not check_dictionary_reversibility(pid_dict, pname_dict):
+            print('WARNING: Player ID dictionary is not reversible by player name dictionary')
+            healthy = False
+        if not check_dictionary_reversibility(pname_dict, pid_dict):
+            print('WARNING: Player name dictionary is not reversible by player name dictionary')
+            healthy = False
     
     # Check that matches are fully translatable 
     if not check_matches_translatability(matches, pname_dict):
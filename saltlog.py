@@ -0,0 +1,111 @@
+""" Structured state log.
+Every processed state is written as one JSON Lines record (receive time, mode, status, categories, state) to a
+single rotating log. Records are handed to a background thread through a queue, so logging never touches the
+disk on the caller's thread. Rotated segments are gzipped.
+"""
+
+import json
+import gzip
+import os
+import shutil
+import atexit
+import logging
+import logging.handlers
+from time import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+STATE_LOG_FILENAME = 'state_log.jsonl'
+STATE_LOG_MAX_BYTES = 64*1024*1024   # Rotate once the log reaches this size...
+STATE_LOG_ROTATE_WHEN = None   # ...or, if set (e.g. 'midnight'), on this TimedRotatingFileHandler schedule
+STATE_LOG_BACKUP_COUNT = 50   # Rotated segments kept
+ENABLED = True
+
+# Record categories, replacing the old separate log files
+UNIDENTIFIED = 'unidentified'   # Mode or status could not be determined (was help_me_id_this.txt)
+RESULTS = 'results'   # A match result (was win_state_log.txt). Every state is logged (was full_state_log.txt).
+
+logger = None
+listener = None
+
+
+class StateQueueHandler(logging.handlers.QueueHandler):
+    # Queue the record as is; the JSON encoding happens on the listener thread
+
+    def prepare(self, record):
+        return record
+
+
+class JSONLinesFormatter(logging.Formatter):
+
+    def format(self, record):
+        return json.dumps(record.msg, sort_keys=True)
+
+
+def gzip_namer(name):
+    return name + '.gz'
+
+
+def gzip_rotator(source, dest):
+    with open(source, 'rb') as infile, gzip.open(dest, 'wb') as outfile:
+        shutil.copyfileobj(infile, outfile)
+    os.remove(source)
+
+
+def start_state_log(filename=None):
+    global logger, listener
+    if listener is not None:
+        return
+    if filename is None:
+        filename = STATE_LOG_FILENAME
+    if STATE_LOG_ROTATE_WHEN is not None:
+        handler = logging.handlers.TimedRotatingFileHandler(filename, when=STATE_LOG_ROTATE_WHEN, backupCount=STATE_LOG_BACKUP_COUNT, encoding='utf-8')
+    else:
+        handler = logging.handlers.RotatingFileHandler(filename, maxBytes=STATE_LOG_MAX_BYTES, backupCount=STATE_LOG_BACKUP_COUNT, encoding='utf-8')
+    handler.namer = gzip_namer
+    handler.rotator = gzip_rotator
+    handler.setFormatter(JSONLinesFormatter())
+
+    record_queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(record_queue, handler)
+    listener.start()
+    logger = logging.getLogger('saltwatch.state')
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.addHandler(StateQueueHandler(record_queue))
+    atexit.register(stop_state_log)
+
+
+def stop_state_log():
+    # Flush everything queued and close the log
+    global logger, listener
+    if listener is None:
+        return
+    listener.stop()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    for handler in listener.handlers:
+        handler.close()
+    logger, listener = None, None
+
+
+def log_state(mode, status, state, categories=(), received=None):
+    if not ENABLED:
+        return
+    if listener is None:
+        start_state_log()
+    logger.info({'received': time() if received is None else received, 'mode': mode, 'status': status,
+                 'categories': list(categories), 'state': state})
+
+
+def read_state_log(filename):
+    # Records from one log segment, plain or gzipped. A torn last line is skipped.
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rb') as infile:
+        for line in infile:
+            try:
+                yield json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue
@@ -2,19 +2,74 @@
 """
 
 import sys
+import os
+import json
+import hashlib
 import numpy as np
+from scipy import sparse
 import saltstorage as ss
 import saltdoc as sd
 from sklearn.cross_validation import train_test_split
 import pickle
+import shutil
+import tempfile
+import multiprocessing
+from multiprocessing import shared_memory
+from time import time
+
+# Training and evaluation only read matches from the last TRAINING_WINDOW_DAYS days and/or the last
+# TRAINING_WINDOW_MATCHES matches (None for no limit). calc_weights makes old matches count for little anyway.
+TRAINING_WINDOW_DAYS = None
+TRAINING_WINDOW_MATCHES = None
+
+# prepare_inputs results can be cached on disk, keyed by a fingerprint of the matches and min_weight. A history
+# that only grew since an entry was stored extends that entry. Least recently used entries are evicted
+# once the cache grows past PREPARED_CACHE_MAX_BYTES. Off unless USE_PREPARED_CACHE is set or prepare_inputs
+# (or hyperparameter_search, whose repeated searches benefit most) is called with use_cache=True. The cache lives in
+# PREPARED_CACHE_DIRECTORY inside saltstorage.DATA_DIRECTORY.
+USE_PREPARED_CACHE = False
+PREPARED_CACHE_DIRECTORY = 'prepared_cache'
+PREPARED_CACHE_MAX_BYTES = 1 << 30
+
+
+def build_rank_array(ranks, size=None):
+    # Dense rank vector indexed by player ID, plus a mask of which IDs actually have a rank
+    if size is None:
+        size = max(ranks.keys())+1 if ranks else 0
+    rank_values = np.zeros(size)
+    known = np.zeros(size, dtype=bool)
+    if ranks:
+        pids = np.fromiter(ranks.keys(), dtype=int, count=len(ranks))
+        vals = np.fromiter(ranks.values(), dtype=float, count=len(ranks))
+        in_range = (pids >= 0) & (pids < size)
+        rank_values[pids[in_range]] = vals[in_range]
+        known[pids[in_range]] = True
+    return rank_values, known
 
 
 def predict_outcomes(ranks, pid1, pid2):
     # <0.5 means p1 wins, >0.5 means p2 wins
-    if len(pid1)==1:
-        return predict_one_outcome(ranks, pid1, pid2)
+    # ranks can be a {pid: rank} dict or a (rank_values, known) pair from build_rank_array
+    if isinstance(ranks, dict):
+        rank_values, known = build_rank_array(ranks)
     else:
-        return np.array([predict_one_outcome(ranks, id1, id2) for id1,id2 in zip(pid1,pid2)])
+        rank_values, known = ranks
+    return predict_outcomes_from_array(rank_values, known, pid1, pid2)
+
+
+def predict_outcomes_from_array(rank_values, known, pid1, pid2):
+    pid1 = np.asarray(pid1, dtype=int)
+    pid2 = np.asarray(pid2, dtype=int)
+    # Unknown or out-of-range IDs (including the -1 placeholder for new players) predict 0.5
+    valid1 = (pid1 >= 0) & (pid1 < len(rank_values))
+    valid2 = (pid2 >= 0) & (pid2 < len(rank_values))
+    idx1 = np.where(valid1, pid1, 0)
+    idx2 = np.where(valid2, pid2, 0)
+    if len(rank_values) == 0:
+        return np.full(pid1.shape, 0.5)
+    valid = valid1 & valid2 & known[idx1] & known[idx2]
+    pred = 1./(1+np.power(10, (rank_values[idx1]-rank_values[idx2])/400.))
+    return np.where(valid, pred, 0.5)
 
 
 def predict_one_outcome(ranks, pid1, pid2):
@@ -24,57 +79,123 @@ def predict_one_outcome(ranks, pid1, pid2):
         return 0.5
 
 
+def load_training_matches(window_days=None, window_matches=None):
+    # Read only the part of the match history inside the training window
+    if window_days is None and window_matches is None:
+        return np.asarray(ss.matches)
+    if window_days is not None:
+        matches = ss.query_matches(since=int(time()-window_days*24*60*60))
+        if window_matches is not None:
+            matches = matches[-window_matches:]
+    else:
+        matches = ss.recent_matches(window_matches)
+    print('{:d} matches in the training window'.format(len(matches)))
+    return matches
+
+
 def calc_weights(t, tmin, tmax, min_weight=0.):
     return (1-min_weight)*np.power((1+t-tmin)/(1+tmax-tmin), 2.) + min_weight
   
 
-def calc_neighborhoods(matches, weights, pid_list):
-
-    #neighborhood_ids_2 = [[match[0] for match in matches if match[1]==pid] + [match[1] for match in matches if match[0]==pid] for pid in pid_list]
-    # ^ Would need the weights too, in the same order. Probably just one big list comprehension grabbing both. No clear time savings either. Oh well, leave for now.
-    neighborhood_ids = []
-    neighborhood_weights = []
-    for pid in pid_list:
-        this_ids = []
-        this_weights = []
-        for match, weight in zip(matches, weights):
-            if match[0]==pid:
-                this_ids.append(match[1])
-                this_weights.append(weight)
-            elif match[1]==pid:
-                this_ids.append(match[0])
-                this_weights.append(weight)
-        if len(this_ids)==0 or len(this_weights)==0:
-            print('No neighborhood!', pid)
-        neighborhood_ids.append(this_ids)
-        neighborhood_weights.append(this_weights)
-    return neighborhood_ids, neighborhood_weights
-        
-
-def calc_neighborhood_averages(neighborhood_ranks, neighborhood_weights, neighborhood_total_weights):
-    neighborhood_averages = [np.dot(ranks, weights)/total_weight for (ranks,weights,total_weight) in zip(neighborhood_ranks, neighborhood_weights, neighborhood_total_weights)]
-    return neighborhood_averages
-
-
-def calc_neighborhood_ranks(neighborhood_ids, ranks):
-    neighborhood_ranks = []
-    for neighborhood in neighborhood_ids:
-        neighborhood_ranks.append([ranks[pid] for pid in neighborhood])
-    return neighborhood_ranks
-
-
-def calc_neighborhood_sizes(neighborhood_ids):
-    neighborhood_sizes = [len(x) for x in neighborhood_ids]
-    return neighborhood_sizes
-
-
-def calc_neighborhood_total_weights(neighborhood_weights):
-    neighborhood_total_weights = [sum(weights) for weights in neighborhood_weights]
-    return neighborhood_total_weights
-
-
-def train_model(matches, pid_list, lookup, ranks, weights, neighborhood_ids, neighborhood_weights, neighborhood_sizes, neighborhood_total_weights, 
-        validation_matches=[], neighbor_regularization=0.4, MAX_ITER=200, base_lr=1.0, frac_lr_const=0.0, verbose=True):
+def pair_checksum(matches, start=0):
+    # Order-sensitive checksum (mod 2**64) of the player pairs of matches, numbered from start
+    pairs = np.asarray(matches)[:,:2].astype(np.int64).astype(np.uint64)
+    if len(pairs) == 0:
+        return 0
+    positions = 2*np.arange(start, start+len(pairs), dtype=np.uint64) + np.uint64(1)
+    return int(np.sum((pairs[:,0]*np.uint64(1000003) + pairs[:,1])*positions, dtype=np.uint64))
+
+
+class NeighborhoodIndex(object):
+    # Adjacency index over a match history. Each player appearance is stored as an edge
+    # (player ID, opponent ID, match index) in growable arrays, so appending a match is amortized O(1)
+    # and the weighted CSR matrix for a set of match weights is built in one vectorized pass.
+
+    def __init__(self, matches=None):
+        self.player_ids = np.zeros(16, dtype=np.int64)
+        self.neighbor_ids = np.zeros(16, dtype=np.int64)
+        self.match_indices = np.zeros(16, dtype=np.int64)
+        self.num_edges = 0
+        self.num_matches = 0
+        self.checksum = 0   # pair_checksum of the matches indexed so far
+        if matches is not None and len(matches) > 0:
+            self.extend(matches)
+
+    def extend(self, matches):
+        matches = np.asarray(matches)
+        p1 = matches[:,0].astype(np.int64)
+        p2 = matches[:,1].astype(np.int64)
+        match_indices = np.arange(self.num_matches, self.num_matches+len(matches))
+        self.checksum = (self.checksum + pair_checksum(matches, self.num_matches)) % 2**64
+        # Each player gets the other as a neighbor, but a player matched against themself only counts once
+        distinct = p1 != p2
+        self._append_edges(np.concatenate((p1, p2[distinct])),
+                           np.concatenate((p2, p1[distinct])),
+                           np.concatenate((match_indices, match_indices[distinct])))
+        self.num_matches += len(matches)
+
+    def covers(self, matches):
+        # True if the index describes exactly these matches, not just the same number of them
+        return self.num_matches == len(matches) and self.checksum == pair_checksum(matches)
+
+    def _append_edges(self, player_ids, neighbor_ids, match_indices):
+        new_num_edges = self.num_edges + len(player_ids)
+        if new_num_edges > len(self.player_ids):
+            capacity = max(new_num_edges, 2*len(self.player_ids))
+            for name in ('player_ids', 'neighbor_ids', 'match_indices'):
+                grown = np.zeros(capacity, dtype=np.int64)
+                grown[:self.num_edges] = getattr(self, name)[:self.num_edges]
+                setattr(self, name, grown)
+        self.player_ids[self.num_edges:new_num_edges] = player_ids
+        self.neighbor_ids[self.num_edges:new_num_edges] = neighbor_ids
+        self.match_indices[self.num_edges:new_num_edges] = match_indices
+        self.num_edges = new_num_edges
+
+    def to_csr(self, weights, pid_list):
+        # Rows and columns follow the order of pid_list, i.e. the lookup indices used in train_model
+        row_of = np.full(max(np.max(pid_list), np.max(self.player_ids[:self.num_edges], initial=0))+1, -1, dtype=np.int64)
+        row_of[pid_list] = np.arange(len(pid_list))
+        rows = row_of[self.player_ids[:self.num_edges]]
+        cols = row_of[self.neighbor_ids[:self.num_edges]]
+        edge_weights = np.asarray(weights, dtype=float)[self.match_indices[:self.num_edges]]
+        in_list = (rows >= 0) & (cols >= 0)
+        rows, cols, edge_weights = rows[in_list], cols[in_list], edge_weights[in_list]
+
+        neighborhood_matrix = sparse.csr_matrix((edge_weights, (rows, cols)), shape=(len(pid_list), len(pid_list)))
+        neighborhood_sizes = np.bincount(rows, minlength=len(pid_list))
+        neighborhood_total_weights = np.bincount(rows, weights=edge_weights, minlength=len(pid_list))
+        return neighborhood_matrix, neighborhood_sizes, neighborhood_total_weights
+
+
+def calc_neighborhoods(matches, weights, pid_list, neighborhood_index=None):
+    # Reuse a given index (e.g. one extended from the prepared-input cache) if it covers exactly these matches
+    if neighborhood_index is None or not neighborhood_index.covers(matches):
+        neighborhood_index = NeighborhoodIndex(matches)
+    neighborhood_matrix, neighborhood_sizes, neighborhood_total_weights = neighborhood_index.to_csr(weights, pid_list)
+    for row in np.where(neighborhood_sizes==0)[0]:
+        print('No neighborhood!', pid_list[row])
+    return neighborhood_matrix, neighborhood_sizes, neighborhood_total_weights
+
+
+def calc_neighborhood_averages(neighborhood_matrix, ranks, pid_list, neighborhood_total_weights):
+    rank_vector = np.array([ranks[pid] for pid in pid_list])
+    return neighborhood_matrix.dot(rank_vector)/neighborhood_total_weights
+
+
+def train_model(matches, pid_list, lookup, ranks, weights, neighborhood_matrix, neighborhood_sizes, neighborhood_total_weights, 
+        validation_matches=[], neighbor_regularization=0.4, MAX_ITER=200, base_lr=1.0, frac_lr_const=0.0, engine='sgd', batch_size=None, 
+        start_iter=0, lr_horizon=None, eval_every=1, eval_subsample=None, return_history=False, verbose=True):
+    # engine='sgd' updates ranks one match at a time, engine='batch' applies vectorized updates over
+    # minibatches of batch_size matches (the whole epoch if None).
+    # Training can be resumed from iteration start_iter; lr_horizon (default MAX_ITER) sets the length of
+    # the learning rate schedule, so resumed runs continue on the same schedule.
+    # Validation is scored every eval_every iterations (and on the last one), on a fixed random subset of
+    # eval_subsample validation matches if given. With return_history, also returns an array with one
+    # row of (iteration, % correct, avg error, median error) per evaluation.
+    if lr_horizon is None:
+        lr_horizon = MAX_ITER
+    if engine not in ('sgd', 'batch'):
+        raise ValueError('Unknown training engine: {}'.format(engine))
 
     if verbose:
         print('Initial scores: ')
@@ -83,54 +204,113 @@ def train_model(matches, pid_list, lookup, ranks, weights, neighborhood_ids, nei
         score_performance(ranks, matches, 'training')
         print('')
 
+    if engine == 'batch':
+        # Work on a rank vector indexed by player ID, and precompute each match's neighborhood rows
+        rank_values, known = build_rank_array(ranks, size=max(np.max(matches[:,:2]), max(ranks.keys()))+1)
+        pid_array = np.array(pid_list)
+        row_of = np.zeros(len(rank_values), dtype=int)
+        row_of[pid_array] = np.arange(len(pid_array))
+        match_rows = row_of[matches[:,:2]]
+        neighborhood_sizes = np.asarray(neighborhood_sizes)
+
+    # Scoring buffers are allocated once, for a rank vector big enough for every player ID involved
+    rank_size = max(np.max(matches[:,:2]), max(ranks.keys()))+1
+    if len(validation_matches)>0:
+        if eval_subsample is not None and eval_subsample < len(validation_matches):
+            validation_matches = validation_matches[np.random.choice(len(validation_matches), eval_subsample, replace=False)]
+        val_buffers = prepare_score_buffers(validation_matches, rank_size)
+    history = []
+
     best_val_score = 0.0
     best_ranks = ranks.copy()
     iterations_since_new_best_score = 0
-    for i in range(MAX_ITER):
+    for i in range(start_iter, MAX_ITER):
         if verbose:
             print('Iteration {:d}'.format(i))
-        neighborhood_ranks = calc_neighborhood_ranks(neighborhood_ids, ranks)
-        neighborhood_averages = calc_neighborhood_averages(neighborhood_ranks, neighborhood_weights, neighborhood_total_weights)
         #learning_rate = 5.*np.power((1+0.1*MAX_ITER)/(i+0.1*MAX_ITER), 0.602) + 15.
-        learning_rate = base_lr*((1-frac_lr_const)*np.power((1+0.1*MAX_ITER)/(i+0.1*MAX_ITER), 0.602) + frac_lr_const)
+        learning_rate = base_lr*((1-frac_lr_const)*np.power((1+0.1*lr_horizon)/(i+0.1*lr_horizon), 0.602) + frac_lr_const)
         #learning_rate = 1
-        indices = np.random.permutation(len(matches))
-        
-        for weight, match in zip(weights[indices], matches[indices]):
-            pred = predict_one_outcome(ranks, match[0], match[1])
-            pred_factor = weight*(match[2]-pred)*pred*(1-pred)
-            ranks[match[0]] -= learning_rate *  (pred_factor + neighbor_regularization/neighborhood_sizes[lookup[match[0]]]*(ranks[match[0]]-neighborhood_averages[lookup[match[0]]]))
-            ranks[match[1]] -= learning_rate * (-pred_factor + neighbor_regularization/neighborhood_sizes[lookup[match[1]]]*(ranks[match[1]]-neighborhood_averages[lookup[match[1]]]))
-            #ranks[match[0]] -= learning_rate *  (pred_factor + neighbor_regularization*(ranks[match[0]]-neighborhood_averages[lookup[match[0]]]))
-            #ranks[match[1]] -= learning_rate * (-pred_factor + neighbor_regularization*(ranks[match[1]]-neighborhood_averages[lookup[match[1]]]))
+
+        if engine == 'batch':
+            neighborhood_averages = neighborhood_matrix.dot(rank_values[pid_array])/neighborhood_total_weights
+            train_batch_epoch(rank_values, matches, match_rows, weights, neighborhood_averages, neighborhood_sizes, neighbor_regularization, learning_rate, batch_size=batch_size)
+            current_ranks = (rank_values, known)
+        else:
+            neighborhood_averages = calc_neighborhood_averages(neighborhood_matrix, ranks, pid_list, neighborhood_total_weights)
+            indices = np.random.permutation(len(matches))
+            for weight, match in zip(weights[indices], matches[indices]):
+                pred = predict_one_outcome(ranks, match[0], match[1])
+                pred_factor = weight*(match[2]-pred)*pred*(1-pred)
+                ranks[match[0]] -= learning_rate *  (pred_factor + neighbor_regularization/neighborhood_sizes[lookup[match[0]]]*(ranks[match[0]]-neighborhood_averages[lookup[match[0]]]))
+                ranks[match[1]] -= learning_rate * (-pred_factor + neighbor_regularization/neighborhood_sizes[lookup[match[1]]]*(ranks[match[1]]-neighborhood_averages[lookup[match[1]]]))
+                #ranks[match[0]] -= learning_rate *  (pred_factor + neighbor_regularization*(ranks[match[0]]-neighborhood_averages[lookup[match[0]]]))
+                #ranks[match[1]] -= learning_rate * (-pred_factor + neighbor_regularization*(ranks[match[1]]-neighborhood_averages[lookup[match[1]]]))
+            current_ranks = ranks
        
-        if len(validation_matches)>0:
-            val_score, _, _ = score_performance(ranks, validation_matches, 'validation', verbose=verbose, return_values=True)
+        if len(validation_matches)>0 and ((i-start_iter+1) % eval_every == 0 or i == MAX_ITER-1):
+            if engine == 'batch':
+                rank_array = current_ranks
+            else:
+                rank_array = build_rank_array(ranks, size=rank_size)
+            val_score, val_avg_error, val_median_error = score_performance_fast(rank_array[0], rank_array[1], val_buffers, 'validation', verbose=verbose)
+            history.append((i, val_score, val_avg_error, val_median_error))
+            evaluated_iterations = min(eval_every, i-start_iter+1)
             if val_score > best_val_score:
                 best_val_score = val_score
-                best_ranks = ranks
+                best_ranks = snapshot_ranks(current_ranks)
                 iterations_since_new_best_score = 0
             elif val_score == best_val_score:
-                best_ranks = ranks
-                iterations_since_new_best_score +=1
+                best_ranks = snapshot_ranks(current_ranks)
+                iterations_since_new_best_score += evaluated_iterations
             else:
-                iterations_since_new_best_score +=1
+                iterations_since_new_best_score += evaluated_iterations
             if iterations_since_new_best_score>250:
                 if verbose:
                     print('Validation criteria reached, terminating iteration.')
                 break
-        else:
-            best_ranks = ranks
         if verbose:
-            score_performance(ranks, matches, 'training')
+            score_performance(current_ranks, matches, 'training')
             print('')
 
+    if len(validation_matches)==0 and MAX_ITER > start_iter:
+        best_ranks = snapshot_ranks(current_ranks)
+
     if verbose and len(validation_matches)>0:
         print('Best validation score: {:.2f}'.format(best_val_score))
 
+    # Both engines hand back a {pid: rank} dict with the same keys as the initial ranks
+    if isinstance(best_ranks, tuple):
+        best_values = best_ranks[0]
+        best_ranks = {pid:best_values[pid] for pid in ranks}
+    if return_history:
+        return best_ranks, np.array(history).reshape(-1, 4)
     return best_ranks
 
 
+def train_batch_epoch(rank_values, matches, match_rows, weights, neighborhood_averages, neighborhood_sizes, neighbor_regularization, learning_rate, batch_size=None):
+    # Same per-match gradient as the SGD engine, but computed for a whole minibatch at once and
+    # scatter-added into rank_values (in place)
+    indices = np.random.permutation(len(matches))
+    if batch_size is None:
+        batch_size = len(matches)
+    for start in range(0, len(matches), batch_size):
+        batch = indices[start:start+batch_size]
+        pid1, pid2 = matches[batch,0], matches[batch,1]
+        row1, row2 = match_rows[batch,0], match_rows[batch,1]
+        pred = 1./(1+np.power(10, (rank_values[pid1]-rank_values[pid2])/400.))
+        pred_factor = weights[batch]*(matches[batch,2]-pred)*pred*(1-pred)
+        grad1 =  pred_factor + neighbor_regularization/neighborhood_sizes[row1]*(rank_values[pid1]-neighborhood_averages[row1])
+        grad2 = -pred_factor + neighbor_regularization/neighborhood_sizes[row2]*(rank_values[pid2]-neighborhood_averages[row2])
+        rank_values -= learning_rate*np.bincount(np.concatenate((pid1, pid2)), weights=np.concatenate((grad1, grad2)), minlength=len(rank_values))
+
+
+def snapshot_ranks(ranks):
+    # Copy ranks in either the dict or the (rank_values, known) representation
+    if isinstance(ranks, tuple):
+        return (ranks[0].copy(), ranks[1])
+    return ranks.copy()
+
+
 def score_numcorrect(Y_pred, Y):
     not_just_guessing = Y_pred!=0.5
     just_guessing = Y_pred==0.5
@@ -145,24 +325,157 @@ def score_median_error(Y_pred, Y):
     return np.median(np.abs(Y_pred-Y))
 
 
-def prepare_inputs(matches, pid_dict, pname_dict, initial_ranks={}, min_weight=0., verbose=True):
+def prepare_inputs(matches, pid_dict, pname_dict, initial_ranks={}, min_weight=0., neighborhood_index=None, verbose=True, use_cache=None):
+    if use_cache is None:
+        use_cache = USE_PREPARED_CACHE
+    cached = load_prepared_inputs(matches, pname_dict, min_weight, verbose=verbose) if use_cache else None
+    if cached is not None:
+        pid_list, weights, neighborhood_matrix, neighborhood_sizes, neighborhood_total_weights = cached
+        lookup, ranks = prepare_lookup_and_ranks(pid_list, initial_ranks)
+        if verbose:
+            print('{:d} players found in {:d} matches'.format(len(pid_list), len(matches)))
+        return pid_list, lookup, ranks, weights, neighborhood_matrix, neighborhood_sizes, neighborhood_total_weights
+
     # Per-player attributes
     pid_list, lookup, ranks = prepare_player_related_inputs(matches, pid_dict, pname_dict, initial_ranks=initial_ranks)
     if verbose:
         print('{:d} players found in {:d} matches'.format(len(pid_list), len(matches)))
     
     # Per-match attributes
-    weights, neighborhood_ids, neighborhood_weights, neighborhood_sizes, neighborhood_total_weights = prepare_match_related_inputs(matches, pid_list, min_weight=min_weight)
+    if use_cache and (neighborhood_index is None or not neighborhood_index.covers(matches)):
+        # The index is stored with the entry, so later, longer histories can extend it
+        neighborhood_index = NeighborhoodIndex(matches)
+    weights, neighborhood_matrix, neighborhood_sizes, neighborhood_total_weights = prepare_match_related_inputs(matches, pid_list, min_weight=min_weight, neighborhood_index=neighborhood_index)
+    if use_cache:
+        store_prepared_inputs(matches, min_weight, pid_list, weights, neighborhood_matrix, neighborhood_sizes, neighborhood_total_weights, neighborhood_index)
 
-    return pid_list, lookup, ranks, weights, neighborhood_ids, neighborhood_weights, neighborhood_sizes, neighborhood_total_weights
+    return pid_list, lookup, ranks, weights, neighborhood_matrix, neighborhood_sizes, neighborhood_total_weights
 
 
-def prepare_player_related_inputs(matches, pid_dict, pname_dict, initial_ranks={}): 
-    # Get a concise list of the player IDs that appear in the provided matches
-    _, concise_names_list = sd.check_dictionary_conciseness(matches, pname_dict, return_concise_names=True, verbose=False)
+def get_prepared_cache_directory():
+    return os.path.join(ss.DATA_DIRECTORY, PREPARED_CACHE_DIRECTORY)
 
-    # Create new index lookup list for player IDs
-    pid_list = [pid_dict[name] for name in concise_names_list]
+
+def fingerprint_matches(matches, prefix_lengths=()):
+    # SHA-1 of the match rows as int64, for the whole array and for each of the given prefix lengths, in one pass
+    records = np.ascontiguousarray(matches, dtype=np.int64)
+    digest = hashlib.sha1()
+    fingerprints = {}
+    start = 0
+    for length in sorted(set(prefix_lengths) | set([len(records)])):
+        digest.update(records[start:length].data)
+        fingerprints[length] = digest.hexdigest()
+        start = length
+    return fingerprints
+
+
+def prepared_cache_key(fingerprint, min_weight):
+    return '{}-{}'.format(fingerprint, repr(float(min_weight)))
+
+
+def read_prepared_cache_index():
+    filename = os.path.join(get_prepared_cache_directory(), 'index.json')
+    if not os.path.isfile(filename):
+        return {}
+    try:
+        return json.load(open(filename, 'r'))
+    except ValueError:
+        return {}
+
+
+def write_prepared_cache_index(index):
+    filename = os.path.join(get_prepared_cache_directory(), 'index.json')
+    with open(filename + '.tmp', 'w') as outfile:
+        json.dump(index, outfile)
+    os.rename(filename + '.tmp', filename)
+
+
+def load_prepared_inputs(matches, pname_dict, min_weight, verbose=True):
+    # Returns (pid_list, weights, neighborhood_matrix, neighborhood_sizes, neighborhood_total_weights),
+    # or None if nothing in the cache fits these matches
+    index = read_prepared_cache_index()
+    candidates = [entry for entry in index.values() if entry['num_matches'] <= len(matches)]
+    fingerprints = fingerprint_matches(matches, [entry['num_matches'] for entry in candidates])
+    key = prepared_cache_key(fingerprints[len(matches)], min_weight)
+    try:
+        if key in index:
+            entry = index[key]
+            with np.load(os.path.join(get_prepared_cache_directory(), entry['filename'])) as cached:
+                pid_list = cached['pid_list'].tolist()
+                weights = cached['weights']
+                neighborhood_matrix = sparse.csr_matrix((cached['matrix_data'], cached['matrix_indices'], cached['matrix_indptr']), shape=(len(pid_list), len(pid_list)))
+                neighborhood_sizes = cached['neighborhood_sizes']
+                neighborhood_total_weights = cached['neighborhood_total_weights']
+            if verbose:
+                print('Prepared inputs loaded from cache')
+        else:
+            # The longest cached prefix of these matches, whatever its min_weight: its neighborhood index is
+            # extended with the new matches, and weights, which depend on the newest timestamp, are recomputed
+            prefixes = [entry for entry in candidates if fingerprints[entry['num_matches']] == entry['fingerprint']]
+            if not prefixes:
+                return None
+            entry = max(prefixes, key=lambda entry: entry['num_matches'])
+            with np.load(os.path.join(get_prepared_cache_directory(), entry['filename'])) as cached:
+                old_pid_list = cached['pid_list']
+                neighborhood_index = NeighborhoodIndex()
+                neighborhood_index._append_edges(cached['index_player_ids'], cached['index_neighbor_ids'], cached['index_match_indices'])
+                neighborhood_index.num_matches = entry['num_matches']
+                neighborhood_index.checksum = pair_checksum(matches[:entry['num_matches']])
+            new_matches = np.asarray(matches[entry['num_matches']:])
+            neighborhood_index.extend(new_matches)
+            new_pids = [pid for pid in np.unique(new_matches[:,:2]).tolist() if pid in pname_dict]
+            pid_list = np.union1d(old_pid_list, np.asarray(new_pids, dtype=np.int64)).tolist()
+            weights, neighborhood_matrix, neighborhood_sizes, neighborhood_total_weights = prepare_match_related_inputs(matches, pid_list, min_weight=min_weight, neighborhood_index=neighborhood_index)
+            if verbose:
+                print('Prepared inputs extended from cache with {:d} new matches'.format(len(new_matches)))
+            store_prepared_inputs(matches, min_weight, pid_list, weights, neighborhood_matrix, neighborhood_sizes, neighborhood_total_weights, neighborhood_index, fingerprint=fingerprints[len(matches)])
+            return pid_list, weights, neighborhood_matrix, neighborhood_sizes, neighborhood_total_weights
+    except (IOError, KeyError, ValueError) as e:
+        print('Ignoring unreadable prepared input cache entry: {}'.format(e))
+        return None
+    entry['last_used'] = time()
+    write_prepared_cache_index(index)
+    return pid_list, weights, neighborhood_matrix, neighborhood_sizes, neighborhood_total_weights
+
+
+def store_prepared_inputs(matches, min_weight, pid_list, weights, neighborhood_matrix, neighborhood_sizes, neighborhood_total_weights, neighborhood_index, fingerprint=None):
+    if fingerprint is None:
+        fingerprint = fingerprint_matches(matches)[len(matches)]
+    key = prepared_cache_key(fingerprint, min_weight)
+    if not os.path.isdir(get_prepared_cache_directory()):
+        os.makedirs(get_prepared_cache_directory())
+    filename = key + '.npz'
+    path = os.path.join(get_prepared_cache_directory(), filename)
+    num_edges = neighborhood_index.num_edges
+    with open(path + '.tmp', 'wb') as outfile:
+        np.savez(outfile, pid_list=np.asarray(pid_list, dtype=np.int64), weights=weights,
+                 matrix_data=neighborhood_matrix.data, matrix_indices=neighborhood_matrix.indices, matrix_indptr=neighborhood_matrix.indptr,
+                 neighborhood_sizes=neighborhood_sizes, neighborhood_total_weights=neighborhood_total_weights,
+                 index_player_ids=neighborhood_index.player_ids[:num_edges], index_neighbor_ids=neighborhood_index.neighbor_ids[:num_edges],
+                 index_match_indices=neighborhood_index.match_indices[:num_edges])
+    os.rename(path + '.tmp', path)
+    index = read_prepared_cache_index()
+    index[key] = {'fingerprint': fingerprint, 'num_matches': len(matches), 'min_weight': float(min_weight),
+                  'filename': filename, 'bytes': os.path.getsize(path), 'last_used': time()}
+    evict_prepared_inputs(index, PREPARED_CACHE_MAX_BYTES)
+    write_prepared_cache_index(index)
+
+
+def evict_prepared_inputs(index, max_bytes):
+    # Drop least recently used entries until the cache fits in max_bytes (always keeping the newest one)
+    entries = sorted(index.items(), key=lambda item: item[1]['last_used'])
+    total_bytes = sum(entry['bytes'] for key, entry in entries)
+    for key, entry in entries[:-1]:
+        if total_bytes <= max_bytes:
+            break
+        path = os.path.join(get_prepared_cache_directory(), entry['filename'])
+        if os.path.isfile(path):
+            os.remove(path)
+        total_bytes -= entry['bytes']
+        del index[key]
+
+
+def prepare_lookup_and_ranks(pid_list, initial_ranks={}):
     lookup = {pid:i for i,pid in enumerate(pid_list)}
     
     # Merge initial ranks onto default values
@@ -170,16 +483,25 @@ def prepare_player_related_inputs(matches, pid_dict, pname_dict, initial_ranks={
     for key in initial_ranks.keys():
         ranks[key] = initial_ranks[key]
 
+    return lookup, ranks
+
+
+def prepare_player_related_inputs(matches, pid_dict, pname_dict, initial_ranks={}): 
+    # Get a concise list of the player IDs that appear in the provided matches
+    _, concise_names_list = sd.check_dictionary_conciseness(matches, pname_dict, return_concise_names=True, verbose=False)
+
+    # Create new index lookup list for player IDs
+    pid_list = [pid_dict[name] for name in concise_names_list]
+    lookup, ranks = prepare_lookup_and_ranks(pid_list, initial_ranks)
+
     return pid_list, lookup, ranks
 
 
-def prepare_match_related_inputs(matches, pid_list, min_weight=0.):
+def prepare_match_related_inputs(matches, pid_list, min_weight=0., neighborhood_index=None):
     weights = calc_weights(matches[:,5].astype(float), np.min(matches[:,5]), np.max(matches[:,5]), min_weight=min_weight)
-    neighborhood_ids, neighborhood_weights = calc_neighborhoods(matches, weights, pid_list)
-    neighborhood_sizes = calc_neighborhood_sizes(neighborhood_ids)
-    neighborhood_total_weights = calc_neighborhood_total_weights(neighborhood_weights)
+    neighborhood_matrix, neighborhood_sizes, neighborhood_total_weights = calc_neighborhoods(matches, weights, pid_list, neighborhood_index=neighborhood_index)
 
-    return weights, neighborhood_ids, neighborhood_weights, neighborhood_sizes, neighborhood_total_weights
+    return weights, neighborhood_matrix, neighborhood_sizes, neighborhood_total_weights
 
 
 def score_performance(ranks, matches, desc_str, verbose=True, return_values=False):
@@ -194,113 +516,181 @@ def score_performance(ranks, matches, desc_str, verbose=True, return_values=Fals
         return pct_correct, avg_error, median_error
 
 
+def prepare_score_buffers(matches, size):
+    # Match columns and work arrays for score_performance_fast, allocated once and reused every evaluation
+    pid1 = np.asarray(matches[:,0], dtype=int)
+    pid2 = np.asarray(matches[:,1], dtype=int)
+    in_range = (pid1>=0) & (pid1<size) & (pid2>=0) & (pid2<size)
+    num_matches = len(matches)
+    return {'idx1': np.where(in_range, pid1, 0), 'idx2': np.where(in_range, pid2, 0), 'in_range': in_range,
+            'outcomes': np.asarray(matches[:,2], dtype=float), 'outcome_is_p2': np.asarray(matches[:,2])==1,
+            'pred': np.empty(num_matches), 'work': np.empty(num_matches), 
+            'mask1': np.empty(num_matches, dtype=bool), 'mask2': np.empty(num_matches, dtype=bool)}
+
+
+def score_performance_fast(rank_values, known, buffers, desc_str, verbose=False):
+    # Same numbers as score_performance, computed in the preallocated buffers from prepare_score_buffers
+    pred, work, mask1, mask2 = buffers['pred'], buffers['work'], buffers['mask1'], buffers['mask2']
+    np.take(rank_values, buffers['idx1'], out=pred)
+    np.take(rank_values, buffers['idx2'], out=work)
+    np.subtract(pred, work, out=pred)
+    np.divide(pred, 400., out=pred)
+    np.power(10., pred, out=pred)
+    np.add(pred, 1., out=pred)
+    np.reciprocal(pred, out=pred)
+    # Pairs with an unknown player predict 0.5
+    np.take(known, buffers['idx1'], out=mask1)
+    np.take(known, buffers['idx2'], out=mask2)
+    np.logical_and(mask1, mask2, out=mask1)
+    np.logical_and(mask1, buffers['in_range'], out=mask1)
+    np.logical_not(mask1, out=mask1)
+    pred[mask1] = 0.5
+
+    # Count correct predictions, with half credit for guesses
+    num_guesses = np.count_nonzero(np.equal(pred, 0.5, out=mask1))
+    np.greater(pred, 0.5, out=mask2)
+    np.equal(mask2, buffers['outcome_is_p2'], out=mask2)
+    np.logical_not(mask1, out=mask1)
+    np.logical_and(mask2, mask1, out=mask2)
+    numcorrect = np.count_nonzero(mask2) + int(num_guesses/2.)
+    pct_correct = float(numcorrect)/len(pred)*100
+
+    np.subtract(pred, buffers['outcomes'], out=work)
+    np.abs(work, out=work)
+    avg_error = np.mean(work)
+    # In-place median, since the error buffer is scratch space anyway
+    half = len(work)//2
+    work.partition(half)
+    median_error = work[half] if len(work)%2 else (work[half] + np.max(work[:half]))/2.
+    if verbose:
+        print('{:d}/{:d} = {:.2f}% correct in {}, avg/median error {:.3f}/{:.3f}'.format(numcorrect, len(pred), pct_correct, desc_str, avg_error, median_error))
+    return pct_correct, avg_error, median_error
+
+
 def calc_delta(E, epsilon=0.05):
     clipped_E  = np.clip(E, epsilon, 1.-epsilon)
     return 400*np.log10((1-clipped_E)/clipped_E)
 
 
-def run_one_model(matches, pid_dict, pname_dict, N_VAL, N_TEST, initial_ranks, neighbor_regularization, MAX_ITER, base_lr, frac_lr_const, min_weight, verbose=True, random_state=1334):
+def run_one_model(matches, pid_dict, pname_dict, N_VAL, N_TEST, initial_ranks, neighbor_regularization, MAX_ITER, base_lr, frac_lr_const, min_weight, verbose=True, random_state=1334, tol=1e-3, max_sweeps=1000):
     
     from sklearn.cross_validation import KFold
     kf = KFold(len(matches), n_folds=50, shuffle=True)
     for train_index, test_index in kf:
         break
 
+    # Sparse win counts: transition[i,j] is the number of times i beat j. Memory grows with distinct pairings.
     num_characters = np.max(matches[:,:2])+1
-    transition = np.zeros(shape=(num_characters, num_characters), dtype=np.int16)
-    for match in matches[train_index]:
-        transition[match[match[2]], match[1-match[2]]] += 1
-    times_seen = np.sum(transition, axis=0) + np.sum(transition, axis=1)
-    win_rate = np.sum(transition, axis=1) / times_seen.astype(float)
-    weights = transition + transition.T
+    train_matches = matches[train_index]
+    winner_ids = np.where(train_matches[:,2]==0, train_matches[:,0], train_matches[:,1])
+    loser_ids = np.where(train_matches[:,2]==0, train_matches[:,1], train_matches[:,0])
+    transition = sparse.csr_matrix((np.ones(len(train_matches), dtype=np.int64), (winner_ids, loser_ids)), shape=(num_characters, num_characters))
+    wins_array = np.asarray(transition.sum(axis=1)).ravel()
+    losses_array = np.asarray(transition.sum(axis=0)).ravel()
+    times_seen = wins_array + losses_array
+    win_rate = wins_array / times_seen.astype(float)
+    weights = (transition + transition.T).tocsr()
 
     np.seterr(invalid='ignore')
 
     power_levels = np.random.randn(num_characters)
-    for i in range(20):
-        for pid in range(num_characters):
-            opponents = np.where(weights[pid,:])[0]
-            if len(opponents)==0:
-                continue
-            E = np.divide(transition[pid].astype(float), weights[pid])[opponents]
-            E = np.nan_to_num(E)
-            deltas = calc_delta(E, epsilon=0.05)
-            #idx_max = np.where(E==1)[0]
-            #idx_min = np.where(E==0)[0]
-            suggested_vals = power_levels[opponents] - deltas
-            #if len(idx_max)>0:
-            #    suggested_vals[idx_max] = np.max(suggested_vals[idx_max])
-            #if len(idx_min)>0:
-            #    suggested_vals[idx_min] = np.min(suggested_vals[idx_min])
-            final_val = np.average(suggested_vals, weights=weights[pid, opponents])
-            power_levels[pid] = final_val
-
-    rows, cols = np.where(transition)
-    probs = np.zeros(shape=(len(power_levels),len(power_levels)))
-    for row,col in zip(rows, cols):
-        probs[row,col] = predict_one_outcome(power_levels, row, col)
+    power_levels, sweeps, residual = solve_power_levels(transition, power_levels, tol=tol, max_sweeps=max_sweeps)
+    if verbose:
+        print('Power levels solved in {:d} sweeps, residual {:.2e}'.format(sweeps, residual))
+
+    all_known = (power_levels, np.ones(num_characters, dtype=bool))
+    pairs = transition.tocoo()
+    probs = predict_outcomes(all_known, pairs.row, pairs.col)
     preds = probs>0.5
     preds[probs==0.5] = 0.5
 
-    correct = 0
-    for row,col in zip(rows, cols):
-        winner = float(transition[row,col])/weights[row,col]<0.5
-        if preds[row,col] == winner:
-            correct += transition[row,col]
-    print('Training accuracy {}'.format(correct/np.sum(transition)))
-
-    correct = 0
-    for row,col,winner in matches[test_index,:3]:
-        pred = predict_one_outcome(power_levels, row, col) > 0.5
-        if pred==winner:
-            correct += 1
+    winner = pairs.data.astype(float)/np.asarray(weights[pairs.row, pairs.col]).ravel()<0.5
+    correct = np.sum(pairs.data[preds==winner])
+    print('Training accuracy {}'.format(correct/np.sum(pairs.data)))
+
+    test_matches = matches[test_index]
+    preds = predict_outcomes(all_known, test_matches[:,0], test_matches[:,1]) > 0.5
+    correct = np.sum(preds==test_matches[:,2])
     print('Test accuracy {}'.format(correct/float(len(test_index))))
 
-    new_ranks = {pid:power_levels[pid] for pid in range(num_characters)}
-    wins = {pid:val for pid,val in zip(range(num_characters),np.sum(transition, axis=1))}
-    losses = {pid:val for pid,val in zip(range(num_characters),np.sum(transition, axis=0))}
-    times_seen = {pid:val for pid,val in zip(range(num_characters),times_seen)}
+    # Only players who appear in these matches get stats. With a training window, everyone else keeps theirs.
+    pid_list = np.unique(matches[:,:2]).tolist()
+    new_ranks = {pid:power_levels[pid] for pid in pid_list}
+    wins = {pid:wins_array[pid] for pid in pid_list}
+    losses = {pid:losses_array[pid] for pid in pid_list}
+    times_seen = {pid:times_seen[pid] for pid in pid_list}
    
-    acc, tpr, tnr = evaluate_prediction_stats(matches, list(range(num_characters)), new_ranks) 
+    acc, tpr, tnr = evaluate_prediction_stats(matches, pid_list, new_ranks) 
 
     return new_ranks, wins, losses, times_seen, acc, tpr, tnr
 
 
+def solve_power_levels(transition, power_levels, tol=1e-3, max_sweeps=1000, damping=0.5):
+    # Fixed point where each character's level is the weighted average of (opponent level - delta), with
+    # delta from the observed win fraction against that opponent. transition[i,j] counts i's wins over j.
+    # Every character is updated at once each sweep (damped Jacobi, which also converges on bipartite
+    # match graphs), stopping when the largest change drops below tol.
+    transition = sparse.csr_matrix(transition, dtype=float)
+    weights = (transition + transition.T).tocoo()
+    rows, cols, pair_counts = weights.row, weights.col, weights.data
+    E = np.asarray(transition[rows, cols]).ravel() / pair_counts
+    deltas = calc_delta(E, epsilon=0.05)
+
+    weights = sparse.csr_matrix((pair_counts, (rows, cols)), shape=transition.shape)
+    total_weights = np.bincount(rows, weights=pair_counts, minlength=transition.shape[0])
+    weighted_deltas = np.bincount(rows, weights=pair_counts*deltas, minlength=transition.shape[0])
+    active = total_weights > 0
+
+    power_levels = np.array(power_levels, dtype=float)
+    residual = np.inf
+    sweeps = 0
+    while sweeps < max_sweeps and residual > tol:
+        suggested = (weights.dot(power_levels)[active] - weighted_deltas[active]) / total_weights[active]
+        step = damping*(suggested - power_levels[active])
+        power_levels[active] += step
+        residual = np.max(np.abs(step)) if len(step) > 0 else 0.
+        sweeps += 1
+
+    return power_levels, sweeps, residual
+
+
+def winner_loser_ids(matches):
+    # match[2] indicates whether match[0] or match[1] won
+    p1_won = matches[:,2]==0
+    winner_ids = np.where(p1_won, matches[:,0], matches[:,1])
+    loser_ids = np.where(p1_won, matches[:,1], matches[:,0])
+    return winner_ids, loser_ids
+
+
 def evaluate_prediction_stats(matches, pid_list, ranks):
     predictions = predict_outcomes(ranks, matches[:,0], matches[:,1])
 
-    tp = {pid:0.0 for pid in pid_list}
-    fp = {pid:0.0 for pid in pid_list}
-    tn = {pid:0.0 for pid in pid_list}
-    fn = {pid:0.0 for pid in pid_list}
-    
-    for match,pred_val in zip(matches,predictions):
-        # Get player IDs of the winner and loser
-        winner_id = match[match[2]]
-        loser_id = match[1-match[2]]
-        # See whether match[0] or match[1] was predicted to win
-        if pred_val == 0.5:
-            pred = int(round(np.random.random()))  
-        else:
-            pred = int(round(pred_val))
-        # Log the statistics from this match
-        if match[2] == pred:
-            tp[winner_id] += 1
-            tn[loser_id] += 1
-        else:
-            fp[winner_id] += 1
-            fn[loser_id] += 1
+    # See whether match[0] or match[1] was predicted to win, guessing randomly on no prediction
+    preds = np.round(predictions).astype(int)
+    guesses = predictions == 0.5
+    preds[guesses] = np.random.randint(0, 2, np.sum(guesses))
+    correct = matches[:,2] == preds
+
+    # Count per-player statistics over integer player IDs, and only build the dicts at the end
+    winner_ids, loser_ids = winner_loser_ids(matches)
+    size = max(np.max(pid_list), np.max(matches[:,:2]))+1 if len(matches)>0 else np.max(pid_list)+1
+    tp = np.bincount(winner_ids[correct], minlength=size).astype(float)
+    tn = np.bincount(loser_ids[correct], minlength=size).astype(float)
+    fp = np.bincount(winner_ids[~correct], minlength=size).astype(float)
+    fn = np.bincount(loser_ids[~correct], minlength=size).astype(float)
 
-    totals = {pid:tp[pid]+tn[pid]+fp[pid]+fn[pid] for pid in pid_list}
-    totals_p = {pid:tp[pid]+fp[pid] for pid in pid_list}
-    totals_n = {pid:tn[pid]+fn[pid] for pid in pid_list}
-    totals_correct = {pid:tp[pid]+tn[pid] for pid in pid_list}
+    totals = tp+tn+fp+fn
+    totals_p = tp+fp
+    totals_n = tn+fn
+    totals_correct = tp+tn
 
-    acc = {pid:(totals_correct[pid])/float(totals[pid]) if not totals[pid]==0 else 0.0 for pid in pid_list}
-    tpr = {pid:(tp[pid])/float(totals_p[pid]) if not totals_p[pid]==0 else 0.0 for pid in pid_list}
-    tnr = {pid:(tn[pid])/float(totals_n[pid]) if not totals_n[pid]==0 else 0.0 for pid in pid_list}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        acc = np.where(totals>0, totals_correct/totals, 0.0)
+        tpr = np.where(totals_p>0, tp/totals_p, 0.0)
+        tnr = np.where(totals_n>0, tn/totals_n, 0.0)
 
-    return acc, tpr, tnr
+    pids = np.asarray(pid_list)
+    return dict(zip(pid_list, acc[pids].tolist())), dict(zip(pid_list, tpr[pids].tolist())), dict(zip(pid_list, tnr[pids].tolist()))
 
 
 def evaluate_player_stats(matches, pid_list, neighborhood_sizes):
@@ -310,51 +700,197 @@ def evaluate_player_stats(matches, pid_list, neighborhood_sizes):
         times_seen[pid] = size
 
     # get wins and losses
-    w = {pid:0 for pid in pid_list}
-    l = {pid:0 for pid in pid_list}
-    for match in matches:
-        # match[2] indicates whether match[0] or match[1] won
-        winner = match[match[2]]
-        loser = match[1-match[2]]
-        w[winner] += 1
-        l[loser] += 1
+    winner_ids, loser_ids = winner_loser_ids(matches)
+    size = max(np.max(pid_list), np.max(matches[:,:2]))+1 if len(matches)>0 else np.max(pid_list)+1
+    pids = np.asarray(pid_list)
+    w_counts = np.bincount(winner_ids, minlength=size)[pids]
+    l_counts = np.bincount(loser_ids, minlength=size)[pids]
 
     # check that wins + losses = times_seen
-    for pid in pid_list:
-        if not (w[pid] + l[pid] == times_seen[pid]):
-            print('Player id {} has an invalid w/l/t count of {}/{}/{}'.format(pid, w[pid], l[pid], times_seen[pid]))
+    for i in np.where(w_counts + l_counts != np.asarray(neighborhood_sizes))[0]:
+        print('Player id {} has an invalid w/l/t count of {}/{}/{}'.format(pid_list[i], w_counts[i], l_counts[i], times_seen[pid_list[i]]))
 
+    w = dict(zip(pid_list, w_counts.tolist()))
+    l = dict(zip(pid_list, l_counts.tolist()))
     return w, l, times_seen
 
 
-def hyperparameter_search(initial_ranks):
+def share_array(array):
+    # Copy an array into a new shared memory block. Returns the block (keep it alive, unlink when done)
+    # and a small picklable descriptor that workers use to attach to it.
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def attach_shared_array(descriptor):
+    name, shape, dtype = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+# Per-process inputs for hyperparameter search workers, filled in by init_search_worker
+search_inputs = {}
+
+
+def init_search_worker(descriptors, pid_list, lookup, ranks, train_kwargs):
+    global search_inputs
+    blocks, arrays = {}, {}
+    for key, descriptor in descriptors.items():
+        blocks[key], arrays[key] = attach_shared_array(descriptor)
+    num_players = len(pid_list)
+    neighborhood_matrix = sparse.csr_matrix((arrays['neighborhood_data'], arrays['neighborhood_indices'], arrays['neighborhood_indptr']), shape=(num_players, num_players))
+    search_inputs = dict(arrays, blocks=blocks, neighborhood_matrix=neighborhood_matrix, pid_list=pid_list, lookup=lookup, ranks=ranks, train_kwargs=train_kwargs)
+
+
+def save_rank_snapshot(filename, ranks):
+    np.savez(filename, pids=np.fromiter(ranks.keys(), dtype=np.int64, count=len(ranks)), values=np.fromiter(ranks.values(), dtype=float, count=len(ranks)))
+
+
+def load_rank_snapshot(filename):
+    with np.load(filename) as snapshot:
+        return dict(zip(snapshot['pids'].tolist(), snapshot['values'].tolist()))
+
+
+def run_search_config(task):
+    # Train one config from iteration start_iter to stop_iter, starting from the shared initial ranks or,
+    # when resuming, from the snapshot file start_snapshot. The resulting ranks are saved to save_snapshot
+    # if given, so only the configs that advance ever have their ranks read back.
+    i, (neighbor_regularization, base_lr, frac_lr_const), start_snapshot, start_iter, stop_iter, save_snapshot = task
+    inputs = search_inputs
+    if start_snapshot is None:
+        start_ranks = inputs['ranks']
+    else:
+        start_ranks = load_rank_snapshot(start_snapshot)
+    new_ranks = train_model(inputs['train_matches'], inputs['pid_list'], inputs['lookup'], start_ranks.copy(), inputs['weights'], inputs['neighborhood_matrix'], inputs['neighborhood_sizes'], inputs['neighborhood_total_weights'], validation_matches=inputs['validation_matches'], neighbor_regularization=neighbor_regularization, MAX_ITER=stop_iter, base_lr=base_lr, frac_lr_const=frac_lr_const, start_iter=start_iter, verbose=False, **inputs['train_kwargs'])
+    scores = score_performance(new_ranks, inputs['test_matches'], 'test', verbose=False, return_values=True)
+    if len(inputs['validation_matches'])>0:
+        val_score, _, _ = score_performance(new_ranks, inputs['validation_matches'], 'validation', verbose=False, return_values=True)
+    else:
+        val_score = None
+    rank_values = list(new_ranks.values())
+    if save_snapshot is not None:
+        save_rank_snapshot(save_snapshot, new_ranks)
+    return i, scores, val_score, np.min(rank_values), np.max(rank_values)
+
+
+def sample_search_space(sampling='grid', nr_range=(0., 0.), base_lr_range=(1., 20.), frac_lr_const_range=(0., 1.), num_values=(1, 77, 21), num_samples=1000, random_state=None):
+    # 'grid': evenly spaced values per parameter, as np.linspace
+    # 'log': like 'grid', but log-spaced for neighbor_regularization and base_lr when their lower bound is >0
+    # 'random': num_samples independent draws, log-uniform for base_lr and uniform for the rest
+    import itertools
+    if sampling == 'grid' or sampling == 'log':
+        def spaced(value_range, num, log):
+            if value_range[0] == value_range[1]:
+                return [value_range[0]]
+            if log and value_range[0] > 0:
+                return np.logspace(np.log10(value_range[0]), np.log10(value_range[1]), num)
+            return np.linspace(value_range[0], value_range[1], num)
+        log = sampling == 'log'
+        return list(itertools.product(*[spaced(nr_range, num_values[0], log), spaced(base_lr_range, num_values[1], log), spaced(frac_lr_const_range, num_values[2], False)]))
+    elif sampling == 'random':
+        rng = np.random.RandomState(random_state)
+        nr_vals = rng.uniform(nr_range[0], nr_range[1], num_samples)
+        base_lr_vals = np.power(10, rng.uniform(np.log10(base_lr_range[0]), np.log10(base_lr_range[1]), num_samples))
+        frac_lr_const_vals = rng.uniform(frac_lr_const_range[0], frac_lr_const_range[1], num_samples)
+        return list(zip(nr_vals, base_lr_vals, frac_lr_const_vals))
+    else:
+        raise ValueError('Unknown sampling method: {}'.format(sampling))
+
+
+def run_search_tasks(pool, tasks, scores, params, desc_str=''):
+    # Run tasks on the pool, streaming test scores into the scores array as they finish
+    val_scores = {}
+    for num_done, (i, config_scores, val_score, min_rank, max_rank) in enumerate(pool.imap_unordered(run_search_config, tasks), 1):
+        scores[i,:] = config_scores
+        val_scores[i] = val_score
+        print('{}[{:d}/{:d}] {}:  {:.2f}% accuracy, {:.3f}/{:.3f} avg/median error, ranks {:0.3f} - {:0.3f}'.format(desc_str, num_done, len(tasks), params[i], scores[i,0], scores[i,1], scores[i,2], min_rank, max_rank))
+    return val_scores
+
+
+def hyperparameter_search(initial_ranks, engine='sgd', batch_size=None, n_jobs=None, search='full', sampling='grid', num_samples=1000, min_budget=10, eta=3, random_state=None, eval_every=1, eval_subsample=None,
+        nr_range=(0., 0.), base_lr_range=(1., 20.), frac_lr_const_range=(0., 1.), num_values=(1, 77, 21), use_cache=None):
+    # search='full' trains every config for MAX_ITER iterations. search='halving' runs successive halving:
+    # every config trains for min_budget iterations, the best 1/eta by validation score resume from their
+    # best-validation ranks (what train_model returns) for eta times as many iterations in total, and so on
+    # up to MAX_ITER. The parameter ranges and sampling are passed on to sample_search_space.
+    # use_cache is passed on to prepare_inputs.
     N_VAL = 1000
     N_TEST = 1000
     MAX_ITER = 500
     min_weight = 0.
-    nr_vals = [0]
-    base_lr_vals = np.linspace(1,20,77)
-    frac_lr_const_vals = np.linspace(0, 1, 21)
+    if search not in ('full', 'halving'):
+        raise ValueError('Unknown search method: {}'.format(search))
+    if search == 'halving' and not N_VAL>0:
+        raise ValueError('Successive halving needs validation matches to rank configs')
 
     ss.load_persistent_data()
-    matches = np.array(ss.matches)
+    matches = load_training_matches(TRAINING_WINDOW_DAYS, TRAINING_WINDOW_MATCHES)
 
-    pid_list, lookup, ranks, weights, neighborhood_ids, neighborhood_weights, neighborhood_sizes, neighborhood_total_weights = prepare_inputs(matches, ss.player_id_dict, ss.player_name_dict, initial_ranks=initial_ranks, min_weight=min_weight)
+    pid_list, lookup, ranks, weights, neighborhood_matrix, neighborhood_sizes, neighborhood_total_weights = prepare_inputs(matches, ss.player_id_dict, ss.player_name_dict, initial_ranks=initial_ranks, min_weight=min_weight, use_cache=use_cache)
 
     if N_VAL>0:
         train_matches, validation_matches = train_test_split(matches[:-N_TEST], test_size=N_VAL)
     else:
         train_matches = matches[:-N_TEST]
-        validation_matches = []
+        validation_matches = np.zeros((0, matches.shape[1]), dtype=matches.dtype)
     test_matches = matches[-N_TEST:]
  
-    import itertools
-    params = list(itertools.product(*[nr_vals, base_lr_vals, frac_lr_const_vals]))
+    params = sample_search_space(sampling=sampling, nr_range=nr_range, base_lr_range=base_lr_range, frac_lr_const_range=frac_lr_const_range,
+                                 num_values=num_values, num_samples=num_samples, random_state=random_state)
     scores = np.zeros((len(params),3))
-    for i, (neighbor_regularization, base_lr, frac_lr_const) in enumerate(params):
-        new_ranks = train_model(train_matches, pid_list, lookup, ranks.copy(), weights, neighborhood_ids, neighborhood_weights, neighborhood_sizes, neighborhood_total_weights, validation_matches=validation_matches, neighbor_regularization=neighbor_regularization, MAX_ITER=MAX_ITER, base_lr=base_lr, frac_lr_const=frac_lr_const, verbose=False)
-        scores[i,:] = score_performance(new_ranks, test_matches, 'test', return_values=True)
-        print('Ranks {:0.3f} - {:0.3f}'.format(np.min(list(new_ranks.values())), np.max(list(new_ranks.values()))))
+
+    # Inputs are prepared once and placed in shared memory, so workers attach to them instead of
+    # receiving a pickled copy
+    shared = {'train_matches': train_matches, 'validation_matches': validation_matches, 'test_matches': test_matches, 
+              'weights': weights, 'neighborhood_sizes': np.asarray(neighborhood_sizes), 'neighborhood_total_weights': np.asarray(neighborhood_total_weights),
+              'neighborhood_data': neighborhood_matrix.data, 'neighborhood_indices': neighborhood_matrix.indices, 'neighborhood_indptr': neighborhood_matrix.indptr}
+    blocks, descriptors = {}, {}
+    snapshot_directory = None
+    try:
+        for key, array in shared.items():
+            blocks[key], descriptors[key] = share_array(array)
+        train_kwargs = {'engine': engine, 'batch_size': batch_size, 'lr_horizon': MAX_ITER, 'eval_every': eval_every, 'eval_subsample': eval_subsample}
+        pool = multiprocessing.Pool(n_jobs, initializer=init_search_worker, initargs=(descriptors, pid_list, lookup, ranks, train_kwargs))
+        try:
+            if search == 'full':
+                run_search_tasks(pool, [(i, config, None, 0, MAX_ITER, None) for i, config in enumerate(params)], scores, params)
+            else:
+                # Configs eliminated at a rung keep the test scores from that rung. Workers write each
+                # config's ranks to a snapshot file; only the survivors' snapshots are read, by the workers
+                # that resume them, and the rest are deleted after every rung.
+                snapshot_directory = tempfile.mkdtemp(prefix='saltmind-search-')
+                def snapshot(i, stop_iter):
+                    return os.path.join(snapshot_directory, '{:d}-{:d}.npz'.format(i, stop_iter))
+                survivors = list(range(len(params)))
+                start_iter = 0
+                stop_iter = min(min_budget, MAX_ITER)
+                while True:
+                    print('Training {:d} configs for iterations {:d}-{:d}'.format(len(survivors), start_iter, stop_iter))
+                    last_rung = stop_iter >= MAX_ITER or len(survivors) <= 1
+                    tasks = [(i, params[i], snapshot(i, start_iter) if start_iter > 0 else None, start_iter, stop_iter, None if last_rung else snapshot(i, stop_iter)) for i in survivors]
+                    val_scores = run_search_tasks(pool, tasks, scores, params, desc_str='{:d}-{:d} '.format(start_iter, stop_iter))
+                    for filename in os.listdir(snapshot_directory):
+                        if not filename.endswith('-{:d}.npz'.format(stop_iter)):
+                            os.remove(os.path.join(snapshot_directory, filename))
+                    if last_rung:
+                        break
+                    num_kept = max(1, int(len(survivors)/eta))
+                    survivors = sorted(survivors, key=lambda i: -val_scores[i])[:num_kept]
+                    for i in set(val_scores) - set(survivors):
+                        os.remove(snapshot(i, stop_iter))
+                    # A lone survivor goes straight to the full budget
+                    start_iter, stop_iter = stop_iter, (MAX_ITER if num_kept == 1 else min(stop_iter*eta, MAX_ITER))
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        if snapshot_directory is not None:
+            shutil.rmtree(snapshot_directory, ignore_errors=True)
+        for shm in blocks.values():
+            shm.close()
+            shm.unlink()
     
     indices = np.lexsort((scores[:,1], -scores[:,0]))  # Second one has first sort priority
     print('')
@@ -394,12 +930,16 @@ if __name__ == "__main__":
 
     ss.load_persistent_data()
     ss.load_player_stats()
-    matches = np.array(ss.matches)
+    matches = load_training_matches(TRAINING_WINDOW_DAYS, TRAINING_WINDOW_MATCHES)
     #initial_ranks = ss.ranks
     initial_ranks = {}
     
     new_ranks, wins, losses, times_seen, acc, tpr, tnr  = run_one_model(matches, ss.player_id_dict, ss.player_name_dict, N_VAL, N_TEST, initial_ranks, neighbor_regularization, MAX_ITER, base_lr=base_lr, frac_lr_const=frac_lr_const, min_weight=min_weight, verbose=True, random_state=random_state)
      
     if N_TEST==0:
-        ss.replace_player_stats(new_ranks, wins, losses, times_seen, acc, tpr, tnr)
+        if TRAINING_WINDOW_DAYS is None and TRAINING_WINDOW_MATCHES is None:
+            ss.replace_player_stats(new_ranks, wins, losses, times_seen, acc, tpr, tnr)
+        else:
+            # Players outside the window were not retrained
+            ss.merge_player_stats(new_ranks, wins, losses, times_seen, acc, tpr, tnr)
         ss.save_player_stats()
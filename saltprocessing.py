@@ -1,8 +1,12 @@
 import requests
 import pickle
-from time import time
+from time import time, sleep
 import os
+import threading
+from collections import deque
+import numpy as np
 import saltstorage as ss
+import saltlog as sl
 
 STATE_JSON_URL = 'http://www-cdn-twitch.saltybet.com/state.json'
 
@@ -21,6 +25,23 @@ HEADERS = {
         'Connection': 'keep-alive',
 }
 
+# State fetches share one pooled keep-alive session with bounded timeouts, and are conditional on the ETag and
+# Last-Modified of the previous response, so an unchanged state.json costs a 304 and the cached state is reused.
+STATE_CONNECT_TIMEOUT = 2.   # Seconds
+STATE_READ_TIMEOUT = 3.
+KEEP_WARM_PERIOD = None   # If set, an idle connection is refreshed every N seconds by start_keep_warm()
+session = None
+cached_state = None
+cached_etag = None
+cached_last_modified = None
+state_latencies = deque(maxlen=1000)   # Seconds per fetch, most recent last
+num_state_fetches = 0
+num_not_modified = 0
+last_state_fetch = 0
+keep_warm_thread = None
+state_lock = threading.Lock()   # Guards the cached state and counters; the keep-warm thread fetches too
+fetches_in_flight = 0
+
 # Modes
 MATCHMAKING = u'M'
 EXHIBITION = u'E'
@@ -35,16 +56,91 @@ RESULTS = u'R'
 status = UNKNOWN # Shamelessly borrowed from the modes
 
 
+def get_session():
+    global session
+    if session is None:
+        session = requests.Session()
+        session.headers.update(HEADERS)
+        # Room for a keep-warm request alongside a real fetch
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=2)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+    return session
+
+
 def get_state():
-    #s = requests.Session()
-    #s.headers.update(HEADERS)    
-    #r = s.get(STATE_JSON_URL)
-    r = requests.get(STATE_JSON_URL, headers=HEADERS)
-    state = r.json()
+    global cached_state, cached_etag, cached_last_modified, num_state_fetches, num_not_modified, last_state_fetch, fetches_in_flight
+    # A 304 refers to the validators this request sent, so it is answered with the state they came with,
+    # whatever another thread may have cached since
+    with state_lock:
+        known_state = cached_state
+        headers = {}
+        if known_state is not None:
+            if cached_etag is not None:
+                headers['If-None-Match'] = cached_etag
+            if cached_last_modified is not None:
+                headers['If-Modified-Since'] = cached_last_modified
+        fetches_in_flight += 1
+    start = time()
+    try:
+        r = get_session().get(STATE_JSON_URL, headers=headers, timeout=(STATE_CONNECT_TIMEOUT, STATE_READ_TIMEOUT))
+        not_modified = r.status_code == 304 and known_state is not None
+        state = dict(known_state) if not_modified else r.json()
+    finally:
+        with state_lock:
+            fetches_in_flight -= 1
+    with state_lock:
+        if not_modified:
+            num_not_modified += 1
+        else:
+            cached_state = dict(state)
+            cached_etag = r.headers.get('ETag')
+            cached_last_modified = r.headers.get('Last-Modified')
+        last_state_fetch = time()
+        state_latencies.append(last_state_fetch - start)
+        num_state_fetches += 1
 
     return state
 
 
+def get_state_latency_stats():
+    # Latency of recent state fetches in milliseconds, plus how many were answered with a 304
+    with state_lock:
+        latencies = np.array(state_latencies)*1000
+    if len(latencies) == 0:
+        return {'fetches': num_state_fetches, 'not_modified': num_not_modified}
+    return {'fetches': num_state_fetches, 'not_modified': num_not_modified, 'last': float(latencies[-1]),
+            'mean': float(latencies.mean()), 'median': float(np.median(latencies)), 'p95': float(np.percentile(latencies, 95)), 'max': float(latencies.max())}
+
+
+def keep_warm():
+    # Refresh the pooled connection whenever it has been idle for KEEP_WARM_PERIOD. This is a conditional
+    # fetch like any other, so it also keeps the cached state current.
+    while KEEP_WARM_PERIOD is not None:
+        idle = time() - last_state_fetch
+        if fetches_in_flight > 0:
+            # A real fetch is keeping the connection warm already
+            idle = 0
+        elif idle >= KEEP_WARM_PERIOD:
+            try:
+                get_state()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print('Keep-warm state fetch failed: {}'.format(e))
+            idle = 0
+        sleep(KEEP_WARM_PERIOD - idle)
+
+
+def start_keep_warm(period=None):
+    global KEEP_WARM_PERIOD, keep_warm_thread
+    if period is not None:
+        KEEP_WARM_PERIOD = period
+    if KEEP_WARM_PERIOD is None or keep_warm_thread is not None:
+        return
+    keep_warm_thread = threading.Thread(target=keep_warm, name='saltprocessing-keep-warm')
+    keep_warm_thread.daemon = True
+    keep_warm_thread.start()
+
+
 def identify_status(state):
 
     # Determine the status being reported by the current state info
@@ -116,24 +212,20 @@ def identify_mode(state, status):
     if status == UNKNOWN:
         mode = UNKNOWN
 
-    # Specially log any states that do not get categorized
+    # Log all captured states for verification/debugging purposes, tagging the ones that do not get
+    # categorized and the win states
+    categories = []
     if mode == UNKNOWN or status == UNKNOWN:
-        with open('help_me_id_this.txt', 'a') as myfile:
-            myfile.write(mode+' '+status+' '+str(state)+'\n')
-
-    # Log all win states for verification/debugging purposes
+        categories.append(sl.UNIDENTIFIED)
     if status == RESULTS:
-        with open('win_state_log.txt', 'a') as myfile:
-            myfile.write(mode+' '+status+' '+str(state)+'\n')
-
-    # Log all captured states for verification/debugging purposes
-    with open('full_state_log.txt', 'a') as myfile:
-        myfile.write(mode+' '+status+' '+str(state)+'\n')
+        categories.append(sl.RESULTS)
+    sl.log_state(mode, status, state, categories)
 
     return mode
 
 
-def process_state(state):
+def process_state(state, timestamp=None):
+    # timestamp overrides the clock, e.g. when replaying recorded states
     status = identify_status(state)
     mode = identify_mode(state, status)
     
@@ -150,7 +242,7 @@ def process_state(state):
         winner = -1                             # Winner undefined        
     p1total = int(state['p1total'].replace(',','')) # amt bet on P1
     p2total = int(state['p2total'].replace(',','')) # amt bet on P2
-    timestamp = int(time())                    # Timestamp (Unix epoch seconds)
+    timestamp = int(time() if timestamp is None else timestamp)  # Timestamp (Unix epoch seconds)
     match = [p1_id, p2_id, winner, p1total, p2total, timestamp]
 
     return mode, status, match
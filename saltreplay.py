@@ -0,0 +1,192 @@
+""" Offline replay of recorded states.
+Streams states from the old full_state_log.txt (one "mode status str(state)" line per state) or from saltlog's
+JSON Lines logs back through saltprocessing.process_state and saltstorage.act_on_processed_state, as fast as
+they can be parsed, to rebuild the match history or to check parser changes against real data.
+Logs are read line by line, so they can hold millions of states. Recorded timestamps come from a simulated
+clock: the receive time for saltlog records, and evenly spaced times for full_state_log.txt, which has none.
+
+Usage: python saltreplay.py data_directory [backend] log1 [log2 ...]
+Regenerates the player dictionaries and match history of the given backend in data_directory from the logs,
+oldest first. Player IDs are reassigned in order of appearance, so retrain the player stats afterwards.
+"""
+
+import sys
+import os
+import ast
+import gzip
+import glob
+import itertools
+from time import time
+import saltprocessing as sp
+import saltstorage as ss
+import saltlog as sl
+
+SIMULATED_STATE_INTERVAL = 60   # Seconds between states in logs without timestamps (about 3 per match)
+SAVE_EVERY = 100000   # Matches held in memory before they are appended to the store
+PROGRESS_EVERY = 100000   # States between progress reports
+QUIET = True   # Silence the per-match printing of saltstorage while replaying
+
+
+def open_log(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rt')
+    return open(filename, 'r')
+
+
+def count_lines(filename):
+    num_lines = 0
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rb') as infile:
+        for block in iter(lambda: infile.read(1024*1024), b''):
+            num_lines += block.count(b'\n')
+    return num_lines
+
+
+def read_full_state_log(filename, start_time=None, interval=SIMULATED_STATE_INTERVAL):
+    # Yields (timestamp, logged mode, logged status, state). Without a start time the simulated clock is set
+    # so the last state lands on the file's modification time. Unparseable lines yield a state of None.
+    if start_time is None:
+        start_time = os.path.getmtime(filename) - interval*count_lines(filename)
+    # Parsing dominates, so a line repeating the previous state reuses its parse.
+    clock = start_time
+    previous_text, previous_state = None, None
+    with open_log(filename) as infile:
+        for line in infile:
+            parts = line.rstrip('\n').split(' ', 2)
+            clock += interval
+            if len(parts) < 3:
+                yield clock, None, None, None
+                continue
+            if parts[2] != previous_text:
+                try:
+                    state = ast.literal_eval(parts[2])
+                except (ValueError, SyntaxError):
+                    state = None
+                previous_text, previous_state = parts[2], state if isinstance(state, dict) else None
+            yield clock, parts[0], parts[1], previous_state
+
+
+def read_json_state_log(filename):
+    # Yields (timestamp, logged mode, logged status, state) from one saltlog segment
+    for record in sl.read_state_log(filename):
+        yield record.get('received'), record.get('mode'), record.get('status'), record.get('state')
+
+
+def state_log_segments(filename):
+    # A saltlog log and its rotated segments, oldest first (filename.N.gz is older the larger N is)
+    def segment_number(segment):
+        number = segment[len(filename)+1:].split('.')[0]
+        return int(number) if number.isdigit() else 0
+    segments = sorted(glob.glob(filename + '.*'), key=segment_number, reverse=True)
+    return [segment for segment in segments if segment_number(segment) > 0] + ([filename] if os.path.isfile(filename) else [])
+
+
+def read_states(filename, start_time=None):
+    # Picks the reader from the file contents: saltlog records start with '{'
+    with open_log(filename) as infile:
+        first = infile.read(1)
+    if first == '{':
+        return read_json_state_log(filename)
+    return read_full_state_log(filename, start_time)
+
+
+def replay_states(records, results=None, save_every=SAVE_EVERY):
+    # Feed (timestamp, logged mode, logged status, state) records through the processing pipeline.
+    # A state identical to the previous one (a redundant notification) is skipped, so no result is recorded twice.
+    if results is None:
+        results = {'states': 0, 'unparseable': 0, 'duplicates': 0, 'matches': 0, 'reclassified': 0, 'counts': {}}
+    previous = None
+    matches_since_save = 0
+    for timestamp, logged_mode, logged_status, state in records:
+        results['states'] += 1
+        if results['states'] % PROGRESS_EVERY == 0:
+            report_progress(results)
+        if state is None:
+            results['unparseable'] += 1
+            continue
+        if state == previous:
+            results['duplicates'] += 1
+            continue
+        previous = state
+        try:
+            mode, status, match = sp.process_state(state, timestamp=timestamp)
+        except (KeyError, ValueError, AttributeError):
+            results['unparseable'] += 1
+            continue
+        key = mode + status
+        results['counts'][key] = results['counts'].get(key, 0) + 1
+        # States the current parser reads differently than it did when they were logged
+        if logged_mode is not None and (logged_mode, logged_status) != (mode, status):
+            results['reclassified'] += 1
+        num_matches = len(ss.matches)
+        ss.act_on_processed_state(mode, status, match)
+        if len(ss.matches) > num_matches:
+            results['matches'] += 1
+            matches_since_save += 1
+            if save_every and matches_since_save >= save_every:
+                ss.save_persistent_data()
+                matches_since_save = 0
+    return results
+
+
+def report_progress(results):
+    elapsed = time() - results.get('start', time())
+    sys.__stdout__.write('{:d} states, {:d} matches, {:.0f} states/s\n'.format(results['states'], results['matches'], results['states']/elapsed if elapsed > 0 else 0))
+    sys.__stdout__.flush()
+
+
+def replay_logs(filenames, start_time=None, save_every=SAVE_EVERY):
+    # Replay the logs in order into whatever match history saltstorage currently holds, then save it
+    results = {'states': 0, 'unparseable': 0, 'duplicates': 0, 'matches': 0, 'reclassified': 0, 'counts': {}, 'start': time()}
+    logging_enabled, online_updates, journal_enabled = sl.ENABLED, ss.ONLINE_UPDATES, ss.JOURNAL_ENABLED
+    # Replayed states must not be logged again, stats get retrained, and the store is saved explicitly
+    sl.ENABLED, ss.ONLINE_UPDATES, ss.JOURNAL_ENABLED = False, False, False
+    stdout = sys.stdout
+    if QUIET:
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        # One stream, so a state repeated across a segment boundary is still a duplicate
+        replay_states(itertools.chain.from_iterable(read_states(filename, start_time) for filename in filenames), results, save_every)
+        ss.save_persistent_data()
+    finally:
+        if QUIET:
+            sys.stdout.close()
+            sys.stdout = stdout
+        sl.ENABLED, ss.ONLINE_UPDATES, ss.JOURNAL_ENABLED = logging_enabled, online_updates, journal_enabled
+    results['seconds'] = time() - results.pop('start')
+    results['per_second'] = results['states']/results['seconds'] if results['seconds'] > 0 else None
+    return results
+
+
+def regenerate_match_store(directory, filenames, backend_name='file', start_time=None):
+    # Rebuild the players and matches of a backend from the logs. Existing bets are kept.
+    ss.DATA_DIRECTORY = directory
+    ss.SQLITE_FILENAME = os.path.join(directory, os.path.basename(ss.SQLITE_FILENAME))
+    ss.use_backend(backend_name)
+    ss.set_player_registry(ss.PlayerRegistry())
+    ss.matches = []
+    ss.open_bets()
+    results = replay_logs(filenames, start_time)
+    print('{:d} states replayed in {:.1f}s ({:.0f} states/s)'.format(results['states'], results['seconds'], results['per_second'] or 0))
+    print('{:d} match results and {:d} characters recorded; {:d} duplicate and {:d} unparseable states skipped'.format(
+        results['matches'], len(ss.player_id_dict), results['duplicates'], results['unparseable']))
+    if results['reclassified']:
+        print('{:d} states now identified differently than when they were logged'.format(results['reclassified']))
+    for key in sorted(results['counts']):
+        print('  mode {} status {}: {:d}'.format(key[0], key[1], results['counts'][key]))
+    return results
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+    directory, args = sys.argv[1], sys.argv[2:]
+    backend_name = 'file'
+    if args[0] in ('file', 'sqlite'):
+        backend_name, args = args[0], args[1:]
+    filenames = []
+    for filename in args:
+        # A saltlog log brings its rotated segments along
+        filenames.extend(state_log_segments(filename) if filename.endswith('.jsonl') else [filename])
+    regenerate_match_store(directory, filenames, backend_name)
@@ -3,8 +3,20 @@ Player dictionaries, match histories, betting histories, etc.
 """
 
 import os
-import pickle
+import json
+import threading
+import traceback
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+from time import time
 import saltprocessing as sp
+import saltbackends as sbk
 import numpy as np
 
 # If Python 2.x, change default string encoding to utf-8
@@ -13,113 +25,637 @@ if sys.version_info[0]==2:
     reload(sys)
     sys.setdefaultencoding('utf-8')
 
-MATCHES_FILENAME = 'matches.p'
+# Persistent data lives in the backend chosen here: 'file' (append-only logs plus the stats file, in
+# DATA_DIRECTORY) or 'sqlite' (one database, SQLITE_FILENAME). Change before loading anything.
+STORAGE_BACKEND = 'file'
+DATA_DIRECTORY = '.'
+SQLITE_FILENAME = 'saltwatch.db'
+COMPRESS_OLD_MATCH_SHARDS = False   # File backend: gzip monthly match shards once the month is over
+backend = None
+
+# Match and bet histories are History objects: saved records are only read from the backend on first
+# access, so loading and appending stay cheap however long the histories get
 matches = []
 
-PLAYERS_FILENAME = 'players.p'
+# The registry is the source of truth; the two dicts are its name -> ID dict and ID -> name view
+player_registry = None
 player_id_dict, player_name_dict = {}, {}
+num_saved_players = 0
 
-RANKS_FILENAME = 'ranks.p'
-ranks = {}
-wins = {}
-losses = {}
-times_seen = {}
-acc = {}
-tpr = {}
-tnr = {}
+# Player stats are one structured array indexed by player ID (fields in saltbackends.PLAYER_STATS_DTYPE).
+# player_stats_version is the model version they came from; a retrain saves a new version.
+player_stats = sbk.empty_player_stats()
+player_stats_version = None
+player_stats_lock = threading.RLock()   # Online updates and reloads replace the array from different threads
 
-BETS_FILENAME = 'bets.p'
 bets = []
 
-TEMP_FILENAME = 'tmp.p'
+# Write-ahead journal: every added match, bet and player is appended here as one JSON line, so a crash
+# loses nothing since the last snapshot. load_persistent_data replays it, save_persistent_data truncates it.
+JOURNAL_FILENAME = 'journal.log'
+JOURNAL_FSYNC_PERIOD = 1.   # Seconds between fsyncs; entries are flushed to the OS immediately
+JOURNAL_ENABLED = True   # Bulk rebuilds (saltreplay) save explicitly and can skip it
+journal_file = None
+last_journal_fsync = 0
+journal_lock = threading.RLock()   # Held over journaling and adding a record, and over taking a save snapshot
+
+# Background persistence: save_persistent_data_async snapshots what needs saving on the calling thread and
+# writes it on a persistence thread, so a slow save never blocks the websocket handler. One save at a time.
+persistence_queue = None
+persistence_thread = None
+save_in_progress = False
+
+# Online updates: every recorded match immediately nudges the in-memory ranks and counters, so ratings
+# stay fresh between full retrains. Nothing is written to disk.
+ONLINE_UPDATES = True
+ONLINE_K_FACTOR = 16.   # Rank change for a completely unexpected result
+
+
+def get_backend():
+    global backend
+    if backend is None:
+        if STORAGE_BACKEND == 'file':
+            backend = sbk.FileBackend(DATA_DIRECTORY, compress_old_shards=COMPRESS_OLD_MATCH_SHARDS)
+        elif STORAGE_BACKEND == 'sqlite':
+            backend = sbk.SQLiteBackend(SQLITE_FILENAME)
+        else:
+            raise ValueError('Unknown storage backend: {}'.format(STORAGE_BACKEND))
+    return backend
+
+
+def use_backend(name):
+    # Switch backends. Anything already loaded stays in memory; use migrate_to_backend to copy it over.
+    global STORAGE_BACKEND, backend
+    if backend is not None:
+        backend.close()
+    STORAGE_BACKEND = name
+    backend = None
+    return get_backend()
+
+
+def migrate_to_backend(name):
+    # Copy all persistent data from the current backend into a fresh one and keep using the new one
+    global matches, bets
+    load_persistent_data()
+    load_player_stats()
+    use_backend(name)
+    set_player_registry(get_player_registry())
+    save_dictionaries()
+    # Plain copies get written in full
+    matches = np.asarray(matches)
+    save_matches()
+    bets = list(bets)
+    save_bets()
+    save_player_stats()
+
 
 def load_persistent_data():
     load_dictionaries()
     load_matches()
     load_bets()
+    replay_journal()
 
 
 def save_persistent_data():
-    save_dictionaries()
-    save_matches()
-    save_bets()
+    wait_for_persistence()
+    prepare_persistent_data_save()()
+
+
+def prepare_persistent_data_save():
+    # Cheap snapshot of everything not yet saved, taken on the calling thread. Returns the function that
+    # writes it, which may run on another thread while new matches, bets and players keep arriving.
+    # Records are journaled and added under journal_lock, so each one lands in exactly one of the snapshot
+    # (and its rotated journal segment) or the new journal segment.
+    with journal_lock:
+        rotate_journal()
+        writers = [prepare_save_dictionaries(), prepare_save_matches(), prepare_save_bets()]
+    def write():
+        # A failed part puts its records back; the others still get saved
+        failure = None
+        for writer in writers:
+            try:
+                writer()
+            except Exception as e:
+                print('Save failed: {}'.format(e))
+                failure = failure or e
+        if failure is not None:
+            raise failure
+        # Everything journaled before the snapshot is now saved
+        remove_saved_journal()
+    return write
+
+
+def save_persistent_data_async():
+    # Returns False if the previous background save has not finished yet
+    global save_in_progress
+    if save_in_progress:
+        print('Previous save still in progress, skipping')
+        return False
+    write = prepare_persistent_data_save()
+    save_in_progress = True
+    def save():
+        global save_in_progress
+        try:
+            write()
+        finally:
+            save_in_progress = False
+    submit_persistence_job(save)
+    return True
+
+
+def reload_player_stats_async():
+    # New stats are loaded on the persistence thread and swapped in whole
+    submit_persistence_job(lambda: load_player_stats(only_if_changed=True))
+
+
+def submit_persistence_job(job):
+    global persistence_queue, persistence_thread
+    if persistence_thread is None:
+        persistence_queue = queue.Queue()
+        persistence_thread = threading.Thread(target=run_persistence_thread, name='saltstorage-persistence')
+        persistence_thread.daemon = True
+        persistence_thread.start()
+    persistence_queue.put(job)
+
+
+def run_persistence_thread():
+    while True:
+        job = persistence_queue.get()
+        try:
+            job()
+        except Exception:
+            # Report and keep going; anything unsaved stays pending and journaled for the next save
+            print('Background persistence failed:')
+            traceback.print_exc()
+        finally:
+            persistence_queue.task_done()
+
+
+def wait_for_persistence():
+    # Block until all submitted background saves and reloads are done
+    if persistence_queue is not None:
+        persistence_queue.join()
+
+
+def get_journal_filename():
+    return os.path.join(DATA_DIRECTORY, JOURNAL_FILENAME)
+
+
+def write_journal_entry(entry):
+    global journal_file, last_journal_fsync
+    if not JOURNAL_ENABLED:
+        return
+    line = json.dumps(entry) + '\n'
+    with journal_lock:
+        if journal_file is None:
+            journal_file = open(get_journal_filename(), 'a')
+            # Start on a fresh line after an entry torn by a crash, so this one is not lost with it
+            if journal_file.tell() > 0 and not journal_ends_with_newline():
+                journal_file.write('\n')
+        journal_file.write(line)
+        journal_file.flush()
+        if time() - last_journal_fsync > JOURNAL_FSYNC_PERIOD:
+            sync_journal()
+
+
+def journal_ends_with_newline():
+    with open(get_journal_filename(), 'rb') as infile:
+        infile.seek(-1, os.SEEK_END)
+        return infile.read(1) == b'\n'
+
+
+def sync_journal():
+    global last_journal_fsync
+    if journal_file is not None:
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+    last_journal_fsync = time()
+
+
+def get_saved_journal_filename():
+    # Journal segment covering the save in progress, removed once that save succeeds
+    return get_journal_filename() + '.saving'
+
+
+def rotate_journal():
+    # Start a new journal segment at a save snapshot
+    global journal_file
+    with journal_lock:
+        if journal_file is not None:
+            sync_journal()
+            journal_file.close()
+            journal_file = None
+        filename = get_journal_filename()
+        saved_filename = get_saved_journal_filename()
+        if not os.path.isfile(filename):
+            return
+        if os.path.isfile(saved_filename):
+            # A failed save left its segment behind; it still has to cover this snapshot
+            with open(filename, 'r') as infile:
+                entries = infile.read()
+            with open(saved_filename, 'a') as outfile:
+                outfile.write('\n' + entries)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            os.remove(filename)
+        else:
+            os.rename(filename, saved_filename)
+
+
+def remove_saved_journal():
+    if os.path.isfile(get_saved_journal_filename()):
+        os.remove(get_saved_journal_filename())
+
+
+def replay_journal():
+    # Re-apply journaled events on top of the loaded snapshot. Matches and bets carry their position in
+    # the history, so events that already made it into the snapshot are skipped.
+    # The segment of an interrupted save comes first.
+    for filename in [get_saved_journal_filename(), get_journal_filename()]:
+        if not os.path.isfile(filename):
+            continue
+        num_players, num_matches, num_bets = 0, 0, 0
+        with open(filename, 'r') as infile:
+            for line in infile:
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    print('Ignoring incomplete journal entry: {}'.format(line.strip()))
+                    continue
+                if entry['type'] == 'player' and entry['name'] not in player_id_dict:
+                    get_player_registry().add(entry['name'], entry['id'])
+                    num_players += 1
+                elif entry['type'] == 'match' and entry['index'] >= len(matches):
+                    matches.append(entry['match'])
+                    num_matches += 1
+                elif entry['type'] == 'bet' and entry['index'] >= len(bets):
+                    bets.append(entry['bet'])
+                    num_bets += 1
+        print('{:d} characters, {:d} match results and {:d} bets recovered from {}'.format(num_players, num_matches, num_bets, filename))
+
+
+class PlayerRegistry(object):
+    # Bijection between player names and IDs. New IDs come from a counter, names are kept in a list indexed
+    # by ID (None for unused IDs) and IDs in a dict keyed by name, so lookups and inserts are O(1) both ways
+    # and a name can never end up with two IDs, or an ID with two names.
+
+    def __init__(self, names=()):
+        self.names = []
+        self.ids = {}
+        self.name_dict = PlayerNameView(self)
+        for pid, name in enumerate(names):
+            if name is not None:
+                self.add(name, pid)
+
+    @classmethod
+    def from_dicts(cls, pid_dict, pname_dict):
+        registry = cls()
+        for pid in sorted(pname_dict.keys()):
+            registry.add(pname_dict[pid], pid)
+        if len(registry.ids) != len(pid_dict) or any(registry.ids.get(name) != pid for name, pid in pid_dict.items()):
+            raise ValueError('Player dictionaries are not a bijection')
+        return registry
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def add(self, name, pid=None):
+        # Assign the next ID, or a specific unused one
+        if name in self.ids:
+            raise ValueError('{} already has ID {:d}'.format(name, self.ids[name]))
+        if pid is None:
+            pid = len(self.names)
+        elif pid < len(self.names) and self.names[pid] is not None:
+            raise ValueError('ID {:d} already belongs to {}'.format(pid, self.names[pid]))
+        if pid >= len(self.names):
+            self.names.extend([None]*(pid+1-len(self.names)))
+        self.names[pid] = name
+        self.ids[name] = pid
+        return pid
+
+    def get_id(self, name, default=-1):
+        return self.ids.get(name, default)
+
+    def get_name(self, pid):
+        return self.name_dict[pid]
+
+
+class PlayerNameView(Mapping):
+    # Read-only {ID: name} dict interface onto a PlayerRegistry
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def __getitem__(self, pid):
+        names = self.registry.names
+        if isinstance(pid, (int, np.integer)) and 0 <= pid < len(names) and names[pid] is not None:
+            return names[pid]
+        raise KeyError(pid)
+
+    def __iter__(self):
+        return (pid for pid, name in enumerate(self.registry.names) if name is not None)
+
+    def __len__(self):
+        return len(self.registry.ids)
+
+
+def set_player_registry(registry, num_saved=0):
+    global player_registry, player_id_dict, player_name_dict, num_saved_players
+    player_registry = registry
+    player_id_dict, player_name_dict = registry.ids, registry.name_dict
+    num_saved_players = num_saved
+
+
+def get_player_registry():
+    # Adopt dictionaries assigned from outside (e.g. after saltdoc surgery) as a new registry
+    if player_registry is None or player_id_dict is not player_registry.ids:
+        registry = getattr(player_name_dict, 'registry', None)
+        if registry is None or registry.ids is not player_id_dict:
+            registry = PlayerRegistry.from_dicts(player_id_dict, player_name_dict)
+        set_player_registry(registry)
+    return player_registry
 
 
 def save_dictionaries():
-    with open(TEMP_FILENAME, 'wb') as outfile:
-        pickle.dump([player_id_dict, player_name_dict], outfile)
-        os.rename(TEMP_FILENAME, PLAYERS_FILENAME)
-    print('{:d} characters saved'.format(len(player_id_dict)))
+    prepare_save_dictionaries()()
+
+
+def prepare_save_dictionaries():
+    registry = get_player_registry()
+    start = num_saved_players
+    names = registry.names[start:]
+    def write():
+        global num_saved_players
+        if start == 0:
+            get_backend().write_players(names)
+        elif names:
+            # New names cost one append each
+            get_backend().append_players(names, start)
+        if registry is player_registry:
+            num_saved_players = start + len(names)
+        print('{:d} characters saved'.format(start + len(names)))
+    return write
 
 
 def load_dictionaries():
-    global player_id_dict, player_name_dict
-    if os.path.isfile(PLAYERS_FILENAME):
-        player_id_dict, player_name_dict = pickle.load(open(PLAYERS_FILENAME, 'rb'))
+    names = get_backend().load_players()
+    if names is not None:
+        set_player_registry(PlayerRegistry(names), len(names))
         print('{:d} characters loaded'.format(len(player_id_dict)))
     else:
-        print('File {} not found, starting new player dictionaries'.format(PLAYERS_FILENAME))
-        player_id_dict, player_name_dict = {}, {}
+        print('{} not found, starting new player dictionaries'.format(get_backend().describe('players')))
+        set_player_registry(PlayerRegistry())
+
+
+class History(object):
+    # A history as stored by the backend. Saved records are read with loader() on first access and counted
+    # with counter(), new records are held in memory until saved. len() and append() never load the saved
+    # records, so opening a long history costs nothing until something actually reads it.
+    # A save takes the pending records (take_pending) and reports back (finish_saving/abort_saving), so it
+    # can run on another thread while new records keep arriving.
+
+    def __init__(self, loader=None, counter=None):
+        self.loader = loader
+        self.counter = counter
+        self.loaded = None
+        self.num_saved = None
+        self.saving = []    # Taken by a save that has not finished yet
+        self.pending = []
+        self.rewrite = False    # The next save replaces everything in the backend
+        self.lock = threading.RLock()
+
+    @classmethod
+    def replacing(cls, records, loader=None, counter=None):
+        # A history that overwrites the backend's copy with records on the next save
+        history = cls(loader, counter)
+        history.loaded = history.empty()
+        history.num_saved = 0
+        history.pending = list(records)
+        history.rewrite = True
+        return history
+
+    def empty(self):
+        return []
+
+    def get_saved(self):
+        with self.lock:
+            if self.loaded is None:
+                saved = self.loader() if self.loader is not None else None
+                self.loaded = saved if saved is not None else self.empty()
+                self.num_saved = len(self.loaded)
+            return self.loaded
+
+    def unsaved(self):
+        with self.lock:
+            return self.saving + self.pending
+
+    def __len__(self):
+        with self.lock:
+            if self.num_saved is None:
+                self.num_saved = self.counter() if self.counter is not None else len(self.get_saved())
+            return self.num_saved + len(self.saving) + len(self.pending)
+
+    def __iter__(self):
+        for record in self.get_saved():
+            yield record
+        for record in self.unsaved():
+            yield record
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return list(self)[key]
+        if key < 0:
+            key += len(self)
+        saved = self.get_saved()
+        if 0 <= key < len(saved):
+            return saved[key]
+        return self.unsaved()[key-len(saved)]
+
+    def append(self, record):
+        with self.lock:
+            self.pending.append(record)
+
+    def take_pending(self):
+        # Returns (records to save, whether they replace everything saved)
+        with self.lock:
+            self.saving, self.pending = self.pending, []
+            return self.saving, self.rewrite
+
+    def finish_saving(self):
+        with self.lock:
+            self.num_saved = len(self) - len(self.pending)
+            if self.loaded is not None:
+                self.loaded.extend(self.saving)
+            self.saving = []
+            self.rewrite = False
+
+    def abort_saving(self):
+        # Put the records back so the next save tries again
+        with self.lock:
+            self.saving, self.pending = [], self.saving + self.pending
+
+
+class MatchHistory(History):
+    # Match history. Saved records are the (N, 6) array from the backend, or for the file backend a lazy view
+    # over its memory-mapped monthly shards, so iterating and indexing never copy the whole history.
+    # Behaves like the old list of [p1_id, p2_id, winner, p1total, p2total, timestamp] lists; np.asarray()
+    # gives the (N, 6) array, which is a copy once the history spans several shards.
+
+    def empty(self):
+        return np.zeros((0, sbk.MATCH_FIELDS), dtype=sbk.MATCH_DTYPE)
+
+    def __iter__(self):
+        saved = self.get_saved()
+        for start in range(0, len(saved), 65536):
+            for match in saved[start:start+65536].tolist():
+                yield match
+        for match in self.unsaved():
+            yield list(match)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return np.asarray(self)[key].tolist()
+        match = History.__getitem__(self, key)
+        return match.tolist() if isinstance(match, np.ndarray) else list(match)
+
+    def __array__(self, dtype=None, copy=None):
+        with self.lock:
+            array = np.asarray(self.get_saved())
+            unsaved = self.unsaved()
+        if unsaved:
+            array = np.concatenate((array, sbk.as_match_records(unsaved)))
+        if dtype is not None:
+            array = array.astype(dtype)
+        return array
+
+    def finish_saving(self):
+        # Reloaded from the backend on next access rather than copying the saved records
+        with self.lock:
+            self.num_saved = len(self) - len(self.pending)
+            self.loaded = None
+            self.saving = []
+            self.rewrite = False
 
 
 def save_matches():
-    with open(TEMP_FILENAME, 'wb') as outfile:
-        pickle.dump(matches, outfile)
-        os.rename(TEMP_FILENAME, MATCHES_FILENAME)
-    print('{:d} match results saved'.format(len(matches)))
+    prepare_save_matches()()
+
+
+def prepare_save_matches():
+    global matches
+    if not isinstance(matches, MatchHistory):
+        # A replaced match list (e.g. after saltdoc surgery) is written in full
+        matches = MatchHistory.replacing(matches, get_backend().load_matches, get_backend().count_matches)
+    return prepare_save_history(matches, get_backend().write_matches, get_backend().append_matches, 'match results')
+
+
+def prepare_save_history(history, write_records, append_records, description):
+    # Only the records added since the last save are written
+    records, rewrite = history.take_pending()
+    def write():
+        try:
+            if rewrite:
+                write_records(records)
+            elif records:
+                append_records(records)
+        except Exception:
+            history.abort_saving()
+            raise
+        history.finish_saving()
+        print('{:d} new {} saved, {:d} total'.format(len(records), description, len(history)))
+    return write
+
+
+def open_matches():
+    global matches
+    matches = MatchHistory(loader=get_backend().load_matches, counter=get_backend().count_matches)
 
     
 def load_matches():
-    global matches
-    if os.path.isfile(MATCHES_FILENAME):
-        matches = pickle.load(open(MATCHES_FILENAME, 'rb'))
-        print('{:d} match results loaded'.format(len(matches)))
-    else:
-        print('File {} not found, starting new match history'.format(MATCHES_FILENAME))
-        matches = []
+    open_matches()
+    print('{:d} match results available'.format(len(matches)))
+
+
+def query_matches(pid=None, since=None, until=None):
+    # Saved and unsaved matches involving pid (if given) with since <= timestamp < until, as an (N, 6) array.
+    # Answered by the backend without loading the full history.
+    saved = get_backend().query_matches(pid=pid, since=since, until=until)
+    if isinstance(matches, MatchHistory) and matches.unsaved():
+        saved = np.concatenate((saved, sbk.select_matches(sbk.as_match_records(matches.unsaved()), pid=pid, since=since, until=until)))
+    return saved
+
+
+def recent_matches(num_matches):
+    # The last num_matches matches, saved or not, as an (N, 6) array. Only the newest shards are read.
+    unsaved = matches.unsaved() if isinstance(matches, MatchHistory) else []
+    if len(unsaved) >= num_matches:
+        return sbk.as_match_records(unsaved[len(unsaved)-num_matches:])
+    saved = get_backend().recent_matches(num_matches - len(unsaved))
+    if unsaved:
+        saved = np.concatenate((saved, sbk.as_match_records(unsaved)))
+    return saved
 
 
 def save_player_stats():
-    with open(TEMP_FILENAME, 'wb') as outfile:
-        pickle.dump([ranks, wins, losses, times_seen, acc, tpr, tnr], outfile)
-        os.rename(TEMP_FILENAME, RANKS_FILENAME)
-    if not (len(ranks) == len(wins) == len(losses) == len(times_seen) == len(acc) == len(tpr) == len(tnr)):
-        print('Stat list length mismatch!', len(ranks), len(wins), len(losses), len(times_seen), len(acc), len(tpr), len(tnr))
-    print('{:d} players\' stats saved'.format(len(ranks)))
-
-
-def load_player_stats():
-    global ranks, wins, losses, times_seen, acc, tpr, tnr
-    if os.path.isfile(RANKS_FILENAME):
-        ranks, wins, losses, times_seen, acc, tpr, tnr = pickle.load(open(RANKS_FILENAME, 'rb'))
-        if not (len(ranks) == len(wins) == len(losses) == len(times_seen) == len(acc) == len(tpr) == len(tnr)):
-            print('Stat list length mismatch!', len(ranks), len(wins), len(losses), len(times_seen), len(acc), len(tpr), len(tnr))
-        print('{:d} players\' stats loaded'.format(len(ranks)))
-    else:
-        print('File {} not found'.format(RANKS_FILENAME))
-        ranks, wins, losses, times_seen, acc, tpr, tnr = {}, {}, {}, {}, {}, {}, {}
+    global player_stats_version
+    player_stats_version = get_backend().save_player_stats(player_stats)
+    print('{:d} players\' stats saved (model version {})'.format(np.count_nonzero(player_stats['known']), player_stats_version))
+
+
+def load_player_stats(only_if_changed=False):
+    global player_stats, player_stats_version
+    # Skip reloading unchanged stats, which would also discard any online updates
+    if only_if_changed and get_backend().player_stats_version() == player_stats_version:
+        return
+    loaded = get_backend().load_player_stats()
+    with player_stats_lock:
+        if loaded is not None:
+            # Swap in the whole array at once, so readers never see a mix of old and new stats
+            player_stats, player_stats_version = loaded
+            print('{:d} players\' stats loaded (model version {})'.format(np.count_nonzero(player_stats['known']), player_stats_version))
+        else:
+            print('{} not found'.format(get_backend().describe('stats')))
+            player_stats, player_stats_version = sbk.empty_player_stats(), None
+
+
+def get_player_stats(pid):
+    # The player's stats record, or None if the player has no stats
+    if 0 <= pid < len(player_stats) and player_stats['known'][pid]:
+        return player_stats[pid]
+    return None
 
 
 def save_bets():
-    with open(TEMP_FILENAME, 'wb') as outfile:
-        pickle.dump(bets, outfile)
-        os.rename(TEMP_FILENAME, BETS_FILENAME)
-    print('{:d} past bets saved'.format(len(bets)))
+    prepare_save_bets()()
 
 
-def load_bets():
+def prepare_save_bets():
     global bets
-    if os.path.isfile(BETS_FILENAME):
-        bets = pickle.load(open(BETS_FILENAME, 'rb'))
-        print('{:d} past bets loaded'.format(len(bets)))
-    else:
-        print('File {} not found, starting new bet history'.format(BETS_FILENAME))
-        bets = []
+    if not isinstance(bets, History):
+        bets = History.replacing(bets, get_backend().load_bets, get_backend().count_bets)
+    return prepare_save_history(bets, get_backend().write_bets, get_backend().append_bets, 'bets')
+
+
+def open_bets():
+    global bets
+    bets = History(loader=get_backend().load_bets, counter=get_backend().count_bets)
+
+
+def load_bets():
+    open_bets()
+    print('{:d} past bets available'.format(len(bets)))
 
 
 def add_match(match):
     global matches 
-    matches.append(match)
+    with journal_lock:
+        write_journal_entry({'type': 'match', 'index': len(matches), 'match': [int(x) for x in match]})
+        matches.append(match)
 
 
 def add_bet(new_bet):
@@ -128,49 +664,79 @@ def add_bet(new_bet):
     # Remove any numpy data types from bet
     for i, item in enumerate(bet):
         if isinstance(item, np.generic):
-            bet[i] = np.asscalar(bet[i])
-    bets.append(bet)
+            bet[i] = bet[i].item()
+    with journal_lock:
+        write_journal_entry({'type': 'bet', 'index': len(bets), 'bet': bet})
+        bets.append(bet)
  
 
 def replace_player_stats(new_ranks, new_wins, new_losses, new_times_seen, new_acc, new_tpr, new_tnr):
-    global ranks, wins, losses, times_seen, acc, tpr, tnr
-    # Remove any numpy data types from ranks
-    ranks = new_ranks
-    for key in ranks:
-        if isinstance(ranks[key], np.generic):
-            ranks[key] = np.asscalar(ranks[key])
-    wins = new_wins
-    losses = new_losses
-    times_seen = new_times_seen
-    acc = new_acc
-    tpr = new_tpr
-    tnr = new_tnr
+    global player_stats
+    new_stats = sbk.player_stats_from_dicts([new_ranks, new_wins, new_losses, new_times_seen, new_acc, new_tpr, new_tnr])
+    with player_stats_lock:
+        player_stats = new_stats
+
+
+def merge_player_stats(new_ranks, new_wins, new_losses, new_times_seen, new_acc, new_tpr, new_tnr):
+    # Like replace_player_stats, but players missing from new_ranks keep their current stats
+    global player_stats
+    new_stats = sbk.player_stats_from_dicts([new_ranks, new_wins, new_losses, new_times_seen, new_acc, new_tpr, new_tnr])
+    with player_stats_lock:
+        merged = sbk.empty_player_stats(max(len(player_stats), len(new_stats)))
+        merged[:len(player_stats)] = player_stats
+        retrained = np.flatnonzero(new_stats['known'])
+        merged[retrained] = new_stats[retrained]
+        player_stats = merged
 
 
 def get_player_id_by_name(pname):
-    try:
-        return player_id_dict[pname]
-    except KeyError:
-        return -1
+    return player_id_dict.get(pname, -1)
 
 
 def assign_new_player_id(pname):
-    global player_id_dict
-    global player_name_dict
-
-    if player_id_dict:
-        new_id = max(player_id_dict.values())+1
-    else:
-        new_id = 0
-    player_id_dict[pname] = new_id
-    player_name_dict[new_id] = pname
+    with journal_lock:
+        registry = get_player_registry()
+        new_id = len(registry.names)
+        write_journal_entry({'type': 'player', 'id': new_id, 'name': pname})
+        registry.add(pname, new_id)
     print('{} assigned to ID {:d}'.format(pname, new_id))
 
     return new_id
 
 
+def update_player_stats_online(match):
+    # One stochastic gradient step of the rank model on a single result (an Elo update), plus the
+    # win/loss/appearance counters. New players start at the average rank.
+    # Applied under player_stats_lock to whichever stats are current, so a reload is never overwritten.
+    global player_stats
+    p1_id, p2_id, winner = match[0], match[1], match[2]
+    with player_stats_lock:
+        if max(p1_id, p2_id) >= len(player_stats):
+            player_stats = np.concatenate((player_stats, sbk.empty_player_stats(max(p1_id, p2_id)+1-len(player_stats))))
+        for pid in (p1_id, p2_id):
+            if not player_stats['known'][pid]:
+                known = player_stats['known']
+                player_stats['rank'][pid] = player_stats['rank'][known].mean() if known.any() else 0.
+                player_stats['known'][pid] = True
+        # pred is the predicted probability that p2 wins, matching saltmind.predict_one_outcome
+        rank = player_stats['rank']
+        pred = 1./(1+10**((rank[p1_id]-rank[p2_id])/400.))
+        step = ONLINE_K_FACTOR*(winner-pred)
+        rank[p1_id] -= step
+        rank[p2_id] += step
+
+        winner_id = match[winner]
+        loser_id = match[1-winner]
+        player_stats['wins'][winner_id] += 1
+        player_stats['losses'][loser_id] += 1
+        player_stats['times_seen'][winner_id] += 1
+        player_stats['times_seen'][loser_id] += 1
+
+
 def act_on_processed_state(mode, status, match):
     if mode == sp.MATCHMAKING or mode == sp.TOURNAMENT:
         if status == sp.RESULTS:
             add_match(match)
+            if ONLINE_UPDATES:
+                update_player_stats_online(match)
             print(mode+' match saved: '+str(match)+'\n')
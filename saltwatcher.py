@@ -1,10 +1,12 @@
 import websocket
-from time import time, sleep
+import asyncio
+from time import time
 import sys
+import traceback
 try:
     import httplib
 except ImportError:
-    import http.client as httplib 
+    import http.client as httplib
 import saltprocessing as sp
 import saltstorage as ss
 import saltbettor as sb
@@ -19,98 +21,197 @@ last_state_check = 0 # Start with no cooldown
 last_data_write = 0
 last_stats_load = 0
 
+# Timeouts (seconds) for the blocking calls the event loop hands to worker threads
+CONNECT_TIMEOUT = 15.
+SOCKET_READ_TIMEOUT = 90.   # Keepalives arrive well within this, so silence means a dead connection
+STATE_FETCH_TIMEOUT = 10.
+BET_TIMEOUT = 30.
 
-def on_message(ws, message):
-    print(message)
-    global last_state_check, last_data_write, last_stats_load
-    
-    # Check if we're due to save data to disk
-    if time() - last_data_write > DATA_WRITE_PERIOD:
-        ss.save_persistent_data()
-        last_data_write = time()
-
-    # Check if we're due to reload the player stats
-    if time() - last_stats_load > STATS_RELOAD_PERIOD:
-        ss.load_player_stats()
-        last_stats_load = time()
-    
-    # Echo keepalive message
-    if message == u'2::':
-        ws.send(message)
-    # Handle state change notifications, which sometimes come in redundant pairs
-    if message == u'3::':
-        if time() - last_state_check > STATE_CHECK_COOLDOWN:
-            state = sp.get_state()
-            last_state_check = time()
-            print(state)
-            mode, status, match = sp.process_state(state)  
-
-            # Explicitly have saltstorage and saltbettor react to the update
-            ss.act_on_processed_state(mode, status, match)
-            sb.act_on_processed_state(mode, status, match)
-
-
-def on_error(ws, error):
-    print(error)
+SERVER = 'www-cdn-twitch.saltybet.com'
+PORT = 1337
 
 
-def on_close(ws):
-    ss.save_persistent_data()
-    last_data_write = time()
-    print("### closed ###")
+# The watcher runs on an asyncio event loop as separate tasks connected by queues:
+#   read_socket   socket.io reader: echoes keepalives, queues state change notifications (one per connection)
+#   fetch_states  fetches and processes the new state, hands it to the storage and bet queues
+#   store_states  records results in saltstorage, on a worker thread since it writes the journal
+#   place_bets    displays stats and bets, one bet at a time; a waiting open state is skipped if a newer one follows
+#   maintain      periodic background saves and stats reloads
+# watch() restarts any of these that dies, and reconnects the reader after a cooldown when the connection drops.
 
 
-
-def on_open(ws):
-    print("### open ###")
+def run_blocking(function, *args):
+    return asyncio.get_event_loop().run_in_executor(None, function, *args)
 
 
 def connect(server, port):
     print("connecting to: %s:%d" %(server, port))
 
-    conn  = httplib.HTTPConnection(server + ":" + str(port))
+    conn  = httplib.HTTPConnection(server + ":" + str(port), timeout=CONNECT_TIMEOUT)
     conn.request('POST','/socket.io/1/')
     resp  = conn.getresponse()
     hskey = resp.read().decode('utf-8').split(':')[0]
 
-    ws = websocket.WebSocketApp(
-            'ws://'+server+':'+str(port)+'/socket.io/1/websocket/'+hskey,
-                    on_open   = on_open,
-                    on_message = on_message,
-                    on_close = on_close)
-    
+    ws = websocket.create_connection('ws://'+server+':'+str(port)+'/socket.io/1/websocket/'+hskey, timeout=CONNECT_TIMEOUT)
+    ws.settimeout(SOCKET_READ_TIMEOUT)
     return ws
 
 
+async def read_socket(ws, notifications):
+    while True:
+        message = await run_blocking(ws.recv)
+        print(message)
+        if not message:
+            raise websocket.WebSocketConnectionClosedException('Connection closed by server')
+        # Echo keepalive message
+        if message == u'2::':
+            await run_blocking(ws.send, message)
+        # Handle state change notifications
+        if message == u'3::':
+            notifications.put_nowait(time())
+
+
+async def fetch_states(notifications, storage_queue, bet_queue):
+    global last_state_check
+    while True:
+        notified = await notifications.get()
+        # Notifications sometimes come in redundant pairs. Compare when they arrived, not when they are
+        # handled, so a backlog does not make distinct notifications look redundant or vice versa.
+        if notified - last_state_check <= STATE_CHECK_COOLDOWN:
+            continue
+        last_state_check = notified
+        try:
+            state = await asyncio.wait_for(run_blocking(sp.get_state), STATE_FETCH_TIMEOUT)
+            print(state)
+            print('State fetched in {:.0f} ms'.format(sp.get_state_latency_stats().get('last', 0)))
+            # Parsing results can assign new player IDs, which writes the journal
+            processed = await run_blocking(sp.process_state, state)
+        except asyncio.TimeoutError:
+            print('State fetch timed out after {:.0f}s'.format(STATE_FETCH_TIMEOUT))
+            continue
+        except Exception as e:
+            print('State fetch failed: {}'.format(e))
+            continue
+        storage_queue.put_nowait(processed)
+        bet_queue.put_nowait(processed)
+
+
+async def store_states(storage_queue):
+    while True:
+        mode, status, match = await storage_queue.get()
+        try:
+            # Journal writes and fsyncs happen here, so keep them off the event loop
+            await run_blocking(ss.act_on_processed_state, mode, status, match)
+        except Exception as e:
+            print('Storing state failed: {}'.format(e))
+
+
+async def place_bets(bet_queue):
+    betting = None
+    while True:
+        processed = await bet_queue.get()
+        if betting is not None:
+            # A bet that timed out keeps running on its thread; never run two at once
+            try:
+                await betting
+            except Exception as e:
+                print('Betting failed: {}'.format(e))
+            betting = None
+        # A newer state makes a waiting open state moot. Locked and results states are always acted on,
+        # since they settle the open bet and refresh the balance.
+        while processed[1] == sp.OPEN and not bet_queue.empty():
+            processed = bet_queue.get_nowait()
+        betting = run_blocking(sb.act_on_processed_state, *processed)
+        try:
+            await asyncio.wait_for(asyncio.shield(betting), BET_TIMEOUT)
+        except asyncio.TimeoutError:
+            print('Betting timed out after {:.0f}s'.format(BET_TIMEOUT))
+            continue
+        except Exception as e:
+            print('Betting failed: {}'.format(e))
+        betting = None
+
+
+async def maintain():
+    global last_data_write, last_stats_load
+    while True:
+        try:
+            # Check if we're due to save data to disk. The write happens on saltstorage's persistence thread.
+            if time() - last_data_write > DATA_WRITE_PERIOD:
+                if ss.save_persistent_data_async():
+                    last_data_write = time()
+
+            # Check if we're due to reload the player stats (only picked up if a retrain rewrote them), also off-thread
+            if time() - last_stats_load > STATS_RELOAD_PERIOD:
+                ss.reload_player_stats_async()
+                last_stats_load = time()
+        except Exception as e:
+            # Tried again next time round
+            print('Maintenance failed: {}'.format(e))
+        await asyncio.sleep(60)
+
+
+async def supervise(name, start_worker):
+    # Run a worker, restarting it if it ever dies so one unexpected error cannot stop it for good
+    while True:
+        try:
+            await start_worker()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            print('{} failed, restarting it:'.format(name))
+            traceback.print_exc()
+        else:
+            print('{} stopped, restarting it'.format(name))
+        await asyncio.sleep(1)
+
+
+async def watch(server, port):
+    notifications = asyncio.Queue()
+    storage_queue = asyncio.Queue()
+    bet_queue = asyncio.Queue()
+    workers = [asyncio.ensure_future(supervise(name, start_worker)) for name, start_worker in (
+               ('fetch_states', lambda: fetch_states(notifications, storage_queue, bet_queue)),
+               ('store_states', lambda: store_states(storage_queue)),
+               ('place_bets', lambda: place_bets(bet_queue)),
+               ('maintain', maintain))]
+    try:
+        while True:
+            ws = None
+            try:
+                ws = await asyncio.wait_for(run_blocking(connect, server, port), CONNECT_TIMEOUT*2)
+                print("### open ###")
+                await read_socket(ws, notifications)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print('Connection lost: {}'.format(e))
+            finally:
+                if ws is not None:
+                    ws.close()
+                    print("### closed ###")
+            # Retry connection after cooldown period
+            print('Waiting {:d}s to reconnect'.format(CONNECTION_RETRY_COOLDOWN))
+            await asyncio.sleep(CONNECTION_RETRY_COOLDOWN)
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await run_blocking(ss.save_persistent_data)
+
+
 if __name__ == "__main__":
     ss.load_persistent_data()
     last_data_write = time()   # Loading counts as having up-to-date data on disk
-    
+
     ss.load_player_stats()
     last_stats_load = time()
-    
+
     sb.login()
+    sp.start_keep_warm()   # No-op unless sp.KEEP_WARM_PERIOD is set
 
     websocket.enableTrace(True)
-    ws = connect('www-cdn-twitch.saltybet.com', 1337)
-    ws.run_forever()
-    while True:
-        try:
-            # Retry connection after cooldown period
-            print('Waiting {:d}s to reconnect'.format(CONNECTION_RETRY_COOLDOWN))
-            # Attempt reconnect
-            sleep(CONNECTION_RETRY_COOLDOWN)  
-            ws.run_forever()
-        except:
-            break
-            
-
-    #while True:
-    #    try:
-    #        websocket.enableTrace(True)
-    #        ws = connect('www-cdn-twitch.saltybet.com', 1337)
-    #        ws.run_forever()
-    #        break
-    #    except: 
-    #        continue
-
+    try:
+        asyncio.run(watch(SERVER, PORT))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,203 @@
+import os
+import pickle
+import numpy as np
+import pytest
+import saltbackends as sbk
+
+MONTH = 31*24*60*60
+START_TIME = 1420070400   # 2015-01-01 UTC
+
+
+def make_matches(num_matches, start_time=START_TIME, interval=MONTH//4):
+    matches = np.zeros((num_matches, sbk.MATCH_FIELDS), dtype=sbk.MATCH_DTYPE)
+    matches[:,0] = np.arange(num_matches) % 5
+    matches[:,1] = (np.arange(num_matches)+1) % 5
+    matches[:,2] = np.arange(num_matches) % 2
+    matches[:,3] = 100*np.arange(num_matches)
+    matches[:,5] = start_time + interval*np.arange(num_matches)
+    return matches
+
+
+@pytest.fixture
+def backend(tmp_path):
+    return sbk.FileBackend(str(tmp_path))
+
+
+def test_match_log_round_trip_is_memory_mapped(tmp_path):
+    filename = str(tmp_path / 'matches.bin')
+    matches = make_matches(10)
+    sbk.write_match_log(filename, matches[:6])
+    sbk.append_match_log(filename, matches[6:])
+    loaded = sbk.read_match_log(filename)
+    assert isinstance(loaded, np.memmap)
+    assert np.array_equal(loaded, matches)
+    assert sbk.count_match_log(filename) == 10
+
+
+def test_match_log_ignores_and_overwrites_partial_record(tmp_path):
+    filename = str(tmp_path / 'matches.bin')
+    matches = make_matches(3)
+    sbk.write_match_log(filename, matches[:2])
+    with open(filename, 'ab') as outfile:
+        outfile.write(b'\x01\x02\x03')
+    assert np.array_equal(sbk.read_match_log(filename), matches[:2])
+    sbk.append_match_log(filename, matches[2:])
+    assert np.array_equal(sbk.read_match_log(filename), matches)
+
+
+def test_append_shards_by_month(backend):
+    matches = make_matches(12)
+    backend.append_matches(matches[:7])
+    backend.append_matches(matches[7:])
+    months = [month for month, filename in backend.match_shards()]
+    assert months == sorted(set(sbk.match_months(matches)))
+    assert backend.count_matches() == 12
+    assert np.array_equal(np.asarray(backend.load_matches()), matches)
+
+
+def test_load_is_lazy_view_over_shards(backend):
+    matches = make_matches(12)
+    backend.append_matches(matches)
+    loaded = backend.load_matches()
+    assert isinstance(loaded, sbk.ShardedMatchRecords)
+    assert all(part is None for part in loaded.parts)
+    assert len(loaded) == 12
+    assert np.array_equal(loaded[5], matches[5])
+    assert sum(part is not None for part in loaded.parts) == 1
+    assert np.array_equal(loaded[2:9], matches[2:9])
+    assert np.array_equal(loaded[-1], matches[-1])
+    assert np.array_equal(np.array(list(loaded)), matches)
+
+
+def test_compressed_shards_read_and_reopened_for_late_match(backend):
+    matches = make_matches(12)
+    backend.append_matches(matches)
+    backend.compress_shards()
+    shards = backend.match_shards()
+    assert all(filename.endswith('.gz') for month, filename in shards[:-1])
+    assert not shards[-1][1].endswith('.gz')
+    assert backend.count_matches() == 12
+    assert np.array_equal(np.asarray(backend.load_matches()), matches)
+
+    # A late result for a compressed month goes back into an uncompressed shard
+    late = make_matches(1, start_time=int(matches[0,5])+60)
+    backend.append_matches(late)
+    first_month, first_filename = backend.match_shards()[0]
+    assert not first_filename.endswith('.gz')
+    assert len(os.listdir(backend.match_shard_directory)) == len(shards)
+    assert backend.count_matches() == 13
+    assert len(backend.query_matches(since=int(matches[0,5]), until=int(matches[0,5])+MONTH//8)) == 2
+
+
+def test_compress_old_shards_on_append(tmp_path):
+    backend = sbk.FileBackend(str(tmp_path), compress_old_shards=True)
+    backend.append_matches(make_matches(8))
+    shards = backend.match_shards()
+    assert [filename.endswith('.gz') for month, filename in shards] == [True]*(len(shards)-1) + [False]
+
+
+def test_query_and_recent_read_only_needed_shards(backend):
+    matches = make_matches(12)
+    backend.append_matches(matches)
+    since, until = int(matches[4,5]), int(matches[8,5])
+    assert np.array_equal(backend.query_matches(since=since, until=until), matches[4:8])
+    assert np.array_equal(backend.query_matches(pid=0), matches[(matches[:,0]==0) | (matches[:,1]==0)])
+    assert np.array_equal(backend.recent_matches(5), matches[-5:])
+    assert np.array_equal(backend.recent_matches(100), matches)
+
+
+def test_migrates_pickled_matches_into_shards(backend):
+    matches = make_matches(6)
+    with open(backend.matches_filename, 'wb') as outfile:
+        pickle.dump(matches.tolist(), outfile)
+    assert backend.count_matches() == 6
+    assert os.path.isdir(backend.match_shard_directory)
+    assert np.array_equal(np.asarray(backend.load_matches()), matches)
+
+
+def test_write_matches_survives_interrupted_swap(backend):
+    matches = make_matches(12)
+    backend.append_matches(matches)
+    # New shards complete, old ones moved aside, then a crash before the new ones moved in
+    backend.build_match_shards(matches[:3])
+    os.rename(backend.match_shard_directory, backend.match_shard_directory + '.old')
+    assert np.array_equal(np.asarray(sbk.FileBackend(os.path.dirname(backend.match_shard_directory)).load_matches()), matches[:3])
+
+    # A crash while building the new shards leaves the old ones in place
+    backend.build_match_shards(matches[:1])
+    assert backend.count_matches() == 3
+    backend.write_matches(matches[5:])
+    assert np.array_equal(np.asarray(backend.load_matches()), matches[5:])
+    assert os.listdir(os.path.dirname(backend.match_shard_directory)) == ['matches']
+
+
+def make_stats(num_players):
+    stats = sbk.empty_player_stats(num_players)
+    stats['rank'] = 100.*np.arange(num_players)
+    stats['wins'] = np.arange(num_players)
+    stats['acc'] = 0.5
+    stats['known'] = np.arange(num_players) % 3 != 1
+    return stats
+
+
+def test_stats_file_round_trip_and_versions(backend):
+    assert backend.player_stats_version() is None
+    assert backend.load_player_stats() is None
+    stats = make_stats(7)
+    assert backend.save_player_stats(stats) == 1
+    assert backend.save_player_stats(stats[:5]) == 2
+    assert backend.player_stats_version() == 2
+    loaded, version = backend.load_player_stats()
+    assert version == 2
+    assert np.array_equal(loaded, stats[:5])
+
+    # Loaded stats are copy-on-write: changing them leaves the file alone
+    loaded['rank'][0] = -1.
+    assert backend.load_player_stats()[0]['rank'][0] == 0.
+    with open(backend.stats_filename, 'r+b') as outfile:
+        outfile.write(b'NOTSTATS')
+    with pytest.raises(IOError):
+        backend.player_stats_version()
+
+
+def test_migrates_pickled_stats_once(backend):
+    ranks = {0: 1500., 2: 1320.}
+    dicts = [ranks, {0: 3, 2: 1}, {0: 1, 2: 4}, {0: 4, 2: 5}, {0: .75, 2: .2}, {0: .5, 2: 0.}, {0: 1., 2: .25}]
+    with open(backend.ranks_filename, 'wb') as outfile:
+        pickle.dump(dicts, outfile)
+    assert backend.player_stats_version() == 1
+    loaded, version = backend.load_player_stats()
+    assert version == 1
+    assert loaded['known'].tolist() == [True, False, True]
+    assert loaded['rank'][[0, 2]].tolist() == [1500., 1320.]
+    assert loaded['losses'][[0, 2]].tolist() == [1, 4]
+    assert loaded['tnr'][[0, 2]].tolist() == [1., .25]
+
+    # The pickle is only read while stats.bin does not exist
+    assert backend.save_player_stats(make_stats(3)) == 2
+    assert np.array_equal(backend.load_player_stats()[0], make_stats(3))
+
+
+def test_sqlite_backend_shared_between_threads(tmp_path):
+    import threading
+    backend = sbk.SQLiteBackend(str(tmp_path / 'saltwatch.db'))
+    matches = make_matches(400)
+    errors = []
+    def append(part):
+        try:
+            for start in range(0, len(part), 10):
+                backend.append_matches(part[start:start+10])
+                backend.count_matches()
+                backend.recent_matches(5)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=append, args=(matches[i::4],)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert backend.count_matches() == 400
+    loaded = backend.load_matches()
+    assert np.array_equal(loaded[np.lexsort((loaded[:,5],))], matches)
+    backend.close()
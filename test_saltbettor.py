@@ -0,0 +1,77 @@
+from time import time
+import pytest
+import saltprocessing as sp
+import saltstorage as ss
+import saltbettor as sb
+
+
+@pytest.fixture
+def bettor(monkeypatch):
+    # Empty balance cache, with server balances served from a dict
+    monkeypatch.setattr(sb, 'balances', {})
+    monkeypatch.setattr(sb, 'balance_stats', dict((key, 0) for key in sb.balance_stats))
+    monkeypatch.setattr(sb, 'open_bet', None)
+    server = {sp.MATCHMAKING: 5000, sp.TOURNAMENT: 800}
+    monkeypatch.setattr(sb, 'fetch_balance', lambda mode: server[mode])
+    for name in ('player_registry', 'player_id_dict', 'player_name_dict', 'num_saved_players', 'player_stats'):
+        monkeypatch.setattr(ss, name, getattr(ss, name))
+    ss.set_player_registry(ss.PlayerRegistry(['Alpha', 'Beta']))
+    ss.player_stats = ss.sbk.empty_player_stats(2)
+    return server
+
+
+def test_cached_balance_used_until_it_expires(bettor, monkeypatch):
+    assert sb.get_cached_balance(sp.MATCHMAKING) == 5000
+    bettor[sp.MATCHMAKING] = 6000
+    assert sb.get_cached_balance(sp.MATCHMAKING) == 5000
+    sb.adjust_cached_balance(sp.MATCHMAKING, -1000)
+    assert sb.get_cached_balance(sp.MATCHMAKING) == 4000
+
+    # Past BALANCE_MAX_AGE the server is asked again
+    balance, fetched = sb.balances[sp.MATCHMAKING]
+    sb.balances[sp.MATCHMAKING] = (balance, fetched - sb.BALANCE_MAX_AGE - 1)
+    assert sb.get_cached_balance(sp.MATCHMAKING) == 6000
+    stats = sb.get_balance_cache_stats()
+    assert (stats['misses'], stats['hits'], stats['stale'], stats['refreshes'], stats['local_updates']) == (1, 2, 1, 2, 1)
+
+    # Nothing cached, nothing to adjust
+    sb.adjust_cached_balance(sp.TOURNAMENT, 100)
+    assert sp.TOURNAMENT not in sb.balances
+
+
+def test_winning_bet_paid_out_rounded_up(bettor):
+    sb.balances[sp.MATCHMAKING] = (900, time())
+    # 100 on player 2, who had 300 bet on them against 1000
+    sb.open_bet = (sp.MATCHMAKING, 1, 100, 0, 1, 2)
+    assert sb.settle_open_bet(sp.MATCHMAKING, [0, 1, 1, 1000, 300, 0])
+    assert sb.balances[sp.MATCHMAKING][0] == 900 + 100 + 334
+    assert sb.open_bet is None
+
+    # A lost bet was already paid for when it was placed
+    sb.open_bet = (sp.MATCHMAKING, 0, 100, 0, 1, 2)
+    assert sb.settle_open_bet(sp.MATCHMAKING, [0, 1, 1, 1000, 300, 0])
+    assert sb.balances[sp.MATCHMAKING][0] == 1334
+
+    # Another match's result, or another mode, settles nothing
+    for mode, match in [(sp.MATCHMAKING, [1, 0, 0, 300, 1000, 0]), (sp.TOURNAMENT, [0, 1, 1, 1000, 300, 0])]:
+        sb.open_bet = (sp.MATCHMAKING, 1, 100, 0, 1, 2)
+        assert not sb.settle_open_bet(mode, match)
+    assert sb.balances[sp.MATCHMAKING][0] == 1334
+
+
+def test_bet_on_new_character_settled_at_result(bettor, monkeypatch):
+    monkeypatch.setattr(sb, 'place_bet', lambda player, wager: True)
+    monkeypatch.setattr(sb.random, 'randint', lambda low, high: 1)
+    monkeypatch.setattr(ss, 'add_bet', lambda bet: None)
+    sb.balances[sp.MATCHMAKING] = (1500, time())
+    # Gamma is new, so still -1 while betting is open
+    assert sb.place_saltmind_bet(sp.MATCHMAKING, [0, -1, -1, 0, 0, 0])
+    assert sb.balances[sp.MATCHMAKING][0] == 0
+
+    gamma = ss.get_player_registry().add('Gamma')
+    assert sb.settle_open_bet(sp.MATCHMAKING, [0, gamma, 1, 1000, 1500, 0])
+    assert sb.balances[sp.MATCHMAKING][0] == 1500 + 1000
+
+    # An ID that already existed when the bet was placed is a different character
+    assert sb.place_saltmind_bet(sp.MATCHMAKING, [0, -1, -1, 0, 0, 0])
+    assert not sb.settle_open_bet(sp.MATCHMAKING, [0, 1, 1, 1000, 1500, 0])
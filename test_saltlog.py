@@ -0,0 +1,40 @@
+import os
+import pytest
+import saltlog as sl
+
+
+@pytest.fixture
+def state_log(tmp_path, monkeypatch):
+    sl.stop_state_log()
+    monkeypatch.setattr(sl, 'ENABLED', True)
+    monkeypatch.setattr(sl, 'STATE_LOG_MAX_BYTES', 1024)
+    monkeypatch.setattr(sl, 'STATE_LOG_ROTATE_WHEN', None)
+    filename = str(tmp_path / 'state_log.jsonl')
+    sl.start_state_log(filename)
+    yield filename
+    sl.stop_state_log()
+
+
+def test_records_written_and_rotated_into_gzipped_segments(state_log):
+    states = [{'p1name': 'Alpha {:d}'.format(i), 'p2name': 'Beta', 'status': 'open'} for i in range(40)]
+    for i, state in enumerate(states):
+        sl.log_state('M', 'O', state, [sl.RESULTS] if i % 2 else [], received=1000+i)
+    # Stopping drains the queue on the listener thread
+    sl.stop_state_log()
+
+    segments = sorted(name for name in os.listdir(os.path.dirname(state_log)) if name.endswith('.gz'))
+    assert len(segments) > 1
+    # Oldest segment has the highest number
+    filenames = [state_log + '.{:d}.gz'.format(n) for n in range(len(segments), 0, -1)] + [state_log]
+    records = [record for filename in filenames for record in sl.read_state_log(filename)]
+    assert [record['state'] for record in records] == states
+    assert [record['received'] for record in records] == list(range(1000, 1040))
+    assert records[1] == {'received': 1001, 'mode': 'M', 'status': 'O', 'categories': [sl.RESULTS], 'state': states[1]}
+    assert all(os.path.getsize(filename) <= sl.STATE_LOG_MAX_BYTES for filename in filenames[-1:])
+
+
+def test_disabled_log_writes_nothing(state_log, monkeypatch):
+    monkeypatch.setattr(sl, 'ENABLED', False)
+    sl.log_state('M', 'O', {'status': 'open'})
+    sl.stop_state_log()
+    assert os.path.getsize(state_log) == 0
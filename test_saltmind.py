@@ -1,3 +1,5 @@
+import os
+import pytest
 import saltmind as sm
 import numpy as np
 
@@ -9,36 +11,169 @@ test_matches = [[0, 1, 0, 0, 0, 1],
 test_pid_dict = {0:0, 1:1, 2:2, 3:3}
 test_pname_dict = {0:0, 1:1, 2:2, 3:3}
 
-N_VAL = 0
-N_TEST = 0
-initial_ranks = {}
-neighbor_regularization = 0.00
-MAX_ITER = 100
-random_state = 1334
+# Fixed synthetic ranks, with a hole at ID 4
+test_ranks = {0: 1500., 1: 1320.5, 2: 1710., 3: 1400., 5: 1000.}
 
 
-new_ranks, wins, losses, times_seen, acc, tpr, tnr = sm.run_one_model(np.array(test_matches), test_pid_dict, test_pname_dict, N_VAL, N_TEST, initial_ranks, neighbor_regularization, MAX_ITER, verbose=True, random_state=random_state)
+def old_predict_outcomes(ranks, pid1, pid2):
+    # The original dict-based batch prediction, one pair at a time
+    return np.array([sm.predict_one_outcome(ranks, id1, id2) for id1,id2 in zip(pid1, pid2)])
 
-print(new_ranks)
-print(wins)
-print(losses)
-print(times_seen)
-print('')
 
+def test_predict_outcomes_from_array_matches_dict_predictions():
+    # Batch predictions should match the per-pair predictions, with 0.5 for unknown players
+    pid1 = np.array([0, 1, 2, 3, -1, 7, 4, 5, 2])
+    pid2 = np.array([1, 2, 3, 0, 2, 0, 1, 0, 2])
+    rank_values, known = sm.build_rank_array(test_ranks)
+    expected = old_predict_outcomes(test_ranks, pid1, pid2)
+    assert np.allclose(sm.predict_outcomes_from_array(rank_values, known, pid1, pid2), expected)
+    assert np.allclose(sm.predict_outcomes(test_ranks, pid1, pid2), expected)
+    assert np.allclose(expected[[4, 5, 6]], 0.5)
 
-N_VAL = 0
-N_TEST = 0
-initial_ranks = {}
-neighbor_regularization = 1.
-MAX_ITER = 100
-random_state = 1334
 
+def test_predict_outcomes_from_array_single_pair():
+    rank_values, known = sm.build_rank_array(test_ranks)
+    assert np.isclose(float(sm.predict_outcomes_from_array(rank_values, known, 0, 2)), sm.predict_one_outcome(test_ranks, 0, 2))
+    assert float(sm.predict_outcomes_from_array(rank_values, known, 0, 4)) == 0.5
 
-new_ranks, wins, losses, times_seen, acc, tpr, tnr = sm.run_one_model(np.array(test_matches), test_pid_dict, test_pname_dict, N_VAL, N_TEST, initial_ranks, neighbor_regularization, MAX_ITER, verbose=True, random_state=random_state)
 
-print(new_ranks)
-print(wins)
-print(losses)
-print(times_seen)
-print('')
+def old_evaluate_prediction_stats(matches, pid_list, ranks):
+    # The original dict-based per-match loop
+    predictions = sm.predict_outcomes(ranks, matches[:,0], matches[:,1])
+    tp, fp, tn, fn = [{pid:0.0 for pid in pid_list} for i in range(4)]
+    for match, pred_val in zip(matches, predictions):
+        winner_id = match[match[2]]
+        loser_id = match[1-match[2]]
+        if pred_val == 0.5:
+            pred = int(round(np.random.random()))
+        else:
+            pred = int(round(pred_val))
+        if match[2] == pred:
+            tp[winner_id] += 1
+            tn[loser_id] += 1
+        else:
+            fp[winner_id] += 1
+            fn[loser_id] += 1
+    totals = {pid:tp[pid]+tn[pid]+fp[pid]+fn[pid] for pid in pid_list}
+    totals_p = {pid:tp[pid]+fp[pid] for pid in pid_list}
+    totals_n = {pid:tn[pid]+fn[pid] for pid in pid_list}
+    acc = {pid:(tp[pid]+tn[pid])/float(totals[pid]) if not totals[pid]==0 else 0.0 for pid in pid_list}
+    tpr = {pid:tp[pid]/float(totals_p[pid]) if not totals_p[pid]==0 else 0.0 for pid in pid_list}
+    tnr = {pid:tn[pid]/float(totals_n[pid]) if not totals_n[pid]==0 else 0.0 for pid in pid_list}
+    return acc, tpr, tnr
 
+
+def old_evaluate_player_stats(matches, pid_list, neighborhood_sizes):
+    times_seen = dict(zip(pid_list, neighborhood_sizes))
+    w = {pid:0 for pid in pid_list}
+    l = {pid:0 for pid in pid_list}
+    for match in matches:
+        w[match[match[2]]] += 1
+        l[match[1-match[2]]] += 1
+    return w, l, times_seen
+
+
+def test_vectorized_evaluation_matches_dict_loops(monkeypatch):
+    rng = np.random.RandomState(7)
+    matches = np.zeros((500, 6), dtype=np.int64)
+    matches[:,0] = rng.randint(0, 12, 500)
+    matches[:,1] = (matches[:,0] + rng.randint(1, 12, 500)) % 12
+    matches[:,2] = rng.randint(0, 2, 500)
+    # IDs 8 to 11 are unknown to the model, and ID 12 has no matches
+    ranks = {pid: float(rank) for pid, rank in enumerate(rng.normal(1500, 200, 8))}
+    pid_list = list(range(13))
+
+    # Both versions guess randomly on unknown players; feed them the same guesses in match order
+    predictions = sm.predict_outcomes(ranks, matches[:,0], matches[:,1])
+    guesses = rng.randint(0, 2, np.sum(predictions == 0.5))
+    assert len(guesses) > 0
+    remaining = list(guesses)
+    monkeypatch.setattr(np.random, 'random', lambda: float(remaining.pop(0)))
+    expected = old_evaluate_prediction_stats(matches, pid_list, ranks)
+    assert remaining == []
+    monkeypatch.setattr(np.random, 'randint', lambda low, high, size: guesses[:size].copy())
+    assert sm.evaluate_prediction_stats(matches, pid_list, ranks) == expected
+
+    sizes = [np.sum(matches[:,:2] == pid) for pid in pid_list]
+    sizes[3] += 1   # Reported as invalid by both
+    assert sm.evaluate_player_stats(matches, pid_list, sizes) == old_evaluate_player_stats(matches, pid_list, sizes)
+
+
+def test_neighborhood_index_only_reused_for_the_same_matches():
+    matches = np.array(test_matches)
+    index = sm.NeighborhoodIndex(matches[:2])
+    index.extend(matches[2:])
+    assert index.covers(matches)
+    assert index.checksum == sm.NeighborhoodIndex(matches).checksum
+    # Same length, different pairs or order
+    assert not index.covers(matches[::-1])
+    swapped = matches.copy()
+    swapped[3,:2] = [2, 3]
+    assert not index.covers(swapped)
+
+    pid_list = [0, 1, 2, 3]
+    weights = np.ones(len(matches))
+    reused = sm.calc_neighborhoods(swapped, weights, pid_list, neighborhood_index=index)
+    rebuilt = sm.calc_neighborhoods(swapped, weights, pid_list)
+    assert (reused[0] != rebuilt[0]).nnz == 0
+    assert np.array_equal(reused[1], rebuilt[1])
+
+
+def test_prepared_input_cache_is_opt_in_and_under_data_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sm.ss, 'DATA_DIRECTORY', str(tmp_path / 'data'))
+    matches = np.array(test_matches)
+    uncached = sm.prepare_inputs(matches, test_pid_dict, test_pname_dict, verbose=False)
+    assert os.listdir(str(tmp_path)) == []
+    cached = sm.prepare_inputs(matches, test_pid_dict, test_pname_dict, verbose=False, use_cache=True)
+    assert os.path.isfile(os.path.join(sm.get_prepared_cache_directory(), 'index.json'))
+    assert sm.get_prepared_cache_directory().startswith(str(tmp_path / 'data'))
+    reloaded = sm.prepare_inputs(matches, test_pid_dict, test_pname_dict, verbose=False, use_cache=True)
+    assert uncached[0] == cached[0] == reloaded[0]
+    assert np.allclose(uncached[3], reloaded[3])
+
+
+def test_run_one_model_only_rates_players_in_matches():
+    pytest.importorskip('sklearn.cross_validation')
+    # A training window without player 1
+    window = np.array([[0, 2, 0, 0, 0, 1], [0, 3, 0, 0, 0, 1], [2, 3, 1, 0, 0, 1]]*20)
+    results = sm.run_one_model(window, test_pid_dict, test_pname_dict, 0, 0, {}, 0., 10, base_lr=2, frac_lr_const=0., min_weight=0., verbose=False)
+    for stat in results:
+        assert sorted(stat.keys()) == [0, 2, 3]
+    assert results[1][0] > 0 and results[2][3] > 0
+
+
+if __name__ == "__main__":
+    # Example training runs, printed for inspection
+    N_VAL = 0
+    N_TEST = 0
+    initial_ranks = {}
+    neighbor_regularization = 0.00
+    MAX_ITER = 100
+    random_state = 1334
+
+
+    new_ranks, wins, losses, times_seen, acc, tpr, tnr = sm.run_one_model(np.array(test_matches), test_pid_dict, test_pname_dict, N_VAL, N_TEST, initial_ranks, neighbor_regularization, MAX_ITER, verbose=True, random_state=random_state)
+
+    print(new_ranks)
+    print(wins)
+    print(losses)
+    print(times_seen)
+    print('')
+
+
+    N_VAL = 0
+    N_TEST = 0
+    initial_ranks = {}
+    neighbor_regularization = 1.
+    MAX_ITER = 100
+    random_state = 1334
+
+
+    new_ranks, wins, losses, times_seen, acc, tpr, tnr = sm.run_one_model(np.array(test_matches), test_pid_dict, test_pname_dict, N_VAL, N_TEST, initial_ranks, neighbor_regularization, MAX_ITER, verbose=True, random_state=random_state)
+
+    print(new_ranks)
+    print(wins)
+    print(losses)
+    print(times_seen)
+    print('')
@@ -0,0 +1,81 @@
+import threading
+import pytest
+import saltprocessing as sp
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, state=None, etag=None):
+        self.status_code = status_code
+        self.state = state
+        self.headers = {'ETag': etag} if etag is not None else {}
+
+    def json(self):
+        return dict(self.state)
+
+
+class FakeSession(object):
+    # Serves the given states in turn, answering 304 when the request's ETag matches the current one
+
+    def __init__(self, states):
+        self.states = list(states)
+        self.requests = []
+
+    def get(self, url, headers=None, timeout=None):
+        self.requests.append(dict(headers))
+        etag, state = self.states[0]
+        if len(self.states) > 1:
+            self.states.pop(0)
+        if headers.get('If-None-Match') == etag:
+            return FakeResponse(304)
+        return FakeResponse(200, state, etag)
+
+
+@pytest.fixture
+def session(monkeypatch):
+    for name, value in [('cached_state', None), ('cached_etag', None), ('cached_last_modified', None),
+                        ('num_state_fetches', 0), ('num_not_modified', 0), ('fetches_in_flight', 0)]:
+        monkeypatch.setattr(sp, name, value)
+    monkeypatch.setattr(sp, 'state_latencies', sp.deque(maxlen=1000))
+    def install(states):
+        fake = FakeSession(states)
+        monkeypatch.setattr(sp, 'session', fake)
+        return fake
+    return install
+
+
+def test_not_modified_reuses_cached_state(session):
+    fake = session([('a', {'status': 'open'}), ('a', {'status': 'open'}), ('b', {'status': 'locked'})])
+    assert sp.get_state() == {'status': 'open'}
+    assert sp.get_state() == {'status': 'open'}
+    assert fake.requests[1] == {'If-None-Match': 'a'}
+    assert sp.get_state() == {'status': 'locked'}
+    stats = sp.get_state_latency_stats()
+    assert stats['fetches'] == 3 and stats['not_modified'] == 1
+    assert sp.fetches_in_flight == 0
+
+
+def test_not_modified_answered_with_state_of_validators_sent(session, monkeypatch):
+    # Another thread caches a newer state while this request is in flight
+    fake = session([('a', {'status': 'open'})])
+    sp.get_state()
+    get = fake.get
+    def racing_get(url, headers=None, timeout=None):
+        response = get(url, headers=headers, timeout=timeout)
+        with sp.state_lock:
+            sp.cached_state, sp.cached_etag = {'status': 'locked'}, 'b'
+        return response
+    monkeypatch.setattr(fake, 'get', racing_get)
+    assert sp.get_state() == {'status': 'open'}
+
+
+def test_concurrent_fetches_keep_counters_consistent(session):
+    session([('a', {'status': 'open'})])
+    threads = [threading.Thread(target=lambda: [sp.get_state() for i in range(50)]) for j in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sp.num_state_fetches == 200
+    assert sp.fetches_in_flight == 0
+    assert sp.cached_state == {'status': 'open'}
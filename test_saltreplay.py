@@ -0,0 +1,94 @@
+import os
+import gzip
+import json
+import pytest
+import saltstorage as ss
+import saltreplay as sr
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    # An empty file backend in tmp_path
+    monkeypatch.setattr(ss, 'DATA_DIRECTORY', str(tmp_path))
+    monkeypatch.setattr(ss, 'SQLITE_FILENAME', str(tmp_path / 'saltwatch.db'))
+    monkeypatch.setattr(ss, 'ONLINE_UPDATES', False)
+    ss.use_backend('file')
+    ss.set_player_registry(ss.PlayerRegistry())
+    ss.matches, ss.bets = [], []
+    yield tmp_path
+    ss.wait_for_persistence()
+    if ss.journal_file is not None:
+        ss.journal_file.close()
+        ss.journal_file = None
+    ss.use_backend('file')
+
+
+def make_state(p1name, p2name, status, remaining='99 more matches until the next tournament!', p1total='1,000', p2total='2,000'):
+    return {'p1name': p1name, 'p2name': p2name, 'status': status, 'remaining': remaining,
+            'p1total': p1total, 'p2total': p2total, 'alert': '', 'x': 0}
+
+
+# One match: betting opens, locks, then p2 wins
+MATCH_STATES = [make_state('Alpha', 'Beta', 'open', '98 more matches until the next tournament!', '0', '0'),
+                make_state('Alpha', 'Beta', 'locked', '98 more matches until the next tournament!'),
+                make_state('Alpha', 'Beta', '2', '97 more matches until the next tournament!')]
+
+
+def write_full_state_log(filename, lines):
+    with open(filename, 'w') as outfile:
+        for line in lines:
+            outfile.write(line + '\n')
+
+
+def write_json_state_log(filename, states, start_time):
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'wt') as outfile:
+        for i, state in enumerate(states):
+            outfile.write(json.dumps({'received': start_time + 60*i, 'mode': 'M', 'status': '?', 'categories': [], 'state': state}) + '\n')
+
+
+def test_full_state_log_parsed_with_simulated_clock(tmp_path):
+    filename = str(tmp_path / 'full_state_log.txt')
+    state = MATCH_STATES[0]
+    write_full_state_log(filename, ['M O ' + str(state), 'M O ' + str(state), 'garbage', 'M R {not a dict', 'M L ' + str(MATCH_STATES[1])])
+    records = list(sr.read_states(filename, start_time=1000))
+    assert [record[0] for record in records] == [1060, 1120, 1180, 1240, 1300]
+    assert records[0] == (1060, 'M', 'O', state)
+    assert records[1][3] == state
+    assert records[2][3] is None and records[3][3] is None
+    assert records[4] == (1300, 'M', 'L', MATCH_STATES[1])
+
+
+def test_json_state_log_read_plain_and_gzipped(tmp_path):
+    for name in ('state_log.jsonl', 'state_log.jsonl.1.gz'):
+        filename = str(tmp_path / name)
+        write_json_state_log(filename, MATCH_STATES, 5000)
+        records = list(sr.read_states(filename))
+        assert [record[0] for record in records] == [5000, 5060, 5120]
+        assert [record[3] for record in records] == MATCH_STATES
+
+
+def test_replay_across_rotated_and_gzipped_logs(storage):
+    filename = str(storage / 'state_log.jsonl')
+    second = [make_state('Gamma', 'Alpha', status, '96 more matches until the next tournament!') for status in ('open', 'locked', '1')]
+    third = [make_state('Beta', 'Gamma', status, '95 more matches until the next tournament!') for status in ('open', 'locked', '2')]
+    # Oldest first: .2.gz, .1.gz, then the live log. The first match's result is repeated across a rotation.
+    write_json_state_log(filename + '.2.gz', MATCH_STATES, 1000)
+    write_json_state_log(filename + '.1.gz', MATCH_STATES[2:] + second, 2000)
+    write_json_state_log(filename, third, 3000)
+    segments = sr.state_log_segments(filename)
+    assert segments == [filename + '.2.gz', filename + '.1.gz', filename]
+
+    results = sr.regenerate_match_store(str(storage), segments)
+    assert results['states'] == 10
+    assert results['duplicates'] == 1
+    assert results['matches'] == 3
+    assert [ss.player_name_dict[pid] for pid in range(3)] == ['Alpha', 'Beta', 'Gamma']
+    assert [match[:3] for match in ss.matches] == [[0, 1, 1], [2, 0, 0], [1, 2, 1]]
+    assert [match[5] for match in ss.matches] == [1120, 2180, 3120]
+
+    # Everything was saved, nothing journaled
+    assert not os.path.isfile(ss.get_journal_filename())
+    ss.set_player_registry(ss.PlayerRegistry())
+    ss.load_persistent_data()
+    assert len(ss.matches) == 3 and len(ss.player_id_dict) == 3
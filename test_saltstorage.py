@@ -0,0 +1,405 @@
+import os
+import threading
+import numpy as np
+import pytest
+import saltstorage as ss
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    # A fresh file backend in tmp_path
+    monkeypatch.setattr(ss, 'DATA_DIRECTORY', str(tmp_path))
+    monkeypatch.setattr(ss, 'ONLINE_UPDATES', False)
+    monkeypatch.setattr(ss, 'player_stats', ss.sbk.empty_player_stats())
+    monkeypatch.setattr(ss, 'player_stats_version', None)
+    crash()
+    ss.use_backend('file')
+    ss.set_player_registry(ss.PlayerRegistry())
+    ss.matches, ss.bets = [], []
+    yield tmp_path
+    ss.wait_for_persistence()
+    crash()
+    ss.use_backend('file')
+
+
+def crash():
+    # Drop the open journal without saving anything, as a killed process would
+    if ss.journal_file is not None:
+        ss.journal_file.close()
+        ss.journal_file = None
+
+
+def restart():
+    crash()
+    ss.use_backend('file')
+    ss.set_player_registry(ss.PlayerRegistry())
+    ss.matches, ss.bets = [], []
+    ss.load_persistent_data()
+
+
+def make_match(i):
+    return [i % 3, (i+1) % 3, i % 2, 100*i, 200*i, 1420070400 + 180*i]
+
+
+def make_bet(i):
+    return ['M', i % 2, 1.5, 10*i, 1000+i, 1420070400 + 180*i]
+
+
+def add_players():
+    for name in ['Alpha', 'Beta', 'Gamma']:
+        ss.assign_new_player_id(name)
+
+
+def test_journal_replayed_after_crash_before_save(storage):
+    add_players()
+    for i in range(5):
+        ss.add_match(make_match(i))
+        ss.add_bet(make_bet(i))
+    restart()
+    assert [ss.player_name_dict[pid] for pid in range(3)] == ['Alpha', 'Beta', 'Gamma']
+    assert list(ss.matches) == [make_match(i) for i in range(5)]
+    assert list(ss.bets) == [make_bet(i) for i in range(5)]
+
+    # Crashing again before a save replays the same journal, still exactly once
+    restart()
+    assert len(ss.player_id_dict) == 3
+    assert list(ss.matches) == [make_match(i) for i in range(5)]
+    assert list(ss.bets) == [make_bet(i) for i in range(5)]
+
+
+def test_journal_not_replayed_on_top_of_saved_data(storage):
+    add_players()
+    for i in range(3):
+        ss.add_match(make_match(i))
+        ss.add_bet(make_bet(i))
+    ss.save_persistent_data()
+    assert not os.path.isfile(ss.get_journal_filename())
+    assert not os.path.isfile(ss.get_saved_journal_filename())
+    ss.add_match(make_match(3))
+    restart()
+    assert list(ss.matches) == [make_match(i) for i in range(4)]
+    assert list(ss.bets) == [make_bet(i) for i in range(3)]
+
+
+def test_interrupted_rotation_segment_replayed_first(storage):
+    add_players()
+    ss.add_match(make_match(0))
+    ss.save_persistent_data()
+    ss.add_match(make_match(1))
+    ss.add_bet(make_bet(1))
+    # A save that rotated the journal and then died before writing anything
+    ss.rotate_journal()
+    assert os.path.isfile(ss.get_saved_journal_filename())
+    ss.add_match(make_match(2))
+    restart()
+    assert list(ss.matches) == [make_match(i) for i in range(3)]
+    assert list(ss.bets) == [make_bet(1)]
+
+    # The next successful save covers both segments and removes them
+    ss.save_persistent_data()
+    assert not os.path.isfile(ss.get_saved_journal_filename())
+    restart()
+    assert list(ss.matches) == [make_match(i) for i in range(3)]
+    assert list(ss.bets) == [make_bet(1)]
+
+
+def test_rotation_segment_left_after_completed_save_not_duplicated(storage):
+    add_players()
+    for i in range(3):
+        ss.add_match(make_match(i))
+    # A save that wrote everything but died before removing the rotated segment
+    ss.rotate_journal()
+    ss.save_matches()
+    ss.save_dictionaries()
+    assert os.path.isfile(ss.get_saved_journal_filename())
+    restart()
+    assert list(ss.matches) == [make_match(i) for i in range(3)]
+    assert len(ss.player_id_dict) == 3
+
+
+def test_torn_journal_entry_ignored(storage):
+    add_players()
+    ss.add_match(make_match(0))
+    ss.add_match(make_match(1))
+    crash()
+    with open(ss.get_journal_filename(), 'a') as outfile:
+        outfile.write('{"type": "match", "index": 2, "mat')
+    restart()
+    assert list(ss.matches) == [make_match(0), make_match(1)]
+    assert np.asarray(ss.matches).shape == (2, 6)
+
+    # Entries journaled after the torn one still come back
+    ss.add_match(make_match(2))
+    restart()
+    assert list(ss.matches) == [make_match(i) for i in range(3)]
+
+
+def test_bet_count_read_without_scanning_history(storage, monkeypatch):
+    backend = ss.get_backend()
+    backend.write_bets([make_bet(i) for i in range(3)])
+    backend.append_bets([make_bet(3), make_bet(4)])
+    # The recorded count is used as is
+    with monkeypatch.context() as patch:
+        patch.setattr(ss.sbk, 'count_json_lines', lambda *args: pytest.fail('bets.txt was scanned'))
+        assert backend.count_bets() == 5
+
+    # Lines appended after the count was recorded are added on; a missing count is rebuilt
+    with open(backend.bet_log_filename, 'ab') as outfile:
+        outfile.write(ss.sbk.encode_json_lines([make_bet(5)]))
+    assert backend.count_bets() == 6
+    os.remove(backend.bet_count_filename)
+    assert backend.count_bets() == 6
+    ss.open_bets()
+    assert len(ss.bets) == 6
+
+
+def counting(function, calls, name):
+    def wrapped(*args):
+        calls.append(name)
+        return function(*args)
+    return wrapped
+
+
+def test_history_len_and_append_do_not_load(storage):
+    calls = []
+    history = ss.History(loader=counting(lambda: [[1], [2]], calls, 'load'), counter=counting(lambda: 2, calls, 'count'))
+    history.append([3])
+    assert len(history) == 3
+    assert calls == ['count']
+    assert history[2] == [3]
+    assert calls == ['count', 'load']
+    assert list(history) == [[1], [2], [3]]
+    assert calls == ['count', 'load']
+
+
+def test_history_abort_puts_records_back_in_order(storage):
+    history = ss.History(loader=lambda: [], counter=lambda: 0)
+    history.append('a')
+    records, rewrite = history.take_pending()
+    assert records == ['a'] and not rewrite
+    history.append('b')
+    assert len(history) == 2 and list(history) == ['a', 'b']
+    history.abort_saving()
+    assert history.take_pending()[0] == ['a', 'b']
+    history.finish_saving()
+    assert len(history) == 2 and history.unsaved() == []
+
+
+def test_match_history_opens_lazily(storage):
+    add_players()
+    for i in range(4):
+        ss.add_match(make_match(i))
+    ss.save_persistent_data()
+    restart()
+    assert isinstance(ss.matches, ss.MatchHistory)
+    assert ss.matches.loaded is None
+    ss.add_match(make_match(4))
+    assert len(ss.matches) == 5
+    assert ss.matches.loaded is None
+    assert ss.matches[-1] == make_match(4)
+    assert np.array_equal(np.asarray(ss.matches), [make_match(i) for i in range(5)])
+    assert ss.matches[1:3] == [make_match(1), make_match(2)]
+
+
+def test_replaced_match_list_rewrites_backend(storage):
+    for i in range(4):
+        ss.add_match(make_match(i))
+    ss.save_matches()
+    ss.matches = [make_match(i) for i in (7, 8)]
+    ss.save_matches()
+    ss.open_matches()
+    assert list(ss.matches) == [make_match(7), make_match(8)]
+
+
+def test_background_save_writes_everything(storage):
+    add_players()
+    for i in range(3):
+        ss.add_match(make_match(i))
+        ss.add_bet(make_bet(i))
+    assert ss.save_persistent_data_async()
+    ss.wait_for_persistence()
+    assert not ss.save_in_progress
+    assert not os.path.isfile(ss.get_saved_journal_filename())
+    restart()
+    assert list(ss.matches) == [make_match(i) for i in range(3)]
+    assert list(ss.bets) == [make_bet(i) for i in range(3)]
+
+
+def test_failed_background_save_is_retried(storage, monkeypatch):
+    add_players()
+    ss.add_match(make_match(0))
+    ss.add_bet(make_bet(0))
+    ss.save_persistent_data()
+    ss.add_match(make_match(1))
+    ss.add_bet(make_bet(1))
+
+    backend = ss.get_backend()
+    def failing_append(records):
+        raise IOError('disk full')
+    monkeypatch.setattr(backend, 'append_matches', failing_append)
+    assert ss.save_persistent_data_async()
+    ss.wait_for_persistence()
+    assert not ss.save_in_progress
+    # The matches go back to pending and their journal segment is kept; the bets were still saved
+    assert ss.matches.unsaved() == [make_match(1)]
+    assert ss.bets.unsaved() == []
+    assert os.path.isfile(ss.get_saved_journal_filename())
+
+    # A crash now still recovers the match from the journal, once
+    ss.add_match(make_match(2))
+    restart()
+    assert list(ss.matches) == [make_match(i) for i in range(3)]
+    assert list(ss.bets) == [make_bet(0), make_bet(1)]
+
+    # The restarted backend writes normally again
+    assert ss.get_backend() is not backend
+    assert ss.save_persistent_data_async()
+    ss.wait_for_persistence()
+    assert not os.path.isfile(ss.get_saved_journal_filename())
+    restart()
+    assert list(ss.matches) == [make_match(i) for i in range(3)]
+    assert list(ss.bets) == [make_bet(0), make_bet(1)]
+
+
+def test_records_added_during_background_save_stay_pending(storage, monkeypatch):
+    ss.add_match(make_match(0))
+    backend = ss.get_backend()
+    started, release = threading.Event(), threading.Event()
+    write_matches = backend.write_matches
+    def slow_write(records):
+        started.set()
+        release.wait(5)
+        write_matches(records)
+    monkeypatch.setattr(backend, 'write_matches', slow_write)
+    assert ss.save_persistent_data_async()
+    assert started.wait(5)
+    # Only one background save at a time
+    assert not ss.save_persistent_data_async()
+    ss.add_match(make_match(1))
+    assert len(ss.matches) == 2
+    release.set()
+    ss.wait_for_persistence()
+    assert ss.matches.unsaved() == [make_match(1)]
+    ss.save_persistent_data()
+    ss.open_matches()
+    assert list(ss.matches) == [make_match(0), make_match(1)]
+
+
+def test_match_added_during_save_snapshot_not_lost(storage, monkeypatch):
+    ss.add_match(make_match(0))
+    ss.save_persistent_data()
+    journaled, release = threading.Event(), threading.Event()
+    write_journal_entry = ss.write_journal_entry
+    def slow_journal(entry):
+        write_journal_entry(entry)
+        journaled.set()
+        release.wait(5)
+    monkeypatch.setattr(ss, 'write_journal_entry', slow_journal)
+    # The match is journaled but not yet added when the save takes its snapshot
+    adding = threading.Thread(target=ss.add_match, args=(make_match(1),))
+    adding.start()
+    assert journaled.wait(5)
+    saving = threading.Thread(target=ss.save_persistent_data)
+    saving.start()
+    saving.join(0.2)
+    release.set()
+    adding.join()
+    saving.join()
+    assert len(ss.matches) == 2
+    restart()
+    assert list(ss.matches) == [make_match(0), make_match(1)]
+
+
+def make_stats(ranks):
+    stats = ss.sbk.empty_player_stats(len(ranks))
+    stats['rank'] = ranks
+    stats['known'] = True
+    return stats
+
+
+def test_online_update_moves_ranks_by_elo_step(storage, monkeypatch):
+    monkeypatch.setattr(ss, 'player_stats', make_stats([0., 0.]))
+    monkeypatch.setattr(ss, 'ONLINE_UPDATES', True)
+    ss.act_on_processed_state(ss.sp.MATCHMAKING, ss.sp.RESULTS, [0, 1, 1, 100, 200, 1420070400])
+    # Equal ranks predict 0.5, so the winner gains and the loser drops half the K factor
+    assert ss.player_stats['rank'].tolist() == [-ss.ONLINE_K_FACTOR/2, ss.ONLINE_K_FACTOR/2]
+    assert ss.player_stats['wins'].tolist() == [0, 1]
+    assert ss.player_stats['losses'].tolist() == [1, 0]
+    assert ss.player_stats['times_seen'].tolist() == [1, 1]
+
+    # An expected result moves the ranks less than an upset
+    ss.update_player_stats_online([0, 1, 1])
+    expected_step = ss.player_stats['rank'][1] - ss.ONLINE_K_FACTOR/2
+    ss.update_player_stats_online([0, 1, 0])
+    upset_step = ss.player_stats['rank'][0] - (-ss.ONLINE_K_FACTOR/2 - expected_step)
+    assert 0 < expected_step < ss.ONLINE_K_FACTOR/2 < upset_step
+
+
+def test_online_update_grows_stats_for_new_player(storage, monkeypatch):
+    monkeypatch.setattr(ss, 'player_stats', make_stats([100., 300.]))
+    ss.update_player_stats_online([0, 3, 0])
+    assert len(ss.player_stats) == 4
+    assert ss.player_stats['known'].tolist() == [True, True, False, True]
+    # The new player started at the average rank of the known ones, then lost
+    pred = 1./(1+10**((100.-200.)/400.))
+    assert np.isclose(ss.player_stats['rank'][3], 200. - ss.ONLINE_K_FACTOR*pred)
+    assert ss.player_stats['losses'][3] == 1 and ss.player_stats['times_seen'][3] == 1
+
+
+def test_reload_during_online_update_keeps_new_version(storage, monkeypatch):
+    backend = ss.get_backend()
+    backend.save_player_stats(make_stats([0.]*10))
+    ss.load_player_stats()
+    version = backend.save_player_stats(make_stats([1000.]*10))
+    growing, release = threading.Event(), threading.Event()
+    empty_player_stats = ss.sbk.empty_player_stats
+    def slow_empty_player_stats(size=0):
+        growing.set()
+        release.wait(5)
+        return empty_player_stats(size)
+    monkeypatch.setattr(ss.sbk, 'empty_player_stats', slow_empty_player_stats)
+    # The reload arrives while an update for new players is growing the old array
+    updating = threading.Thread(target=ss.update_player_stats_online, args=([10, 11, 0],))
+    updating.start()
+    assert growing.wait(5)
+    reloading = threading.Thread(target=ss.load_player_stats, kwargs={'only_if_changed': True})
+    reloading.start()
+    reloading.join(0.2)
+    release.set()
+    updating.join()
+    reloading.join()
+    assert ss.player_stats_version == version
+    assert ss.player_stats['rank'][:10].tolist() == [1000.]*10
+
+
+def test_merged_stats_keep_players_outside_training_window(storage, monkeypatch):
+    old = make_stats([10., 20., 30.])
+    old['wins'] = [1, 2, 3]
+    monkeypatch.setattr(ss, 'player_stats', old)
+    # Retrained on a window with players 1 and 4 only
+    ss.merge_player_stats({1: 25., 4: 40.}, {1: 5, 4: 1}, {1: 0, 4: 2}, {1: 5, 4: 3}, {1: 1., 4: .5}, {1: 1., 4: .5}, {1: 1., 4: .5})
+    assert ss.player_stats['rank'].tolist() == [10., 25., 30., 0., 40.]
+    assert ss.player_stats['wins'].tolist() == [1, 5, 3, 0, 1]
+    assert ss.player_stats['known'].tolist() == [True, True, True, False, True]
+
+
+def test_stats_reload_skipped_while_version_unchanged(storage, monkeypatch):
+    backend = ss.get_backend()
+    backend.save_player_stats(make_stats([10., 20.]))
+    ss.load_player_stats()
+    assert ss.player_stats_version == 1
+    ss.update_player_stats_online([0, 1, 1])
+    updated = ss.player_stats['rank'].tolist()
+
+    # Polling an unchanged version only reads the header and keeps the online updates
+    with monkeypatch.context() as patch:
+        patch.setattr(backend, 'load_player_stats', lambda: pytest.fail('unchanged stats reloaded'))
+        ss.load_player_stats(only_if_changed=True)
+    assert ss.player_stats['rank'].tolist() == updated
+
+    # A retrain saves a new version, which replaces them
+    backend.save_player_stats(make_stats([30., 40.]))
+    ss.reload_player_stats_async()
+    ss.wait_for_persistence()
+    assert ss.player_stats_version == 2
+    assert ss.player_stats['rank'].tolist() == [30., 40.]